@@ -1 +1,3 @@
 from .assembler import SyntaxError, Assembler
+from .cache import AssemblyCache
+from .link import LinkError, ObjectModule, assemble_module, build, link
@@ -0,0 +1,363 @@
+import io
+import itertools
+import os
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from .assembler import Assembler, SyntaxError, INSTRUCTIONS, FIELDS, D8, D16
+from .cache import AssemblyCache
+from .link import LinkError, assemble_module, build, link, load_object
+from .bench import make_source, source_lines
+
+class AssemblerTest(unittest.TestCase):
+    def assemble(self, program):
+        return Assembler(program).assemble()
+
+    def test_instructions(self):
+        program = 'NOP\nMVI A, 05\nMVI B,ff\nMVI C,0\nADI 10\nSTA 1234\nLDA ffff\nHLT'
+        self.assertEqual(self.assemble(program), bytes((
+            0x00, 0x3e, 0x05, 0x06, 0xff, 0x0e, 0x00, 0xc6, 0x10,
+            0x32, 0x34, 0x12, 0x3a, 0xff, 0xff, 0x76,
+        )))
+
+    def test_blank_lines_and_comments(self):
+        self.assertEqual(self.assemble(''), b'')
+        self.assertEqual(self.assemble('\n  ; comment\r\n\tNOP ; trailing\r\n\nHLT\n'), b'\x00\x76')
+
+    def test_errors(self):
+        cases = (
+            ('NOP\n\n!NOP', 'Expected instruction on line 3'),
+            ('FOO', 'Unknown instruction "FOO" on line 1'),
+            ('NOP\nNOP NOP', 'Expected new line on line 2'),
+            ('MVI Q,05', 'Unknown argument 1 to MVI "Q" on line 1'),
+            ('MOV M,M', 'Cannot move from M to M on line 1'),
+            ('PUSH SP', 'Unknown argument to PUSH "SP" on line 1'),
+            ('LDAX H', 'Unknown argument to LDAX "H" on line 1'),
+            ('RST 8', 'Unknown argument to RST "8" on line 1'),
+            ('LXI B', 'Expected , on line 1'),
+            ('JNZ', 'Expected argument to JNZ on line 1'),
+            ('RET 00', 'Expected new line on line 1'),
+            ('MVI A 05', 'Expected , on line 1'),
+            ('MVI A,', 'Expected argument 2 to MVI on line 1'),
+            ('MVI A,100', '"256" does not fit in a byte on line 1'),
+            ('LDA', 'Expected argument to LDA on line 1'),
+            ('STA 9z', 'Cannot interpret "9z" as 2 bytes on line 1'),
+            ('MVI A,9z', 'Cannot interpret "9z" as a byte on line 1'),
+            ('NOP\nSTA xyz\nNOP', 'Undefined symbol "xyz" on line 2'),
+            ('x: NOP\nx: NOP', 'Duplicate symbol "x" on line 2'),
+            ('add: NOP', 'Invalid symbol name "add" on line 1'),
+            ('1x EQU 5', 'Invalid symbol name "1x" on line 1'),
+            ('x EQU y\ny EQU 1', 'Undefined symbol "y" on line 1'),
+            ('NOP\nORG 0', 'ORG 0000 is below the current address 0001 on line 2'),
+            ('MVI A,big\nbig EQU 100', '"256" does not fit in a byte on line 1'),
+            ('ADI,05', 'Expected argument to ADI on line 1'),
+            ('ORG ffff\nLXI H, 0\nHLT', 'Code runs past ffff to 10001 on line 2'),
+            ('ORG fffe\nDB 1, 2, 3', 'Code runs past ffff to 10000 on line 2'),
+        )
+        for program, msg in cases:
+            with self.assertRaises(SyntaxError) as cm:
+                self.assemble(program)
+            self.assertEqual(str(cm.exception), msg)
+
+    def test_every_opcode(self):
+        # every operand combination of every mnemonic, immediates as 00
+        opcodes = []
+        for op, (_, operands) in INSTRUCTIONS.items():
+            choices = [['00'] if kind in (D8, D16) else list(FIELDS[kind][0]) for kind in operands]
+            for args in itertools.product(*choices):
+                if op == 'MOV' and args == ('M', 'M'):
+                    continue
+                code = self.assemble(f'{op} {",".join(args)}')
+                length = {D8: 2, D16: 3}.get(operands[-1] if operands else None, 1)
+                self.assertEqual(len(code), length, op)
+                opcodes.append(code[0])
+        undefined = {0x08, 0x10, 0x18, 0x28, 0x38, 0xcb, 0xd9, 0xdd, 0xed, 0xfd}
+        self.assertEqual(sorted(opcodes), sorted(set(range(256)) - undefined))
+
+    def test_program(self):
+        program = '''
+            LXI SP, 2000
+            LXI H, 1000
+            lxi d, 0
+            MVI C, 00
+            CALL 0014   ; loop
+            INX H
+            DCR C
+            JNZ 000b
+            HLT
+            PUSH PSW    ; add
+            MOV A, E
+            ADD M
+            MOV E, A
+            JNC 001c
+            INR D
+            POP PSW     ; done
+            RET
+        '''
+        self.assertEqual(self.assemble(program), bytes((
+            0x31, 0x00, 0x20, 0x21, 0x00, 0x10, 0x11, 0x00, 0x00, 0x0e, 0x00,
+            0xcd, 0x14, 0x00, 0x23, 0x0d, 0xc2, 0x0b, 0x00, 0x76, 0xf5, 0x7b,
+            0x86, 0x5f, 0xd2, 0x1c, 0x00, 0x14, 0xf1, 0xc9,
+        )))
+
+    def test_labels(self):
+        program = '''
+            count EQU 10
+            start: MVI C, count
+            loop:
+                CALL sub    ; forward reference
+                DCR C
+                JNZ loop
+                HLT
+            sub: INR A
+                RET
+        '''
+        assembler = Assembler(program, 0x100)
+        self.assertEqual(assembler.assemble(), bytes((
+            0x0e, 0x10, 0xcd, 0x0a, 0x01, 0x0d, 0xc2, 0x02, 0x01, 0x76, 0x3c, 0xc9,
+        )))
+        self.assertEqual(assembler.symbols, {'count': 0x10, 'start': 0x100, 'loop': 0x102, 'sub': 0x10a})
+        self.assertEqual(assembler.symbol_map(), '0010 count\n0100 start\n0102 loop\n010a sub\n')
+
+    def test_many_labels(self):
+        assembler = Assembler(make_source(20000))
+        assembler.assemble()
+        self.assertEqual(len(assembler.symbols), 20000 // 16)
+        self.assertFalse(assembler.fixups)
+        self.assertEqual(assembler.pending, {})
+
+    def test_org(self):
+        assembler = Assembler('ORG 2000\nJMP next\nORG 2005\nnext: HLT\ndata EQU next')
+        self.assertEqual(assembler.assemble(), b'\xc3\x05\x20\x00\x00\x76')
+        self.assertEqual(assembler.origin, 0x2000)
+        self.assertEqual(assembler.symbols['data'], 0x2005)
+        # code may end at the last address
+        self.assertEqual(Assembler('ORG fffd\nJMP 0\nend:').assemble(), b'\xc3\x00\x00')
+
+    def test_db(self):
+        assembler = Assembler('table: DB 08, ff, size\nDB end\nsize EQU 3\nend: db 0')
+        self.assertEqual(assembler.assemble(), b'\x08\xff\x03\x04\x00')
+        for program, msg in (('DB', 'Expected argument to DB on line 1'),
+                             ('DB 100', '"256" does not fit in a byte on line 1'),
+                             ('DB 1 2', 'Expected , on line 1')):
+            with self.assertRaises(SyntaxError) as cm:
+                Assembler(program).assemble()
+            self.assertEqual(str(cm.exception), msg)
+
+    def test_stream(self):
+        read = []
+        def lines():
+            for n, line in enumerate(source_lines(5000, labels=False)):
+                read.append(n)
+                yield line + '\n'
+        chunks = []
+        for addr, data in Assembler(lines(), 0x100).stream(1000):
+            chunks.append((addr, data, len(read)))
+        self.assertGreater(len(chunks), 3)
+        # chunks are contiguous and handed out before the source is exhausted
+        self.assertEqual(chunks[0][0], 0x100)
+        for (addr, data, _), (next_addr, _, _) in zip(chunks, chunks[1:]):
+            self.assertGreaterEqual(len(data), 1000)
+            self.assertEqual(addr + len(data), next_addr)
+        self.assertLess(chunks[0][2], 5000)
+        source = make_source(5000, labels=False)
+        self.assertEqual(b''.join(data for _, data, _ in chunks), Assembler(source).assemble())
+
+    def test_stream_forward_reference(self):
+        program = ['JMP end'] + ['NOP'] * 100 + ['end: HLT'] + ['NOP'] * 100
+        chunks = list(Assembler(program).stream(10))
+        # nothing can be handed out until end is defined
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[0][1][:3], b'\xc3\x67\x00')
+        self.assertGreaterEqual(len(chunks[0][1]), 0x68)
+        with self.assertRaises(SyntaxError) as cm:
+            list(Assembler(['NOP', 'JMP end', 'NOP']).stream(1))
+        self.assertEqual(str(cm.exception), 'Undefined symbol "end" on line 2')
+
+    def test_write_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'program.asm')
+            with open(path, 'w') as f:
+                f.write(make_source(3000))
+            out = io.BytesIO()
+            with open(path) as f:
+                size = Assembler(f).write(out, 100)
+        self.assertEqual(out.getvalue(), Assembler(make_source(3000)).assemble())
+        self.assertEqual(size, len(out.getvalue()))
+
+    def test_large_program(self):
+        source = make_source(20000, labels=False)
+        output = self.assemble(source)
+        # each line assembles on its own
+        self.assertEqual(output, b''.join(self.assemble(line) for line in source.split('\n')))
+
+class LinkTest(unittest.TestCase):
+    MAIN = '''
+        EXTRN sum, total
+        PUBLIC start
+        start: LXI H, data
+        loop: CALL sum
+            INX H
+            DCR C
+            JNZ loop
+            SHLD total
+            HLT
+        data: NOP
+    '''
+    LIB = '''
+        PUBLIC sum, total, size
+        size EQU 2
+        sum: ADD M
+            JNC done
+            INR B
+        done: RET
+        total: NOP
+            NOP
+    '''
+
+    def test_module(self):
+        obj = assemble_module(self.MAIN, 'main')
+        self.assertEqual(obj.exports, {'start': (0, True)})
+        # LXI H, data; JNZ loop
+        self.assertEqual(obj.relocations, [1, 9])
+        self.assertEqual(obj.imports, {'sum': [4], 'total': [12]})
+        lib = assemble_module(self.LIB, 'lib')
+        self.assertEqual(lib.exports, {'sum': (0, True), 'total': (6, True), 'size': (2, False)})
+        self.assertEqual(lib.relocations, [2])
+
+    def test_module_errors(self):
+        cases = (
+            ('ORG 100', 'ORG in a relocatable module on line 1'),
+            ('x: MVI A, x', 'Relocatable symbol "x" needs a 2 byte operand on line 1'),
+            ('MVI A, x\nx: NOP', 'Relocatable symbol "x" needs a 2 byte operand on line 1'),
+            ('EXTRN x\nMVI A, x', 'External symbol "x" needs a 2 byte operand on line 2'),
+            ('x: NOP\nEXTRN x', 'Duplicate symbol "x" on line 2'),
+            ('EXTRN x\nx: NOP', 'Duplicate symbol "x" on line 2'),
+            ('PUBLIC x\nNOP', 'Undefined symbol "x" on line 1'),
+        )
+        for program, msg in cases:
+            with self.assertRaises(SyntaxError) as cm:
+                assemble_module(program)
+            self.assertEqual(str(cm.exception), msg)
+        with self.assertRaises(SyntaxError) as cm:
+            Assembler('EXTRN x').assemble()
+        self.assertEqual(str(cm.exception), 'EXTRN outside a relocatable module on line 1')
+
+    def test_link(self):
+        objects = [assemble_module(self.MAIN, 'main'), assemble_module(self.LIB, 'lib')]
+        image, symbols = link(objects, 0x100)
+        # the same program assembled as one absolute source
+        lines = (self.MAIN + self.LIB).split('\n')
+        source = '\n'.join(line for line in lines if 'EXTRN' not in line and 'PUBLIC' not in line)
+        self.assertEqual(image, Assembler(source, 0x100).assemble())
+        self.assertEqual(symbols, {'start': 0x100, 'sum': 0x110, 'total': 0x116, 'size': 2})
+
+    def test_link_errors(self):
+        main = assemble_module(self.MAIN, 'main')
+        with self.assertRaises(LinkError) as cm:
+            link([main])
+        self.assertEqual(str(cm.exception), 'Undefined symbol "sum" in main')
+        lib = assemble_module(self.LIB, 'lib')
+        with self.assertRaises(LinkError) as cm:
+            link([main, lib, lib])
+        self.assertEqual(str(cm.exception), 'Symbol "sum" exported by lib and lib')
+        with self.assertRaises(LinkError):
+            link([main, lib], 0xfff0)
+        # labels at the end of a module ending at 10000
+        end = assemble_module('JMP end\nend:', 'end')
+        with self.assertRaises(LinkError) as cm:
+            link([end], 0xfffd)
+        self.assertEqual(str(cm.exception), 'Relocated address 10000 out of range in end')
+        user = assemble_module('EXTRN end\nJMP end', 'user')
+        end = assemble_module('PUBLIC end\nNOP\nend:', 'end')
+        with self.assertRaises(LinkError) as cm:
+            link([user, end], 0xfffc)
+        self.assertEqual(str(cm.exception), 'Symbol "end" at 10000 out of range in user')
+        self.assertEqual(link([end], 0xffff)[1], {'end': 0x10000})
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name, source in (('main', self.MAIN), ('lib', self.LIB), ('extra', 'NOP')):
+                paths.append(os.path.join(tmp, name + '.asm'))
+                with open(paths[-1], 'w') as f:
+                    f.write(source)
+            objects, rebuilt = build(paths, workers=2)
+            self.assertEqual(rebuilt, paths)
+            image, _ = link(objects)
+            self.assertEqual(build(paths)[1], [])
+            with open(paths[2], 'w') as f:
+                f.write('HLT')
+            objects, rebuilt = build(paths, workers=2)
+            self.assertEqual(rebuilt, paths[2:])
+            self.assertEqual(link(objects)[0], image[:-1] + b'\x76')
+            self.assertEqual(load_object(os.path.join(tmp, 'extra.obj')).code, b'\x76')
+            with open(paths[2], 'w') as f:
+                f.write('FOO')
+            with self.assertRaises(SyntaxError) as cm:
+                build(paths)
+            self.assertEqual(str(cm.exception), f'{paths[2]}: Unknown instruction "FOO" on line 1')
+
+def cached_assemble(path, seed):
+    return AssemblyCache(path, max_bytes=2000).assemble(make_source(100, seed))
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def entries(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.bin'))
+
+    def test_hit(self):
+        cache = AssemblyCache(self.path)
+        program = 'ORG 100\nstart: MVI A, 1\nJMP start'
+        first = cache.assemble(program)
+        self.assertEqual(first, (0x100, b'\x3e\x01\xc3\x00\x01', {'start': 0x100}))
+        self.assertEqual(cache.assemble(program), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # another process sees the same entry
+        other = AssemblyCache(self.path)
+        self.assertEqual(other.assemble(program), first)
+        self.assertEqual(other.hits, 1)
+        # the origin is part of the key
+        self.assertEqual(cache.assemble('NOP', 0x200)[0], 0x200)
+        self.assertEqual(cache.assemble('NOP', 0x300)[0], 0x300)
+        self.assertEqual(len(self.entries()), 3)
+
+    def test_errors_not_cached(self):
+        cache = AssemblyCache(self.path)
+        for _ in range(2):
+            with self.assertRaises(SyntaxError):
+                cache.assemble('JMP nowhere')
+        self.assertEqual((cache.misses, self.entries()), (2, []))
+
+    def test_eviction(self):
+        # room for two entries
+        cache = AssemblyCache(self.path, max_bytes=500)
+        programs = [make_source(100, seed) for seed in range(3)]
+        cache.assemble(programs[0])
+        cache.assemble(programs[1])
+        cache.assemble(programs[0])
+        self.assertEqual(cache.hits, 1)
+        # the least recently used entry goes first
+        cache.assemble(programs[2])
+        self.assertEqual(len(self.entries()), 2)
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.path, name)) for name in self.entries()), 500)
+        cache.assemble(programs[0])
+        self.assertEqual(cache.hits, 2)
+        cache.assemble(programs[1])
+        self.assertEqual(cache.hits, 2)
+
+    def test_concurrent(self):
+        seeds = [seed % 8 for seed in range(64)]
+        with ProcessPoolExecutor(4) as pool:
+            results = list(pool.map(cached_assemble, [self.path] * len(seeds), seeds))
+        for seed, result in zip(seeds, results):
+            self.assertEqual(result[1], Assembler(make_source(100, seed)).assemble())
+        self.assertEqual([name for name in os.listdir(self.path) if not name.endswith('.bin')], [])
+
+unittest.main()
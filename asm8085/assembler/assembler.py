@@ -1,141 +1,401 @@
+import re
 import string
+import sys
+from collections import deque
+
+# bump whenever the same source can assemble to different output, it is part
+# of the cache key
+VERSION = 1
 
 class SyntaxError(Exception):
     pass
 
+# a word or any other single character, which the parser reports as unexpected
+TOKEN = re.compile(r'[A-Za-z0-9]+|[^ \t\r\n]')
+WORD_CHARS = frozenset(string.ascii_uppercase + string.ascii_lowercase + string.digits)
+
+# operand kinds, register fields are (names, shift) pairs ORed into the opcode
+REGS = {name: code for code, name in enumerate('BCDEHLMA')}
+D8 = 'd8'
+D16 = 'd16'
+FIELDS = {
+    'src': (REGS, 0),
+    'dst': (REGS, 3),
+    'rp': ({'B': 0, 'D': 1, 'H': 2, 'SP': 3}, 4),
+    'push': ({'B': 0, 'D': 1, 'H': 2, 'PSW': 3}, 4),
+    'bd': ({'B': 0, 'D': 1}, 4),
+    'rst': ({str(n): n for n in range(8)}, 3),
+}
+
+# mnemonic -> (opcode with zeroed fields, operand kinds), immediates follow the
+# opcode little-endian
+INSTRUCTIONS = {
+    # data transfer
+    'MOV': (0x40, ('dst', 'src')),
+    'MVI': (0x06, ('dst', D8)),
+    'LXI': (0x01, ('rp', D16)),
+    'LDA': (0x3a, (D16,)),
+    'STA': (0x32, (D16,)),
+    'LHLD': (0x2a, (D16,)),
+    'SHLD': (0x22, (D16,)),
+    'LDAX': (0x0a, ('bd',)),
+    'STAX': (0x02, ('bd',)),
+    'XCHG': (0xeb, ()),
+    # arithmetic
+    'ADD': (0x80, ('src',)),
+    'ADC': (0x88, ('src',)),
+    'SUB': (0x90, ('src',)),
+    'SBB': (0x98, ('src',)),
+    'ADI': (0xc6, (D8,)),
+    'ACI': (0xce, (D8,)),
+    'SUI': (0xd6, (D8,)),
+    'SBI': (0xde, (D8,)),
+    'INR': (0x04, ('dst',)),
+    'DCR': (0x05, ('dst',)),
+    'INX': (0x03, ('rp',)),
+    'DCX': (0x0b, ('rp',)),
+    'DAD': (0x09, ('rp',)),
+    'DAA': (0x27, ()),
+    # logical
+    'ANA': (0xa0, ('src',)),
+    'XRA': (0xa8, ('src',)),
+    'ORA': (0xb0, ('src',)),
+    'CMP': (0xb8, ('src',)),
+    'ANI': (0xe6, (D8,)),
+    'XRI': (0xee, (D8,)),
+    'ORI': (0xf6, (D8,)),
+    'CPI': (0xfe, (D8,)),
+    'RLC': (0x07, ()),
+    'RRC': (0x0f, ()),
+    'RAL': (0x17, ()),
+    'RAR': (0x1f, ()),
+    'CMA': (0x2f, ()),
+    'CMC': (0x3f, ()),
+    'STC': (0x37, ()),
+    # branch
+    'JMP': (0xc3, (D16,)),
+    'CALL': (0xcd, (D16,)),
+    'RET': (0xc9, ()),
+    'RST': (0xc7, ('rst',)),
+    'PCHL': (0xe9, ()),
+    # stack, I/O and machine control
+    'PUSH': (0xc5, ('push',)),
+    'POP': (0xc1, ('push',)),
+    'XTHL': (0xe3, ()),
+    'SPHL': (0xf9, ()),
+    'IN': (0xdb, (D8,)),
+    'OUT': (0xd3, (D8,)),
+    'EI': (0xfb, ()),
+    'DI': (0xf3, ()),
+    'RIM': (0x20, ()),
+    'SIM': (0x30, ()),
+    'HLT': (0x76, ()),
+    'NOP': (0x00, ()),
+}
+# conditional jumps, calls and returns in condition code order
+for code, cc in enumerate(('NZ', 'Z', 'NC', 'C', 'PO', 'PE', 'P', 'M')):
+    INSTRUCTIONS['J' + cc] = (0xc2 | code << 3, (D16,))
+    INSTRUCTIONS['C' + cc] = (0xc4 | code << 3, (D16,))
+    INSTRUCTIONS['R' + cc] = (0xc0 | code << 3, ())
+
+# names an argument in error messages, numbered only when there are several
+def argument(op, n, operands):
+    if len(operands) > 1:
+        return f'argument {n + 1} to {op}'
+    return f'argument to {op}'
+
+# immediate kinds as named in error messages
+SIZES = {D8: 'a byte', D16: '2 bytes'}
+LIMITS = {D8: 0xff, D16: 0xffff}
+
+def is_number(word):
+    try:
+        int(word, 16)
+    except ValueError:
+        return False
+    return True
+
+# Labels ("name:"), "name EQU value" and "ORG address" define symbols and move
+# the location counter, "DB byte, ..." emits bytes as they are. Operands are
+# hex numbers or symbols, a symbol used before it is defined is emitted as
+# zeros and patched when it is defined, so assembly is a single pass over the
+# source. Symbols are case-sensitive and cannot look like hex numbers.
+# The program is a string or any iterable of lines (an open file, a
+# generator). stream() hands out the output in chunks as lines are read, only
+# the output from the first unresolved forward reference on is held back.
+# A relocatable program is a module assembled at 0 for the linker: labels
+# (and EQUs of labels) are relative to the module start, every 2 byte operand
+# holding one is recorded in relocations, "PUBLIC name" exports a symbol and
+# "EXTRN name" declares one defined by another module, its uses are recorded
+# in imports.
 class Assembler:
-    def __init__(self, program):
+    def __init__(self, program, origin=0, relocatable=False):
         self.program = program
-        self.index = 0
-        self.output = b''
+        # output not handed out yet, it starts flushed bytes after the origin
+        self.output = bytearray()
+        self.flushed = 0
+        # address of the first byte, moved by an ORG before any code
+        self.origin = origin
         self.line = 1
+        # tokens of the current line and the index of the next one
+        self.tokens = []
+        self.index = 0
+        self.symbols = {}
+        # [offset from origin, operand kind, symbol, line] of forward
+        # references in offset order, the symbol is cleared once patched
+        self.fixups = deque()
+        # symbol -> its fixups not patched yet
+        self.pending = {}
+        self.relocatable = relocatable
+        # symbols relative to the module start
+        self.relative = set()
+        # offsets of 2 byte operands holding a relative value
+        self.relocations = []
+        # external symbol -> offsets of the 2 byte operands using it
+        self.imports = {}
+        # exported symbol -> line of its PUBLIC
+        self.exports = {}
 
-    def done(self):
-        return self.index == len(self.program)
+    def err(self, msg='Error', line=None):
+        raise SyntaxError(f'{msg} on line {self.line if line is None else line}')
 
-    def cur(self):
-        return self.program[self.index]
-    
-    def err(self, msg='Error'):
-        raise SyntaxError(f'{msg} on line {self.line}')
-    
     def emit(self, byte):
-        self.output += byte.to_bytes(1, byteorder='big')
+        self.output.append(byte)
 
-    def skip_whitespace(self):
-        while self.index < len(self.program):
-            cur = self.program[self.index]
-            if cur not in '; \t\r':
-                return
-            if cur == ';':
-                self.index += 1
-                while not self.done() and self.cur() != '\n':
-                    self.index += 1
-                return
-            self.index += 1
-    
-    def space_chk(self, msg='Error'):
-        self.skip_whitespace()
-        if self.done() or self.cur() == '\n':
-            self.err(msg)
+    def emit_word(self, word):
+        self.output.append(word & 0xff)
+        self.output.append(word >> 8)
 
-    def char_skip(self, chr, msg=f'Expected {chr}'):
-        if self.cur() != chr:
-            self.err(msg)
+    def here(self):
+        return self.origin + self.flushed + len(self.output)
+
+    def char_skip(self, chr, msg=None):
+        if self.index == len(self.tokens) or self.tokens[self.index] != chr:
+            self.err(msg or f'Expected {chr}')
         self.index += 1
 
     def parse_string(self, msg='Expected string'):
-        alphabet = string.ascii_uppercase + string.ascii_lowercase + string.digits
-        if self.done() or self.cur() not in alphabet:
+        if self.index == len(self.tokens) or self.tokens[self.index][0] not in WORD_CHARS:
             self.err(msg)
-        ident = ''
-        while not self.done() and self.cur() in alphabet:
-            ident += self.cur()
-            self.index += 1
-        return ident
-    
-    def as_hex_byte(self, string):
-        try:
-            val = int(string, 16)
-            if val < 0 or val > 255:
-                self.err(f'"{val}" does not fit in a byte')
-            return val
-        except ValueError:
-            self.err(f'Cannot interpret "{string}" as byte')
-    
-    def as_hex_two_bytes(self, string):
+        self.index += 1
+        return self.tokens[self.index - 1]
+
+    def end_line(self):
+        if self.index != len(self.tokens):
+            self.err('Expected new line')
+
+    def fit(self, val, kind, line=None):
+        if val > LIMITS[kind]:
+            self.err(f'"{val}" does not fit in {SIZES[kind]}', line)
+        return val
+
+    # the value of a number or defined symbol, None for a symbol not defined yet
+    def value(self, arg, kind):
         try:
-            val = int(string, 16)
-            if val < 0 or val > 65535:
-                self.err(f'"{val}" does not fit in 2 bytes')
-            return val
+            return self.fit(int(arg, 16), kind)
         except ValueError:
-            self.err(f'Cannot interpret "{string}" as 2 bytes')
-    
-    def assemble_next_line(self):
-        if self.done():
-            self.err('No more to assemble')
-        self.skip_whitespace()
+            pass
+        if arg[0] in string.digits:
+            self.err(f'Cannot interpret "{arg}" as {SIZES[kind]}')
+        val = self.symbols.get(arg)
+        return None if val is None else self.fit(val, kind)
+
+    def define(self, name, val):
+        if name[0] not in WORD_CHARS or name[0] in string.digits or is_number(name):
+            self.err(f'Invalid symbol name "{name}"')
+        if name in self.symbols or name in self.imports:
+            self.err(f'Duplicate symbol "{name}"')
+        self.symbols[name] = val
+        for fixup in self.pending.pop(name, ()):
+            offset, kind, _, line = fixup
+            self.fit(val, kind, line)
+            if name in self.relative:
+                self.relocate(offset, kind, name, line)
+            offset -= self.flushed
+            self.output[offset] = val & 0xff
+            if kind == D16:
+                self.output[offset + 1] = val >> 8
+            fixup[2] = None
+
+    def relocate(self, offset, kind, name, line=None):
+        if kind != D16:
+            self.err(f'Relocatable symbol "{name}" needs a 2 byte operand', line)
+        self.relocations.append(offset)
+
+    def emit_value(self, arg, kind):
+        val = self.value(arg, kind)
+        if arg in self.relative:
+            self.relocate(self.flushed + len(self.output), kind, arg)
+        elif val is None and arg in self.imports:
+            if kind != D16:
+                self.err(f'External symbol "{arg}" needs a 2 byte operand')
+            self.imports[arg].append(self.flushed + len(self.output))
+            val = 0
+        if val is None:
+            fixup = [self.flushed + len(self.output), kind, arg, self.line]
+            self.fixups.append(fixup)
+            self.pending.setdefault(arg, []).append(fixup)
+            val = 0
+        if kind == D8:
+            self.emit(val)
+        else:
+            self.emit_word(val)
+
+    # a value that has to be known when its line is assembled
+    def known_value(self, msg, kind=D16):
+        arg = self.parse_string(msg)
+        val = self.value(arg, kind)
+        if val is None:
+            self.err(f'Undefined symbol "{arg}"')
+        return val
+
+    def org(self):
+        if self.relocatable:
+            self.err('ORG in a relocatable module')
+        addr = self.known_value('Expected argument to ORG')
+        if not self.output and not self.flushed:
+            self.origin = addr
+        elif addr < self.here():
+            self.err(f'ORG {addr:04x} is below the current address {self.here():04x}')
+        else:
+            self.output.extend(bytes(addr - self.here()))
+
+    # DB takes a list of bytes
+    def db(self):
+        while True:
+            self.emit_value(self.parse_string('Expected argument to DB'), D8)
+            if self.index == len(self.tokens):
+                return
+            self.char_skip(',')
+
+    # PUBLIC and EXTRN take a list of symbols
+    def linkage(self, op):
+        if not self.relocatable:
+            self.err(f'{op} outside a relocatable module')
+        while True:
+            name = self.parse_string(f'Expected symbol for {op}')
+            if op == 'PUBLIC':
+                self.exports[name] = self.line
+            elif name in self.symbols or name in self.imports:
+                self.err(f'Duplicate symbol "{name}"')
+            else:
+                self.imports[name] = []
+            if self.index == len(self.tokens):
+                return
+            self.char_skip(',')
+
+    def assemble_line(self, text):
+        comment = text.find(';')
+        if comment >= 0:
+            text = text[:comment]
+        tokens = self.tokens = TOKEN.findall(text)
+        self.index = 0
         # check for empty line
-        if self.done():
+        if not tokens:
             return
-        if self.cur() == '\n':
-            self.line += 1
-            self.index += 1
-            return    
+        if len(tokens) > 1:
+            if tokens[1] == ':':
+                # relative before define() patches the forward references
+                if self.relocatable:
+                    self.relative.add(tokens[0])
+                self.define(tokens[0], self.here())
+                self.index = 2
+                if len(tokens) == 2:
+                    return
+            elif tokens[1].upper() == 'EQU':
+                self.index = 2
+                val = self.known_value('Expected argument to EQU')
+                if tokens[2] in self.relative:
+                    self.relative.add(tokens[0])
+                self.define(tokens[0], val)
+                return self.end_line()
         # get instruction mnemonic
-        op = self.parse_string('Expected instruction')
-        if op == 'NOP':
-            self.emit(0x00)
-        elif op == 'MVI':
-            self.space_chk('Expected argument 1 to MVI')
-            arg1 = self.parse_string('Expected argument 1 to MVI')
-            self.char_skip(',')
-            # argument 1
-            if arg1 == 'A':
-                self.emit(0x3e)
-            elif arg1 == 'B':
-                self.emit(0x06)
-            elif arg1 == 'C':
-                self.emit(0x0e)
-            else:
-                self.err(f'Unknown argument 1 to MVI "{arg1}"')
-            # argument 2
-            self.space_chk('Expected argument 2 to MVI')
-            arg2 = self.parse_string('Expected argument 2 to MVI')
-            arg2 = self.as_hex_byte(arg2)
-            self.emit(arg2)
-        elif op == 'STA':
-            self.emit(0x32)
-            self.space_chk('Expected argument to STA')
-            arg = self.parse_string('Expected argument to STA')
-            arg = self.as_hex_two_bytes(arg)
-            top = arg >> 8
-            bottom = arg & 0xff
-            self.emit(bottom)
-            self.emit(top)
-        elif op == 'LDA':
-            self.emit(0x3a)
-            self.space_chk('Expected argument to STA')
-            arg = self.parse_string('Expected argument to STA')
-            arg = self.as_hex_two_bytes(arg)
-            top = arg >> 8
-            bottom = arg & 0xff
-            self.emit(bottom)
-            self.emit(top)
-        elif op == 'HLT':
-            self.emit(0x76)
-        elif op == 'ADI':
-            self.emit(0xc6)
-            self.space_chk('Expected argument to ADI')
-            arg = self.parse_string('Expected argument to ADI')
-            arg = self.as_hex_byte(arg)
-            self.emit(arg)
-        else:
-            self.err(f'Unknown instruction "{op}"')
-        self.skip_whitespace()
-        if self.cur() == '\n':
-            self.line += 1
+        word = self.parse_string('Expected instruction')
+        op = word.upper()
+        if op == 'ORG':
+            self.org()
+            return self.end_line()
+        if op == 'PUBLIC' or op == 'EXTRN':
+            return self.linkage(op)
+        if op == 'DB':
+            return self.db()
+        if op not in INSTRUCTIONS:
+            self.err(f'Unknown instruction "{word}"')
+        opcode, operands = INSTRUCTIONS[op]
+        arg = None
+        for n, kind in enumerate(operands):
+            if n:
+                self.char_skip(',')
+            if self.index == len(tokens) or tokens[self.index][0] not in WORD_CHARS:
+                self.err(f'Expected {argument(op, n, operands)}')
+            arg = tokens[self.index]
             self.index += 1
-        elif not self.done():
-            self.err('Expected new line')
+            if kind in FIELDS:
+                names, shift = FIELDS[kind]
+                code = names.get(arg.upper())
+                if code is None:
+                    self.err(f'Unknown {argument(op, n, operands)} "{arg}"')
+                opcode |= code << shift
+        if opcode == 0x76 and op == 'MOV':
+            self.err('Cannot move from M to M')
+        self.emit(opcode)
+        # immediates are always the last operand
+        if operands and operands[-1] in SIZES:
+            self.emit_value(arg, operands[-1])
+        self.end_line()
+
+    # number of output bytes before the first unresolved forward reference
+    def ready(self):
+        fixups = self.fixups
+        while fixups and fixups[0][2] is None:
+            fixups.popleft()
+        return fixups[0][0] - self.flushed if fixups else len(self.output)
+
+    # removes and returns the address and first size bytes of the output
+    def take(self, size):
+        addr = self.origin + self.flushed
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        self.flushed += size
+        return addr, data
+
+    # yields (address, bytes) chunks of at least chunk_size bytes, except for
+    # the last one, in address order
+    def stream(self, chunk_size=0x10000):
+        lines = self.program.split('\n') if isinstance(self.program, str) else self.program
+        for self.line, text in enumerate(lines, 1):
+            self.assemble_line(text)
+            # checked once a line rather than on every byte emitted
+            if self.here() > 0x10000:
+                self.err(f'Code runs past ffff to {self.here() - 1:x}')
+            if len(self.output) >= chunk_size:
+                size = self.ready()
+                if size >= chunk_size:
+                    yield self.take(size)
+        size = self.ready()
+        if self.fixups:
+            _, _, name, line = self.fixups[0]
+            self.err(f'Undefined symbol "{name}"', line)
+        for name, line in self.exports.items():
+            if name not in self.symbols:
+                self.err(f'Undefined symbol "{name}"', line)
+        if size:
+            yield self.take(size)
+
+    # writes the output to a binary file as it is assembled, returns its size
+    def write(self, f, chunk_size=0x10000):
+        size = 0
+        for _, data in self.stream(chunk_size):
+            f.write(data)
+            size += len(data)
+        return size
+
+    def assemble(self):
+        return b''.join(data for _, data in self.stream(sys.maxsize))
+
+    def symbol_map(self):
+        return symbol_map(self.symbols)
+
+# one "address name" line per symbol in address order
+def symbol_map(symbols):
+    return ''.join(f'{val:04x} {name}\n' for name, val in sorted(symbols.items(), key=lambda item: (item[1], item[0])))
@@ -0,0 +1,88 @@
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from .assembler import Assembler
+from .cache import AssemblyCache
+
+LINES = (
+    'NOP', 'HLT', 'MVI A, {:02x}', 'MVI B,{:02x} ; load B', 'ADI {:02x}',
+    'STA {:04x}', 'LDA {:04x}', '', '; comment only',
+)
+
+# with labels every 16th line defines a symbol and some lines jump to one of
+# the 32 nearest, half of them forward references (EQU rather than labels,
+# 100k lines do not fit in 64 KiB)
+def source_lines(lines, seed=0, labels=True):
+    rng = random.Random(seed)
+    for n in range(lines):
+        line = rng.choice(LINES).format(rng.randrange(256))
+        if labels:
+            if rng.random() < 0.1:
+                target = min(max(n // 16 + rng.randrange(-16, 16), 0), (lines - 1) // 16)
+                line = f'JNZ l{target * 16}'
+            if n % 16 == 0:
+                line = f'l{n} EQU {n & 0xffff:x}'
+        yield line
+
+def make_source(lines, seed=0, labels=True):
+    return '\n'.join(source_lines(lines, seed, labels))
+
+# time per line should stay flat as the source grows
+def bench_assemble(max_lines=100000):
+    print('assemble')
+    lines = max_lines // 8
+    while lines <= max_lines:
+        source = make_source(lines)
+        start = time.perf_counter()
+        output = Assembler(source).assemble()
+        elapsed = time.perf_counter() - start
+        print(f'{lines:8d} lines {len(output):8d} bytes {elapsed * 1000:8.1f} ms '
+              f'{elapsed / lines * 1e9:6.0f} ns/line')
+        lines *= 2
+
+# peak memory of assembling a generated source held as one string against
+# streaming it from a generator into a file
+def bench_stream(lines=200000):
+    print(f'stream, {lines} lines')
+    def peak(assemble):
+        tracemalloc.start()
+        start = time.perf_counter()
+        assemble()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, peak
+    with open(os.devnull, 'wb') as out:
+        cases = (
+            ('assemble()', lambda: Assembler(make_source(lines)).assemble()),
+            ('write()', lambda: Assembler(source_lines(lines)).write(out)),
+        )
+        for name, assemble in cases:
+            elapsed, peak_bytes = peak(assemble)
+            print(f'{name:12s} {elapsed * 1000:8.1f} ms  peak {peak_bytes / 1e6:8.2f} MB')
+
+def bench_cache(lines=10000, number=20):
+    print(f'cache, {lines} lines')
+    source = make_source(lines)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = AssemblyCache(tmp)
+        cache.assemble(source)
+        cases = (
+            ('assemble()', lambda: Assembler(source).assemble()),
+            ('cache hit', lambda: cache.assemble(source)),
+        )
+        for name, assemble in cases:
+            start = time.perf_counter()
+            for _ in range(number):
+                assemble()
+            elapsed = (time.perf_counter() - start) / number
+            print(f'{name:12s} {elapsed * 1000:8.2f} ms')
+
+if __name__ == '__main__':
+    max_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench_assemble(max_lines)
+    bench_stream(max_lines)
+    bench_cache()
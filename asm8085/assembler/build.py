@@ -0,0 +1,50 @@
+import os
+import sys
+from .assembler import Assembler, SyntaxError, symbol_map
+from .link import LinkError, build, link
+
+# python -m asm8085.assembler.build [--origin 0100] [--out program.bin]
+#                                   [--workers N] program.asm|module.asm ...
+# one source is assembled on its own, several are assembled as relocatable
+# modules (only those changed since their .obj was written) and linked in
+# order; writes the binary and a symbol map next to it (program.sym)
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {'--origin': [], '--out': [], '--workers': []}
+    paths = []
+    while args:
+        arg = args.pop(0)
+        if arg in options:
+            options[arg].append(args.pop(0))
+        else:
+            paths.append(arg)
+    origin = int(options['--origin'][-1], 16) if options['--origin'] else 0
+    workers = int(options['--workers'][-1]) if options['--workers'] else None
+    out = options['--out'][-1] if options['--out'] else os.path.splitext(paths[0])[0] + '.bin'
+    if len(paths) == 1:
+        # the source is streamed so it is never held in memory as a whole
+        path = paths[0]
+        with open(path) as src, open(out, 'wb') as dst:
+            assembler = Assembler(src, origin)
+            try:
+                size = assembler.write(dst)
+            except SyntaxError as e:
+                error = f'{path}: {e}'
+            else:
+                error = None
+        if error is not None:
+            os.remove(out)
+            sys.exit(error)
+        origin, symbols = assembler.origin, assembler.symbols
+        print(f'{path}: {size} bytes at {origin:04x}, {len(symbols)} symbols')
+    else:
+        try:
+            objects, rebuilt = build(paths, workers=workers)
+            image, symbols = link(objects, origin)
+        except (SyntaxError, LinkError) as e:
+            sys.exit(str(e))
+        with open(out, 'wb') as f:
+            f.write(image)
+        print(f'{out}: {len(image)} bytes at {origin:04x}, {len(rebuilt)} of {len(paths)} modules assembled')
+    with open(os.path.splitext(out)[0] + '.sym', 'w') as f:
+        f.write(symbol_map(symbols))
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import struct
+import tempfile
+import time
+from .assembler import VERSION, Assembler
+
+# On-disk cache of assembled programs keyed by a hash of the assembler
+# version, origin and source text, so a hit skips parsing entirely. Each entry
+# is one file holding the origin, the code and the symbol map. Entries are
+# written to a temporary file and renamed into place, so concurrent processes
+# only ever see complete entries. Reads and writes set the entry's mtime, when
+# the cache grows past max_bytes the least recently used entries are removed.
+
+HEADER = struct.Struct('<HI') # origin, code size
+SUFFIX = '.bin'
+
+def entry_key(source, origin=0):
+    h = hashlib.sha256(f'{VERSION}:{origin:04x}:'.encode())
+    h.update(source.encode())
+    return h.hexdigest()
+
+def touch(path):
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+class AssemblyCache:
+    def __init__(self, path, max_bytes=64 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    # returns (origin, code, symbols) or None
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError: # never written or evicted by another process
+            return None
+        try:
+            touch(path)
+        except FileNotFoundError:
+            pass
+        origin, size = HEADER.unpack_from(data)
+        start = HEADER.size
+        code = data[start:start + size]
+        symbols = {}
+        for line in data[start + size:].decode().splitlines():
+            addr, name = line.split(' ')
+            symbols[name] = int(addr, 16)
+        return origin, code, symbols
+
+    def put(self, key, origin, code, symbols):
+        symbol_map = ''.join(f'{val:04x} {name}\n' for name, val in symbols.items())
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(origin, len(code)))
+                f.write(code)
+                f.write(symbol_map.encode())
+            touch(tmp)
+            os.replace(tmp, self.entry_path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    # removes the least recently used entries until the cache fits max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith(SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except FileNotFoundError: # removed by another process
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    # assembles source, a string, through the cache
+    # returns (origin, code, symbols), raises SyntaxError like Assembler,
+    # errors are not cached
+    def assemble(self, source, origin=0):
+        key = entry_key(source, origin)
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        assembler = Assembler(source, origin)
+        code = assembler.assemble()
+        self.put(key, assembler.origin, code, assembler.symbols)
+        return assembler.origin, code, assembler.symbols
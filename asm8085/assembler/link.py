@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from .assembler import VERSION, SyntaxError, Assembler, symbol_map
+
+# Separate assembly and linking: each module is assembled at 0 into an object
+# file (JSON) holding its code, exports, imports and relocations, and the
+# linker places the modules one after another and patches them. Object files
+# record a hash of the source they were built from, build() only reassembles
+# modules whose source (or the assembler version) changed, in parallel.
+
+OBJECT_SUFFIX = '.obj'
+
+class LinkError(Exception):
+    pass
+
+# exports are name -> (value, relative), relocations the offsets of words the
+# module's address is added to, imports name -> offsets of the words set to
+# the symbol's address
+class ObjectModule:
+    def __init__(self, name, code, exports, relocations, imports, source_hash=None):
+        self.name = name
+        self.code = code
+        self.exports = exports
+        self.relocations = relocations
+        self.imports = imports
+        self.source_hash = source_hash
+
+def source_hash(source):
+    return hashlib.sha256(f'{VERSION}:module:{source}'.encode()).hexdigest()
+
+def assemble_module(source, name='module'):
+    assembler = Assembler(source, relocatable=True)
+    code = assembler.assemble()
+    exports = {name: (assembler.symbols[name], name in assembler.relative) for name in assembler.exports}
+    return ObjectModule(name, code, exports, sorted(assembler.relocations), assembler.imports,
+                        source_hash(source))
+
+def save_object(obj, path):
+    data = {
+        'name': obj.name, 'code': obj.code.hex(), 'exports': obj.exports,
+        'relocations': obj.relocations, 'imports': obj.imports, 'source': obj.source_hash,
+    }
+    # renamed into place so parallel builds never read half an object
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def load_object(path):
+    with open(path) as f:
+        data = json.load(f)
+    exports = {name: tuple(export) for name, export in data['exports'].items()}
+    return ObjectModule(data['name'], bytes.fromhex(data['code']), exports, data['relocations'],
+                        data['imports'], data['source'])
+
+def object_path(path, out_dir=None):
+    base = os.path.splitext(path)[0]
+    if out_dir is not None:
+        base = os.path.join(out_dir, os.path.basename(base))
+    return base + OBJECT_SUFFIX
+
+def up_to_date(path, obj_path):
+    with open(path) as f:
+        source = f.read()
+    try:
+        obj = load_object(obj_path)
+    except (OSError, ValueError, KeyError):
+        return False
+    return obj.source_hash == source_hash(source)
+
+def build_object(path, obj_path):
+    with open(path) as f:
+        source = f.read()
+    try:
+        obj = assemble_module(source, os.path.splitext(os.path.basename(path))[0])
+    except SyntaxError as e:
+        raise SyntaxError(f'{path}: {e}') from None
+    save_object(obj, obj_path)
+
+# assembles the modules in paths whose objects are out of date, over a process
+# pool when there are several, objects go next to the sources or in out_dir
+# returns the objects in the order of paths and the paths reassembled
+def build(paths, out_dir=None, workers=None):
+    obj_paths = [object_path(path, out_dir) for path in paths]
+    stale = [(path, obj_path) for path, obj_path in zip(paths, obj_paths) if not up_to_date(path, obj_path)]
+    if len(stale) > 1 and workers != 1:
+        with ProcessPoolExecutor(workers) as pool:
+            list(pool.map(build_object, *zip(*stale)))
+    else:
+        for path, obj_path in stale:
+            build_object(path, obj_path)
+    return [load_object(obj_path) for obj_path in obj_paths], [path for path, _ in stale]
+
+# places the modules one after another from origin and resolves their imports
+# returns the image and the exported symbols at their final addresses
+def link(objects, origin=0):
+    bases = []
+    end = origin
+    for obj in objects:
+        bases.append(end)
+        end += len(obj.code)
+    if end > 0x10000:
+        raise LinkError(f'{end - origin} bytes do not fit at {origin:04x}')
+    symbols = {}
+    owners = {}
+    for obj, base in zip(objects, bases):
+        for name, (val, relative) in obj.exports.items():
+            if name in symbols:
+                raise LinkError(f'Symbol "{name}" exported by {owners[name]} and {obj.name}')
+            symbols[name] = base + val if relative else val
+            owners[name] = obj.name
+    image = bytearray()
+    for obj, base in zip(objects, bases):
+        code = bytearray(obj.code)
+        for offset in obj.relocations:
+            word = (code[offset] | code[offset + 1] << 8) + base
+            # a label at the very end of a module ending at 10000
+            if word > 0xffff:
+                raise LinkError(f'Relocated address {word:04x} out of range in {obj.name}')
+            code[offset] = word & 0xff
+            code[offset + 1] = word >> 8
+        for name, offsets in obj.imports.items():
+            if name not in symbols:
+                raise LinkError(f'Undefined symbol "{name}" in {obj.name}')
+            val = symbols[name]
+            if val > 0xffff:
+                raise LinkError(f'Symbol "{name}" at {val:04x} out of range in {obj.name}')
+            for offset in offsets:
+                code[offset] = val & 0xff
+                code[offset + 1] = val >> 8
+        image += code
+    return bytes(image), symbols
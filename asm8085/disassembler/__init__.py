@@ -0,0 +1 @@
+from .disassembler import disassemble, disassemble_memory, instruction_at, listing
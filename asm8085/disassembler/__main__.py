@@ -0,0 +1,65 @@
+import random
+import unittest
+from ..assembler import Assembler
+from ..vm.util import Memory
+from .disassembler import TABLE, disassemble, disassemble_memory, instruction_at, listing
+
+UNDEFINED = {0x08, 0x10, 0x18, 0x28, 0x38, 0xcb, 0xd9, 0xdd, 0xed, 0xfd}
+
+class DisassemblerTest(unittest.TestCase):
+    def test_table(self):
+        self.assertEqual(len(TABLE), 256)
+        self.assertEqual(TABLE[0x7e], ('MOV A, M', 1))
+        self.assertEqual(TABLE[0x31], ('LXI SP, ', 3))
+        self.assertEqual(TABLE[0xcf], ('RST 1', 1))
+        self.assertEqual([opcode for opcode, (text, _) in enumerate(TABLE) if text.startswith('DB')],
+                         sorted(UNDEFINED))
+
+    def test_round_trip(self):
+        rng = random.Random(0)
+        for opcode in set(range(256)) - UNDEFINED:
+            code = bytes([opcode]) + rng.randbytes(TABLE[opcode][1] - 1)
+            (addr, length, text), = disassemble(code)
+            self.assertEqual((addr, length), (0, len(code)))
+            self.assertEqual(Assembler(text).assemble(), code, text)
+        # undefined opcodes and cut off instructions too
+        code = bytes(sorted(UNDEFINED)) + rng.randbytes(0x400) + b'\xcd\x00'
+        source = '\n'.join(text for _, _, text in disassemble(code))
+        self.assertEqual(Assembler(source).assemble(), code)
+
+    def test_program(self):
+        code = Assembler('ORG 100\nstart: MVI A, 05\nCALL start\nJNZ 1234\nHLT').assemble()
+        self.assertEqual(list(disassemble(code, 0x100)), [
+            (0x100, 2, 'MVI A, 05'), (0x102, 3, 'CALL 0100'), (0x105, 3, 'JNZ 1234'), (0x108, 1, 'HLT'),
+        ])
+        self.assertEqual(listing(code, 0x100), (
+            '0100  3E 05     MVI A, 05\n'
+            '0102  CD 00 01  CALL 0100\n'
+            '0105  C2 34 12  JNZ 1234\n'
+            '0108  76        HLT\n'
+        ))
+
+    def test_truncated(self):
+        self.assertEqual(list(disassemble(b'\x08\xc3\x01')), [(0, 1, 'DB 08'), (1, 1, 'DB C3'), (2, 1, 'DB 01')])
+        self.assertEqual(listing(b'\x3e'), '0000  3E        DB 3E\n')
+
+    def test_memory(self):
+        mem = Memory(0x10000)
+        mem.load(b'\x00\x21\x34\x12\x76', 0x1000)
+        # the last instruction starting in the range is complete
+        self.assertEqual(list(disassemble_memory(mem, 0x1000, 0x1002)), [
+            (0x1000, 1, 'NOP'), (0x1001, 3, 'LXI H, 1234'),
+        ])
+        self.assertEqual(instruction_at(mem, 0x1001), (3, 'LXI H, 1234'))
+        mem.load(b'\xcd\x00', 0xfffe)
+        mem[0] = 0x20
+        # operands wrap around the top of memory in both
+        self.assertEqual(instruction_at(mem, 0xfffe), (3, 'CALL 2000'))
+        self.assertEqual(list(disassemble_memory(mem, 0xfffe, 0x10000)), [(0xfffe, 3, 'CALL 2000')])
+        self.assertEqual(list(disassemble_memory(mem, 0xffff, 0x10000)), [(0xffff, 1, 'NOP')])
+        mem = Memory(0x100)
+        mem.load(b'\xcd\x00', 0xfe)
+        self.assertEqual(instruction_at(mem, 0xfe), (1, 'DB CD'))
+        self.assertEqual(list(disassemble_memory(mem, 0xfe, 0x100)), [(0xfe, 1, 'DB CD'), (0xff, 1, 'NOP')])
+
+unittest.main()
@@ -0,0 +1,21 @@
+import random
+import sys
+import time
+from .disassembler import disassemble, listing
+
+def bench_disassemble(size=1 << 20):
+    data = random.Random(0).randbytes(size)
+    cases = (
+        ('disassemble', lambda: list(disassemble(data))),
+        ('listing', lambda: listing(data)),
+    )
+    print(f'disassemble, {size >> 10} KiB of random bytes')
+    for name, run in cases:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(f'{name:12s} {elapsed * 1000:8.1f} ms {size / elapsed / 1e6:6.2f} MB/s')
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 20
+    bench_disassemble(size)
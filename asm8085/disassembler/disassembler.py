@@ -0,0 +1,112 @@
+import itertools
+from ..assembler.assembler import INSTRUCTIONS, FIELDS, D8, D16
+
+# Table-driven disassembler: TABLE maps every opcode to its text (up to the
+# immediate) and length, built once from the assembler's instruction table so
+# the output assembles back to the same bytes. Immediates are appended from a
+# table of two digit hex strings, so no formatting happens per instruction.
+# Opcodes the 8085 does not define, and instructions cut off by the end of
+# the data, come out as "DB xx", which assembles back to the byte.
+# In memory, operands past ffff wrap around to 0000 as they do on the VM.
+
+HEX = [f'{n:02X}' for n in range(256)]
+
+def build_table():
+    table = [(f'DB {HEX[opcode]}', 1) for opcode in range(256)]
+    for op, (base, operands) in INSTRUCTIONS.items():
+        names = [list(FIELDS[kind][0].items()) if kind in FIELDS else [('', 0)] for kind in operands]
+        for args in itertools.product(*names):
+            opcode = base
+            for kind, (_, code) in zip(operands, args):
+                if kind in FIELDS:
+                    opcode |= code << FIELDS[kind][1]
+            if op == 'MOV' and opcode == 0x76: # HLT
+                continue
+            fields = [name for kind, (name, _) in zip(operands, args) if kind in FIELDS]
+            text = ', '.join([op + ' ' + fields[0]] + fields[1:]) if fields else op
+            length = 1
+            # immediates are always the last operand
+            if operands and operands[-1] in (D8, D16):
+                text += ', ' if fields else ' '
+                length = 2 if operands[-1] == D8 else 3
+            table[opcode] = (text, length)
+    return table
+
+TABLE = build_table()
+
+# yields (address, length, text) for each instruction in data, addr is the
+# address of data[0]
+def disassemble(data, addr=0):
+    table = TABLE
+    hexs = HEX
+    size = len(data)
+    i = 0
+    while i < size:
+        opcode = data[i]
+        text, length = table[opcode]
+        if length == 1:
+            yield addr + i, 1, text
+        elif i + length > size:
+            yield addr + i, 1, 'DB ' + hexs[opcode]
+            length = 1
+        elif length == 2:
+            yield addr + i, 2, text + hexs[data[i + 1]]
+        else:
+            yield addr + i, 3, text + hexs[data[i + 2]] + hexs[data[i + 1]]
+        i += length
+
+# the (length, text) of the instruction at addr in mem (a Memory or any
+# indexable), operands wrap around at the top of a 64 KiB memory, an
+# instruction cut off by the end of a smaller one is "DB xx"
+def instruction_at(mem, addr):
+    opcode = mem[addr]
+    text, length = TABLE[opcode]
+    if addr + length > len(mem) != 0x10000:
+        return 1, 'DB ' + HEX[opcode]
+    if length == 2:
+        text += HEX[mem[(addr + 1) & 0xffff]]
+    elif length == 3:
+        text += HEX[mem[(addr + 2) & 0xffff]] + HEX[mem[(addr + 1) & 0xffff]]
+    return length, text
+
+# the instructions starting in start..end of mem, the last one may read up to
+# two bytes past end, wrapping around like instruction_at()
+def disassemble_memory(mem, start, end):
+    size = len(mem)
+    data = mem.dump(start, min(end + 2, size))
+    if size == 0x10000 and end + 2 > size:
+        data += mem.dump(0, end + 2 - size)
+    for addr, length, text in disassemble(data, start):
+        if addr >= end:
+            return
+        yield addr, length, text
+
+# per opcode the part of a listing line after the address that does not
+# depend on the operands
+LISTING = [f'  {HEX[opcode]}        {text if length == 1 else "DB " + HEX[opcode]}\n'
+           for opcode, (text, length) in enumerate(TABLE)]
+
+# one "address  bytes  text" line per instruction, the loop of disassemble()
+# is inlined as formatting dominates
+def listing(data, addr=0):
+    table = TABLE
+    fixed = LISTING
+    hexs = HEX
+    size = len(data)
+    lines = []
+    i = 0
+    while i < size:
+        opcode = data[i]
+        text, length = table[opcode]
+        if length == 1 or i + length > size:
+            lines.append(f'{addr + i:04X}{fixed[opcode]}')
+            length = 1
+        elif length == 2:
+            arg = hexs[data[i + 1]]
+            lines.append(f'{addr + i:04X}  {hexs[opcode]} {arg}     {text}{arg}\n')
+        else:
+            lo = hexs[data[i + 1]]
+            hi = hexs[data[i + 2]]
+            lines.append(f'{addr + i:04X}  {hexs[opcode]} {lo} {hi}  {text}{hi}{lo}\n')
+        i += length
+    return ''.join(lines)
@@ -1,3 +1,9 @@
 from .util import VMError, Flags, Memory
-from .registers import Registes
+from .registers import Registers
 from .vm import VM
+from .fast import FastVM
+from .predecode import CachedVM
+from .translate import TranslatingVM
+from .trace import Trace
+from .profile import Profile
+from .clock import Clock
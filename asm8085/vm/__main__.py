@@ -1,6 +1,24 @@
+import io
+import json
+import os
+import tempfile
+import time
 import unittest
-from util import VMError
-from vm import VM
+from .util import VMError, Flags, Memory, PAGE_SIZE, S_BIT, Z_BIT, P_BIT, CY_BIT
+from .registers import Registers
+from .vm import VM
+from .fast import FastVM
+from .predecode import CachedVM
+from .translate import TranslatingVM, HOT_THRESHOLD
+from .verify import verify, verify_batch, IMPLEMENTED
+from .runner import run_all, run_program, init_worker
+from .trace import Trace
+from .profile import Profile
+from .clock import Clock, TSTATES, CYCLES
+try:
+    from .batch import BatchVM
+except ImportError: # numpy is optional
+    BatchVM = None
 
 class ControlTest(unittest.TestCase):
     def test_nop(self):
@@ -469,8 +487,1089 @@ class LogicalTest(unittest.TestCase):
         self.assertEqual(vm.flags.CY, 1)
         self.assertEqual(vm.regs.PC, 1)
 
+class BranchTest(unittest.TestCase):
+    def test_jmp(self):
+        vm = VM()
+        vm.mem.load(b'\xc3\x34\x12') # JMP 1234
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 0x1234)
+
+    def test_jcc(self):
+        vm = VM()
+        vm.mem.load(b'\xca\x34\x12\xc2\x34\x12') # JZ 1234; JNZ 1234
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 3)
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 0x1234)
+
+    def test_conditions(self):
+        # NZ Z NC C PO PE P M
+        cases = (
+            (0x00, (True, False, True, False, True, False, True, False)),
+            (Z_BIT | CY_BIT, (False, True, False, True, True, False, True, False)),
+            (S_BIT | P_BIT, (True, False, True, False, False, True, False, True)),
+        )
+        for psw, taken in cases:
+            for cc, expected in enumerate(taken):
+                vm = VM()
+                vm.flags.psw = psw
+                vm.mem.load(bytes([0xc2 | (cc << 3), 0x00, 0x10]))
+                vm.execute_next()
+                self.assertEqual(vm.regs.PC, 0x1000 if expected else 3)
+
+    def test_call_ret(self):
+        vm = VM()
+        vm.regs.SP = 0x2000
+        vm.mem.load(b'\xcd\x00\x10') # CALL 1000
+        vm.mem[0x1000] = 0xc9 # RET
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 0x1000)
+        self.assertEqual(vm.regs.SP, 0x1ffe)
+        self.assertEqual(vm.mem.dump(0x1ffe, 0x2000), b'\x03\x00')
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 3)
+        self.assertEqual(vm.regs.SP, 0x2000)
+
+    def test_ccc_rcc(self):
+        vm = VM()
+        vm.regs.SP = 0x2000
+        vm.flags.CY = True
+        vm.mem.load(b'\xd4\x00\x10\xdc\x00\x10') # CNC 1000; CC 1000
+        vm.mem.load(b'\xd8\xd0', 0x1000) # RC; RNC
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 3)
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 0x1000)
+        vm.execute_next()
+        self.assertEqual((vm.regs.PC, vm.regs.SP), (6, 0x2000))
+        vm.regs.PC = 0x1001
+        vm.regs.SP = 0x1ffe
+        vm.execute_next()
+        self.assertEqual((vm.regs.PC, vm.regs.SP), (0x1002, 0x1ffe))
+
+    def test_pchl(self):
+        vm = VM()
+        vm.mem[0] = 0xe9 # PCHL
+        vm.regs.HL = 0x4321
+        vm.execute_next()
+        self.assertEqual(vm.regs.PC, 0x4321)
+
+class StackTest(unittest.TestCase):
+    def test_push_pop(self):
+        vm = VM()
+        vm.regs.SP = 0x2000
+        vm.regs.BC = 0x1234
+        vm.mem.load(b'\xc5\xd1') # PUSH B; POP D
+        vm.execute_next()
+        self.assertEqual(vm.mem.dump(0x1ffe, 0x2000), b'\x34\x12')
+        vm.execute_next()
+        self.assertEqual(vm.regs.DE, 0x1234)
+        self.assertEqual(vm.regs.SP, 0x2000)
+        self.assertEqual(vm.regs.PC, 2)
+
+    def test_push_pop_psw(self):
+        vm = VM()
+        vm.regs.SP = 0x2000
+        vm.regs.A = 0x55
+        vm.flags.psw = Z_BIT | CY_BIT
+        vm.mem.load(b'\xf5\xf1') # PUSH PSW; POP PSW
+        vm.execute_next()
+        self.assertEqual(vm.mem.dump(0x1ffe, 0x2000), b'\x41\x55')
+        vm.mem[0x1ffe] = 0xff
+        vm.execute_next()
+        self.assertEqual(vm.regs.A, 0x55)
+        self.assertEqual(vm.flags.as_byte(), 0xc5)
+
+    def test_sphl(self):
+        vm = VM()
+        vm.mem[0] = 0xf9 # SPHL
+        vm.regs.HL = 0x3000
+        vm.execute_next()
+        self.assertEqual(vm.regs.SP, 0x3000)
+        self.assertEqual(vm.regs.PC, 1)
+
+    def test_stack_underflow(self):
+        vm = VM()
+        vm.mem[0] = 0xe5 # PUSH H
+        vm.regs.SP = 1
+        vm.regs.HL = 0x1234
+        # SP wraps to FFFF, the high byte wraps to 0000
+        vm.execute_next()
+        self.assertEqual(vm.regs.SP, 0xffff)
+        self.assertEqual((vm.mem[0xffff], vm.mem[0]), (0x34, 0x12))
+        vm.regs.PC = 0x100
+        vm.mem[0x100] = 0xd1 # POP D
+        vm.execute_next()
+        self.assertEqual((vm.regs.DE, vm.regs.SP), (0x1234, 1))
+
+class RegistersTest(unittest.TestCase):
+    def test_encoded_access(self):
+        regs = Registers()
+        for enc, name in enumerate('BCDEHL'):
+            regs[enc] = 0x10 + enc
+            self.assertEqual(getattr(regs, name), 0x10 + enc)
+        regs[0b111] = 0x7f
+        self.assertEqual(regs.A, 0x7f)
+        self.assertEqual(regs[0b1000], 0x1011)
+        self.assertEqual(regs[0b1001], 0x1213)
+        self.assertEqual(regs[0b1010], 0x1415)
+        regs[0b1011] = 0xbeef
+        self.assertEqual(regs.SP, 0xbeef)
+
+    def test_pairs(self):
+        regs = Registers()
+        regs.HL = 0xabcd
+        self.assertEqual((regs.H, regs.L), (0xab, 0xcd))
+        regs[0b1001] = 0x0102
+        self.assertEqual((regs.D, regs.E, regs.DE), (0x01, 0x02, 0x0102))
+
+    def test_bad_encoding(self):
+        regs = Registers()
+        for enc in (0b0110, 0b1100, -1):
+            with self.assertRaises(IndexError):
+                regs[enc]
+            with self.assertRaises(IndexError):
+                regs[enc] = 0
+
+class FlagsTest(unittest.TestCase):
+    def test_update_zsp(self):
+        flags = Flags()
+        flags.CY = 1
+        for val in range(256):
+            flags.update_zsp(val)
+            self.assertEqual(flags.Z, 1 if val == 0 else 0)
+            self.assertEqual(flags.S, val >> 7)
+            self.assertEqual(flags.P, 1 if bin(val).count('1') % 2 == 0 else 0)
+            self.assertEqual(flags.CY, 1)
+        for val in (-1, 0x100):
+            with self.assertRaises(AssertionError):
+                flags.update_zsp(val)
+
+    def test_views(self):
+        flags = Flags()
+        flags.S = 1
+        flags.P = 1
+        self.assertEqual(flags.as_byte(), 0x84)
+        flags.psw = 0x41
+        self.assertEqual((flags.S, flags.Z, flags.P, flags.CY), (0, 1, 0, 1))
+        flags.Z = 0
+        self.assertEqual(flags.as_byte(), 0x01)
+
+class MemoryTest(unittest.TestCase):
+    def test_load_dump(self):
+        mem = Memory(0x100)
+        self.assertEqual(mem.load(b'\x01\x02\x03', 0x10), 0x13)
+        self.assertEqual(mem[0x11], 0x02)
+        self.assertEqual(mem.dump(0x0f, 0x14), b'\x00\x01\x02\x03\x00')
+        self.assertEqual(len(mem.dump()), 0x100)
+
+    def test_load_out_of_range(self):
+        mem = Memory(0x100)
+        with self.assertRaises(VMError):
+            mem.load(b'\x01\x02', 0xff)
+        with self.assertRaises(VMError):
+            mem.dump(0x80, 0x101)
+
+    def test_bad_address(self):
+        mem = Memory(0x100)
+        mem[0xff] = 0x01
+        for addr in (-1, -0x100, 0x100, 0x10000):
+            with self.assertRaises(VMError):
+                mem[addr]
+            with self.assertRaises(VMError):
+                mem[addr] = 0x02
+        self.assertEqual(mem[0xff], 0x01)
+        mem = Memory(0x10000)
+        with self.assertRaises(VMError):
+            mem[-1] = 0x02
+        self.assertEqual(mem[0xffff], 0)
+
+    def test_fill_copy(self):
+        mem = Memory(0x100)
+        mem.fill(0x20, 0x30, 0xaa)
+        self.assertEqual(mem.dump(0x1f, 0x31), b'\x00' + b'\xaa' * 0x10 + b'\x00')
+        mem.load(b'\x01\x02\x03\x04')
+        mem.copy(0, 2, 4)
+        self.assertEqual(mem.dump(0, 6), b'\x01\x02\x01\x02\x03\x04')
+
+    def test_slices(self):
+        mem = Memory(0x100)
+        mem[4:7] = b'\x07\x08\x09'
+        self.assertEqual(mem[4:7], b'\x07\x08\x09')
+        self.assertEqual(mem[5], 0x08)
+        self.assertEqual(mem.view[5], 0x08)
+        mem.view[5] = 0x0a
+        self.assertEqual(mem.view[4:7], b'\x07\x0a\x09')
+        image = bytes(4) + b'\x07\x0a\x09' + bytes(0xf9)
+        self.assertEqual(bytes(mem.view), image)
+        self.assertEqual(mem.view.tobytes(), image)
+        self.assertEqual(list(mem), list(image))
+        full = Memory(0x10000)
+        full[0xffff] = 0x01
+        self.assertEqual(bytes(full.view), bytes(0xffff) + b'\x01')
+        with self.assertRaises(ValueError):
+            mem[4:7] = b'\x01'
+        self.assertEqual(len(mem), 0x100)
+
+    def test_shared_pages(self):
+        mem = Memory(0x300)
+        mem.load(b'\x01' * 0x300)
+        fork = mem.fork()
+        self.assertTrue(all(a is b for a, b in zip(mem.pages, fork.pages)))
+        fork[0x105] = 0x02
+        self.assertEqual((mem[0x105], fork[0x105]), (0x01, 0x02))
+        self.assertEqual([a is b for a, b in zip(mem.pages, fork.pages)], [True, False, True])
+        # a word across the page boundary copies the next page too
+        fork.write_word(0x1ff, 0x0304)
+        self.assertEqual(fork.dump(0x1fe, 0x202), b'\x01\x04\x03\x01')
+        self.assertEqual(mem.dump(0x1fe, 0x202), b'\x01\x01\x01\x01')
+        self.assertEqual(fork.read_word(0x1ff), 0x0304)
+
+    def temp_file(self, data):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.write(data)
+        return f.name
+
+    def test_map_rom(self):
+        path = self.temp_file(bytes(range(256)) * 2 + b'\x10\x11')
+        mem = Memory(0x400)
+        mem[0x302] = 0x55
+        self.assertEqual(mem.map_file(path, 0x100), 0x302)
+        self.assertEqual((mem[0x100], mem[0x1ff], mem[0x300], mem[0x301]), (0x00, 0xff, 0x10, 0x11))
+        self.assertIsInstance(mem.pages[1], memoryview)
+        # the rest of a partial last page keeps its contents
+        self.assertEqual(mem[0x302], 0x55)
+        with self.assertRaises(VMError):
+            mem[0x180] = 0x01
+        with self.assertRaises(VMError):
+            mem[0x303] = 0x01
+        with self.assertRaises(VMError):
+            mem.map_file(path, 0x80)
+        fork = mem.fork()
+        self.assertIs(fork.pages[1], mem.pages[1])
+
+    def test_map_writable(self):
+        path = self.temp_file(b'\x00' * 0x200)
+        mem = Memory(0x400)
+        mem.map_file(path, 0x200, writable=True)
+        mem[0x201] = 0x42
+        mem.write_word(0x2ff, 0x1234)
+        snap = mem.snapshot()
+        mem[0x201] = 0x43
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual((data[1], data[0xff], data[0x100]), (0x43, 0x34, 0x12))
+        self.assertEqual(snap[2][1], 0x42)
+        # a fork gets plain RAM
+        fork = mem.fork()
+        fork[0x201] = 0x44
+        self.assertIsInstance(fork.pages[2], bytearray)
+        # restoring writes the saved bytes back and keeps the file mapped
+        mem.restore(snap)
+        self.assertIsInstance(mem.pages[2], memoryview)
+        mem[0x202] = 0x02
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual((data[1], data[2]), (0x42, 0x02))
+        self.assertEqual(mem.dump(0x201, 0x203), b'\x42\x02')
+
+    def test_dirty_pages(self):
+        mem = Memory(0x400)
+        mem.load(b'\x01\x02\x03', 0x10)
+        self.assertEqual(mem.dirty_pages(), [0])
+        base = mem.mark()
+        self.assertEqual((mem.dirty_pages(), mem.diff()), ([], []))
+        mem[0x11] = 0x07
+        mem[0x12] = 0x08
+        mem.write_word(0xff, 0x0a09)
+        mem[0x300] = 0x00 # written but unchanged
+        self.assertEqual(mem.dirty_pages(), [0, 1, 3])
+        self.assertEqual(mem.diff(), [(0x11, b'\x07\x08'), (0xff, b'\x09\x0a')])
+        mem.mark()
+        mem[0x200] = 0x01
+        self.assertEqual(mem.dirty_pages(), [2])
+        self.assertEqual(mem.diff(base), [(0x11, b'\x07\x08'), (0xff, b'\x09\x0a'), (0x200, b'\x01')])
+
+    def test_device(self):
+        mem = Memory(0x10000)
+        writes = []
+        mem.map_device(0xff00, 0x10000, lambda addr: addr & 0xff, lambda addr, val: writes.append((addr, val)))
+        mem[0xfe00] = 0x01
+        mem[0xff10] = 0x22
+        mem.write_word(0xfffe, 0x4433)
+        self.assertEqual(writes, [(0xff10, 0x22), (0xfffe, 0x33), (0xffff, 0x44)])
+        self.assertEqual((mem[0xff05], mem.read_word(0xfffe), mem[0xfe00]), (0x05, 0xfffe, 0x01))
+        self.assertEqual(mem.dump(0xfeff, 0xff02), b'\x00\x00\x01')
+        self.assertEqual(mem.fork().pages[0xff], mem.pages[0xff])
+        mem.unmap(0xff00, 0x10000)
+        mem[0xff10] = 0x22
+        self.assertEqual((mem[0xff10], len(writes)), (0x22, 3))
+        with self.assertRaises(VMError):
+            mem.map_device(0xff80, 0x10000, None, None)
+
+    def test_device_diff(self):
+        mem = Memory(0x10000)
+        reads = []
+        read = lambda addr: reads.append(addr) or 0x01
+        mem.map_device(0xff00, 0x10000, read, lambda addr, val: None)
+        mem.mark()
+        mem[0x10] = 0x02
+        # mapped before and after the mark, or only after it
+        mem.map_device(0xfe00, 0xff00, read, lambda addr, val: None)
+        self.assertEqual(mem.diff(), [(0x10, b'\x02')])
+        self.assertEqual(mem.dirty_pages(), [0, 0xfe])
+        self.assertEqual(reads, [])
+        self.assertEqual(list(mem.pages[0xff])[-1], 0x01)
+        self.assertEqual(reads[-1], 0xffff)
+
+    def test_banks(self):
+        mem = Memory(0x10000)
+        mem[0x8000] = 0x01
+        banks = mem.banks(0x8000, 0xc000, 3)
+        banks.select(1)
+        self.assertEqual(mem[0x8000], 0x00)
+        mem[0x8000] = 0x02
+        mem.map_view(b'\x03' * PAGE_SIZE, 0x8100) # ROM inside bank 1
+        banks.select(0)
+        self.assertEqual((mem[0x8000], mem[0x8100]), (0x01, 0x00))
+        banks.select(1)
+        self.assertEqual((mem[0x8000], mem[0x8100]), (0x02, 0x03))
+        with self.assertRaises(VMError):
+            mem[0x8100] = 0x00
+        with self.assertRaises(VMError):
+            banks.select(3)
+
+    def test_banked_code(self):
+        vm = CachedVM()
+        vm.mem.load(b'\x3c\x76', 0x4000) # INR A; HLT
+        banks = vm.mem.banks(0x4000, 0x5000, 2)
+        # STA FF00 selects the bank for the next run
+        vm.mem.map_device(0xff00, 0x10000, lambda addr: 0, lambda addr, val: banks.select(val))
+        vm.mem.load(b'\x3d\x76', 0x4000) # DCR A; HLT in bank 0
+        banks.select(1)
+        vm.mem.load(b'\x3c\x3c\x76', 0x4000) # INR A; INR A; HLT in bank 1
+        for bank, expected in ((0, 0xff), (1, 0x02), (0, 0xff)):
+            vm.regs.A = bank
+            vm.regs.PC = 0x100
+            vm.mem.load(b'\x32\x00\xff\x3e\x00\xc3\x00\x40', 0x100) # STA FF00; MVI A, 00; JMP 4000
+            vm.halted = False
+            vm.run()
+            self.assertEqual(vm.regs.A, expected)
+
+    def test_top_of_memory(self):
+        vm = VM()
+        vm.mem[0xffff] = 0x3c # INR A
+        vm.regs.PC = 0xffff
+        vm.mem[0] = 0x76
+        self.assertEqual(vm.run(), (2, VM.STOP_HALT))
+        self.assertEqual((vm.regs.A, vm.regs.PC), (1, 1))
+        # LXI H with its operand wrapping around, then HLT at 0001
+        vm = VM()
+        vm.mem.load(b'\x21\x34', 0xfffe)
+        vm.mem.load(b'\x12\x76')
+        vm.regs.PC = 0xfffe
+        self.assertEqual(vm.run(), (2, VM.STOP_HALT))
+        self.assertEqual((vm.regs.HL, vm.regs.PC), (0x1234, 2))
+        # a word written at ffff notifies watchers of its wrapped high byte
+        mem = Memory(0x10000)
+        writes = []
+        mem.watchers.append(lambda start, end: writes.append((start, end)))
+        mem.watch(0, 1)
+        mem.write_word(0xffff, 0x1234)
+        self.assertEqual((mem[0xffff], mem[0], mem.read_word(0xffff)), (0x34, 0x12, 0x1234))
+        self.assertEqual(writes, [(0, 1)])
+
+class SnapshotTest(unittest.TestCase):
+    def test_restore(self):
+        vm = VM()
+        vm.mem.load(b'\x3c\x32\x00\x10\x76') # INR A; STA 1000; HLT
+        snap = vm.snapshot()
+        vm.run()
+        self.assertEqual((vm.regs.A, vm.mem[0x1000]), (1, 1))
+        vm.restore(snap)
+        self.assertEqual((vm.regs.A, vm.mem[0x1000], vm.regs.PC, vm.halted), (0, 0, 0, False))
+        self.assertEqual(vm.run(), (3, VM.STOP_HALT))
+
+    def test_fork(self):
+        for cls in (VM, FastVM, CachedVM, TranslatingVM):
+            vm = cls()
+            vm.mem.load(b'\x3c\x32\x00\x10\x76') # INR A; STA 1000; HLT
+            vm.run(max_steps=1)
+            fork = vm.fork()
+            self.assertIs(type(fork), cls)
+            fork.regs.A = 0x41
+            fork.run()
+            vm.run()
+            self.assertEqual((vm.regs.A, vm.mem[0x1000]), (1, 1))
+            self.assertEqual((fork.regs.A, fork.mem[0x1000]), (0x41, 0x41))
+        # a fork does not write through to the parent's mapped buffer
+        buffer = bytearray(0x100)
+        vm = VM()
+        vm.mem.load(b'\x3c\x32\x00\x10\x76')
+        vm.mem.map_view(buffer, 0x1000)
+        fork = vm.fork()
+        fork.run()
+        self.assertEqual((fork.mem[0x1000], buffer[0]), (1, 0))
+
+    def test_restore_invalidates(self):
+        vm = CachedVM()
+        vm.mem.load(b'\x3c\x76') # INR A; HLT
+        snap = vm.snapshot()
+        vm.mem[0] = 0x3d # DCR A
+        vm.run()
+        self.assertEqual(vm.regs.A, 0xff)
+        vm.restore(snap)
+        vm.run()
+        self.assertEqual(vm.regs.A, 0x01)
+
+class FastCoreTest(unittest.TestCase):
+    def test_differential(self):
+        for seed in range(5):
+            self.assertGreater(verify(seed, programs=20, steps=200), 0)
+
+    def test_run(self):
+        vm = FastVM()
+        vm.mem.load(b'\x3e\xff\x3c\x06\x05\x80\x76') # MVI A, FF; INR A; MVI B, 05; ADD B; HLT
+        self.assertEqual(vm.run(), (5, VM.STOP_HALT))
+        self.assertEqual(vm.regs.A, 0x05)
+        self.assertEqual(vm.flags.as_byte(), 0x04)
+
+    # every instruction placed so its operands or stack words cross the top
+    # of memory and wrap around, the verifier's random programs rarely get
+    # there
+    def test_top_of_memory(self):
+        for cls in (FastVM, CachedVM, TranslatingVM):
+            for opcode in IMPLEMENTED:
+                for pc, sp in ((0xfffe, 0xfffe), (0xffff, 0xffff), (0xfffd, 0)):
+                    vms = []
+                    for core in (VM, cls):
+                        vm = core()
+                        vm.mem.load(b'\x12\x34\x56', 0)
+                        vm.mem.load(bytes([opcode, 0x77, 0xff])[:0x10000 - pc], pc)
+                        vm.regs.r[:] = [0x66, 0x55, 0x44, 0x33, 0xff, 0xff, 0, 0x11]
+                        vm.regs.pc = pc
+                        vm.regs.sp = sp
+                        try:
+                            vm.run(max_steps=1)
+                            err = None
+                        except VMError as e:
+                            err = str(e)
+                        vms.append((err, tuple(vm.regs.r), vm.regs.pc, vm.regs.sp, vm.flags.psw,
+                                    vm.mem.dump(0, 3), vm.mem.dump(0xfffd, 0x10000)))
+                    self.assertEqual(vms[0], vms[1], f'{cls.__name__} {opcode:02x} at {pc:04x}')
+
+class PredecodeTest(unittest.TestCase):
+    def test_differential(self):
+        for seed in range(5):
+            self.assertGreater(verify(seed, programs=20, steps=200, core=CachedVM), 0)
+
+    def test_cache_hit(self):
+        vm = CachedVM()
+        vm.mem.load(b'\x3c\x76') # INR A; HLT
+        vm.run()
+        vm.halted = False
+        vm.regs.PC = 0
+        vm.run()
+        self.assertEqual(vm.regs.A, 2)
+        self.assertEqual(vm.decoded, 2)
+
+    def test_self_modifying(self):
+        vm = CachedVM()
+        # MVI A, 07; INR A; STA 0001; HLT
+        vm.mem.load(b'\x3e\x07\x3c\x32\x01\x00\x76')
+        vm.run()
+        self.assertEqual(vm.regs.A, 0x08)
+        self.assertEqual(vm.invalidated, 1)
+        vm.halted = False
+        vm.regs.PC = 0
+        vm.run()
+        self.assertEqual(vm.regs.A, 0x09)
+        self.assertEqual(vm.mem[1], 0x09)
+
+    def test_load_invalidates(self):
+        vm = CachedVM()
+        vm.mem.load(b'\x06\x11\x76') # MVI B, 11; HLT
+        vm.run()
+        vm.mem.load(b'\x22', 1)
+        vm.halted = False
+        vm.regs.PC = 0
+        vm.run()
+        self.assertEqual(vm.regs.B, 0x22)
+
+class TranslateTest(unittest.TestCase):
+    def test_differential(self):
+        for seed in range(3):
+            self.assertGreater(verify(seed, programs=5, steps=200, core=TranslatingVM, max_chunk=64), 0)
+
+    def run_again(self, vm):
+        vm.halted = False
+        vm.regs.PC = 0
+        return vm.run()
+
+    def test_block_cache(self):
+        vm = TranslatingVM()
+        vm.mem.load(b'\x3c\x80\x47\x76') # INR A; ADD B; MOV B, A; HLT
+        vm.hot_threshold = 0
+        self.assertEqual(vm.run(), (4, VM.STOP_HALT))
+        self.assertEqual(self.run_again(vm), (4, VM.STOP_HALT))
+        self.assertEqual((vm.regs.A, vm.regs.B), (0x03, 0x03))
+        self.assertEqual(vm.stats(), {'blocks_compiled': 1, 'block_hits': 1, 'block_invalidations': 0})
+
+    def test_hot_threshold(self):
+        vm = TranslatingVM()
+        vm.hot_threshold = 2
+        vm.mem.load(b'\x3c\x76') # INR A; HLT
+        for _ in range(3):
+            self.run_again(vm)
+        self.assertEqual(vm.regs.A, 3)
+        self.assertEqual(vm.blocks_compiled, 1)
+        # thresholds past a byte
+        vm = TranslatingVM()
+        vm.hot_threshold = 300
+        vm.mem.load(b'\x3c\x76')
+        for _ in range(300):
+            self.run_again(vm)
+        self.assertEqual(vm.blocks_compiled, 0)
+        self.run_again(vm)
+        self.assertEqual(vm.blocks_compiled, 1)
+
+    def test_self_modifying(self):
+        vm = TranslatingVM()
+        vm.hot_threshold = 0
+        # MVI A, 07; INR A; STA 0001; INR A; HLT
+        vm.mem.load(b'\x3e\x07\x3c\x32\x01\x00\x3c\x76')
+        self.assertEqual(vm.run(), (5, VM.STOP_HALT))
+        self.assertEqual(vm.regs.A, 0x09)
+        self.assertEqual(vm.block_invalidations, 1)
+        self.run_again(vm)
+        self.assertEqual(vm.regs.A, 0x0a)
+        self.assertEqual(vm.mem[1], 0x09)
+
+    def test_self_modifying_loop(self):
+        # MVI C, 10; outer: MVI B, 00; inner: MVI A, 00; INR A; STA 0005
+        # (the MVI operand); DCR B; JNZ inner; DCR C; JNZ outer; HLT
+        program = b'\x0e\x10\x06\x00\x3e\x00\x3c\x32\x05\x00\x05\xc2\x04\x00\x0d\xc2\x02\x00\x76'
+        expected = FastVM()
+        expected.mem.load(program)
+        steps = expected.run()
+        for hot in (0, HOT_THRESHOLD):
+            vm = TranslatingVM()
+            vm.hot_threshold = hot
+            vm.mem.load(program)
+            self.assertEqual(vm.run(), steps)
+            self.assertEqual(vm.snapshot(), expected.snapshot())
+            # each recompile of a rewritten block waits twice as long, so
+            # 4096 passes compile the blocks around it a few times each
+            # rather than once a pass
+            self.assertLess(vm.blocks_compiled, 30, hot)
+
+    def test_fault_in_block(self):
+        vm = TranslatingVM()
+        vm.hot_threshold = 0
+        # INR A; SHLD 3000; HLT with ROM at 3000
+        vm.mem.load(b'\x3c\x22\x00\x30\x76')
+        vm.mem.map_view(bytes(0x100), 0x3000)
+        with self.assertRaises(VMError):
+            vm.run()
+        self.assertEqual(vm.regs.A, 1)
+        self.assertEqual(vm.regs.PC, 1)
+
+    def test_budget_and_target(self):
+        vm = TranslatingVM()
+        vm.hot_threshold = 0
+        vm.mem.load(b'\x3c' * 8 + b'\x76')
+        self.assertEqual(vm.run(max_steps=3), (3, VM.STOP_STEPS))
+        self.assertEqual(vm.run(until_pc=6), (3, VM.STOP_PC))
+        self.assertEqual(vm.regs.A, 6)
+
+@unittest.skipIf(BatchVM is None, 'numpy is not installed')
+class BatchTest(unittest.TestCase):
+    def test_differential(self):
+        for seed in range(3):
+            self.assertGreater(verify_batch(seed, instances=32, steps=150), 0)
+
+    def test_lockstep(self):
+        batch = BatchVM(4)
+        batch.load(ComplexTest.PROGRAM)
+        for index in range(4):
+            batch.load(bytes([index * 0x40]) * 256, 0x1000, index)
+        batch.run()
+        self.assertTrue(batch.halted.all())
+        for index in range(4):
+            vm = batch.instance(index)
+            self.assertEqual(vm.regs.DE, index * 0x40 * 256)
+            self.assertEqual(batch.steps[index], 4 + 256 * 11 + vm.regs.D + 1)
+        # the carry branch in the subroutine splits the instances
+        self.assertGreater(batch.groups, batch.steps.max())
+
+    def test_top_of_memory(self):
+        batch = BatchVM(1)
+        batch.load(b'\x2a\xff\xff\x76') # LHLD FFFF; HLT
+        batch.load(b'\x11', 0xffff)
+        batch.run()
+        self.assertEqual(batch.errors, [None])
+        self.assertEqual(batch.instance(0).regs.HL, 0x2a11)
+
+    def test_fault(self):
+        batch = BatchVM(2)
+        batch.load(b'\x2a\x00\x10\x3c\x76') # LHLD 1000; INR A; HLT
+        batch.load(b'\x08', 0, 1) # undefined opcode
+        self.assertEqual(batch.run(), 3)
+        self.assertEqual(batch.errors, [None, 'Unknown instruction 08'])
+        self.assertEqual(batch.halted.tolist(), [True, False])
+        self.assertEqual((batch.pc[1], batch.steps[1]), (0, 0))
+        self.assertEqual(batch.instance(0).regs.A, 0x01)
+
+class RunnerTest(unittest.TestCase):
+    PROGRAMS = {
+        'add.asm': 'MVI A, 05\nADI 03\nSTA 1000\nHLT\n',
+        'rom.asm': 'LDA 2000\nADI 01\nHLT',
+        'syntax.asm': 'MVI Q, 01\n',
+        'top.asm': 'LDA FFFF\nHLT\n',
+        'loop.asm': 'NOP\n',
+        'mapped.asm': 'LDA 3000\nADI 01\nHLT',
+        'romwrite.asm': 'STA 3000\nHLT',
+        'labels.asm': 'ORG 0200\nloop: INR A\nCPI 03\nJNZ loop\nHLT\n',
+    }
+
+    def test_run_all(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, source in self.PROGRAMS.items():
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(source)
+            rom = os.path.join(tmp, 'rom.bin')
+            with open(rom, 'wb') as f:
+                f.write(b'\x20' * 0x100)
+            out = io.StringIO()
+            failed = run_all([tmp], out, images=[(0x2000, b'\x41')], max_steps=50,
+                             dumps=[(0x1000, 0x1002)], workers=2, roms=[(0x3000, rom)], diff=True)
+        self.assertEqual(failed, 2)
+        results = {os.path.basename(r['program']): r for r in map(json.loads, out.getvalue().splitlines())}
+        self.assertEqual(sorted(results), sorted(self.PROGRAMS))
+        add = results['add.asm']
+        self.assertEqual((add['stop'], add['steps']), (VM.STOP_HALT, 4))
+        self.assertEqual(add['registers']['A'], 0x08)
+        self.assertEqual(add['memory'], {'1000-1002': '0800'})
+        self.assertEqual(add['diff'], {'1000': '08'})
+        self.assertFalse(add['flags']['Z'])
+        self.assertEqual(results['rom.asm']['registers']['A'], 0x42)
+        self.assertEqual(results['mapped.asm']['registers']['A'], 0x21)
+        self.assertEqual(results['romwrite.asm']['error'], 'VMError: Write to read-only memory at 3000')
+        self.assertEqual(results['romwrite.asm']['steps'], 0)
+        self.assertEqual(results['syntax.asm']['stage'], 'assemble')
+        self.assertEqual(results['top.asm']['stop'], VM.STOP_HALT)
+        labels = results['labels.asm']
+        self.assertEqual((labels['registers']['A'], labels['registers']['PC'], labels['steps']), (3, 0x207, 10))
+        self.assertEqual((results['loop.asm']['stop'], results['loop.asm']['steps']), (VM.STOP_STEPS, 50))
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'fault.asm')
+            with open(path, 'w') as f:
+                f.write('MVI A, 01\nINR A\nSHLD 3000\nHLT\n')
+            rom = os.path.join(tmp, 'rom.bin')
+            with open(rom, 'wb') as f:
+                f.write(bytes(0x100))
+            init_worker((), ((0x3000, rom),))
+            try:
+                result = run_program(path, trace=2)
+            finally:
+                init_worker((), ())
+        self.assertEqual(result['error'], 'VMError: Write to read-only memory at 3000')
+        self.assertEqual([line[:15] for line in result['trace']], ['0002  INR A    ', '0003  SHLD 3000'])
+        # the instructions run before the fault are still reported
+        self.assertEqual(result['steps'], 2)
+
+    def test_clock(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'loop.asm')
+            with open(path, 'w') as f:
+                f.write('MVI B, 02\nloop: DCR B\nJNZ loop\nHLT\n')
+            self.assertEqual(run_program(path, clock=0)['cycles'], 7 + 2 * 4 + 10 + 7 + 5)
+            self.assertNotIn('cycles', run_program(path))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ('add.asm', 'labels.asm', 'syntax.asm'):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(self.PROGRAMS[name])
+            cache = os.path.join(tmp, 'cache')
+            runs = []
+            for _ in range(2):
+                out = io.StringIO()
+                run_all([tmp], out, workers=2, cache=cache)
+                runs.append(sorted(out.getvalue().splitlines()))
+            # the syntax error is not cached
+            self.assertEqual(len(os.listdir(cache)), 2)
+        self.assertEqual(runs[0], runs[1])
+
 class ComplexTest(unittest.TestCase):
-    pass
+    # sums the bytes at 1000..10ff into DE through a subroutine
+    PROGRAM = bytes([
+        0x31, 0x00, 0x20, # LXI SP, 2000
+        0x21, 0x00, 0x10, # LXI H, 1000
+        0x11, 0x00, 0x00, # LXI D, 0000
+        0x0e, 0x00,       # MVI C, 00
+        0xcd, 0x14, 0x00, # loop: CALL add
+        0x23,             # INX H
+        0x0d,             # DCR C
+        0xc2, 0x0b, 0x00, # JNZ loop
+        0x76,             # HLT
+        0xf5,             # add: PUSH PSW
+        0x7b,             # MOV A, E
+        0x86,             # ADD M
+        0x5f,             # MOV E, A
+        0xd2, 0x1c, 0x00, # JNC done
+        0x14,             # INR D
+        0xf1,             # done: POP PSW
+        0xc9,             # RET
+    ])
+
+    def test_subroutine_loop(self):
+        data = bytes(range(256))
+        for cls in (VM, FastVM, CachedVM, TranslatingVM):
+            vm = cls()
+            vm.mem.load(self.PROGRAM)
+            vm.mem.load(data, 0x1000)
+            steps, reason = vm.run()
+            self.assertEqual(reason, VM.STOP_HALT)
+            self.assertEqual(steps, 4 + 256 * 11 + sum(data) // 256 + 1)
+            self.assertEqual(vm.regs.DE, sum(data))
+            self.assertEqual(vm.regs.SP, 0x2000)
+
+class RunTest(unittest.TestCase):
+    def test_run_to_halt(self):
+        vm = VM()
+        vm.mem[0] = 0x3c # INR A
+        vm.mem[1] = 0x3c # INR A
+        vm.mem[2] = 0x76 # HLT
+        self.assertEqual(vm.run(), (3, VM.STOP_HALT))
+        self.assertEqual(vm.regs.A, 2)
+        self.assertTrue(vm.halted)
+        self.assertEqual(vm.regs.PC, 3)
+
+    def test_run_max_steps(self):
+        vm = VM()
+        self.assertEqual(vm.run(max_steps=10), (10, VM.STOP_STEPS))
+        self.assertEqual(vm.regs.PC, 10)
+        self.assertFalse(vm.halted)
+
+    def test_run_until_pc(self):
+        vm = VM()
+        vm.mem[5] = 0x76
+        self.assertEqual(vm.run(until_pc=3), (3, VM.STOP_PC))
+        self.assertEqual(vm.regs.PC, 3)
+        self.assertEqual(vm.run(until_pc=3), (0, VM.STOP_PC))
+        self.assertEqual(vm.run(max_steps=100, until_pc=100), (3, VM.STOP_HALT))
+
+    def test_run_halted(self):
+        vm = VM()
+        vm.mem[0] = 0x76
+        vm.run()
+        with self.assertRaises(VMError):
+            vm.run()
+
+# Trace, Profile and Clock all hook run_loop, the subclasses give the mode to
+# set and what it collected, which has to come out the same on every core and
+# in single steps
+class RunModeTest:
+    # LXI H, 0100; MVI B, 03; loop: MOV A, M; INR A; MOV M, A; DCR B; JNZ loop; HLT
+    PROGRAM = b'\x21\x00\x01\x06\x03\x7e\x3c\x77\x05\xc2\x05\x00\x76'
+    STEPS = 18
+
+    def make(self, cls, program=None, mode=None):
+        vm = cls()
+        vm.mem.load(self.PROGRAM if program is None else program)
+        setattr(vm, self.ATTR, self.mode() if mode is None else mode)
+        return vm
+
+    def test_cores(self):
+        expected = self.make(VM)
+        self.assertEqual(expected.run(), (self.STEPS, VM.STOP_HALT))
+        for cls in (FastVM, CachedVM, TranslatingVM):
+            vm = self.make(cls)
+            self.assertEqual(vm.run(), (self.STEPS, VM.STOP_HALT))
+            self.assertEqual(self.result(vm), self.result(expected), cls.__name__)
+        # single steps and split runs
+        for cls in (VM, FastVM, CachedVM, TranslatingVM):
+            vm = self.make(cls)
+            for _ in range(3):
+                vm.execute_next()
+            vm.run(max_steps=5)
+            vm.run()
+            self.assertEqual(self.result(vm), self.result(expected), cls.__name__)
+
+    def test_error(self):
+        for cls in (VM, FastVM, CachedVM, TranslatingVM):
+            vm = self.make(cls, b'\x3c\x22\x00\x30\x76') # INR A; SHLD 3000; HLT
+            vm.mem.map_view(bytes(0x100), 0x3000)
+            mem = vm.mem
+            with self.assertRaises(VMError) as cm:
+                vm.run()
+            self.assertEqual(cm.exception.steps, 1)
+            self.assertIs(vm.mem, mem)
+            self.check_error(vm)
+
+class TraceTest(RunModeTest, unittest.TestCase):
+    ATTR = 'trace'
+    # MVI A, 03; loop: DCR A; JNZ loop; HLT
+    LOOP = b'\x3e\x03\x3d\xc2\x02\x00\x76'
+
+    def mode(self):
+        return Trace(64)
+
+    def result(self, vm):
+        return vm.trace.dump()
+
+    def check_error(self, vm):
+        # the instruction that raised is the last record
+        self.assertEqual(vm.trace.decode()[-1][:15], '0001  SHLD 3000')
+        self.assertEqual(vm.trace.count, 2)
+
+    def test_records(self):
+        vm = self.make(VM, self.LOOP)
+        self.assertEqual(vm.run(), (8, VM.STOP_HALT))
+        records = list(vm.trace.records())
+        self.assertEqual([record[0] for record in records], [0, 2, 3, 2, 3, 2, 3, 6])
+        # state before each instruction: pc, opcode, operands, B C D E H L A, SP, flags
+        self.assertEqual(records[0], (0, 0x3e, 0x03, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+        self.assertEqual(records[2], (3, 0xc2, 0x02, 0x00, 0, 0, 0, 0, 0, 0, 2, 0, 0))
+        self.assertEqual(records[-1][10:], (0, 0, Z_BIT | P_BIT))
+        self.assertEqual(vm.trace.decode()[0], '0000  MVI A, 03      A=00 B=00 C=00 D=00 E=00 H=00 L=00 SP=0000 ----')
+        self.assertEqual(vm.trace.decode()[-1][:20], '0006  HLT           ')
+        self.assertTrue(vm.trace.decode()[-1].endswith(' -ZP-'))
+
+    def test_ring(self):
+        vm = self.make(FastVM, self.LOOP, Trace(3))
+        # exactly full, nothing overwritten yet
+        vm.run(max_steps=3)
+        self.assertEqual([record[0] for record in vm.trace.records()], [0, 2, 3])
+        # wrapped within a run and across runs, oldest first
+        vm.run(max_steps=2)
+        self.assertEqual(vm.trace.count, 5)
+        self.assertEqual([record[0] for record in vm.trace.records()], [3, 2, 3])
+        vm.run()
+        self.assertEqual([record[0] for record in vm.trace.records()], [2, 3, 6])
+        self.assertEqual(len(vm.trace.dump()), len(Trace(3).buffer))
+        vm.trace.clear()
+        self.assertEqual(vm.trace.dump(), b'')
+
+    def test_operands_wrap(self):
+        # LXI H, 1234 at fffe, its operand bytes are at ffff and 0000
+        vm = FastVM()
+        vm.mem[0xfffe] = 0x21
+        vm.mem[0xffff] = 0x34
+        vm.mem[0] = 0x12
+        vm.regs.pc = 0xfffe
+        vm.trace = Trace()
+        vm.run(max_steps=1)
+        self.assertEqual(vm.trace.decode(), [
+            'FFFE  LXI H, 1234    A=00 B=00 C=00 D=00 E=00 H=00 L=00 SP=0000 ----'])
+
+    def test_disabled(self):
+        vm = VM()
+        self.assertIsNone(vm.trace)
+        self.assertIsNone(vm.fork().trace)
+
+class ProfileTest(RunModeTest, unittest.TestCase):
+    ATTR = 'profile'
+
+    def mode(self):
+        return Profile()
+
+    def result(self, vm):
+        profile = vm.profile
+        return profile.pcs, profile.opcodes, profile.reads, profile.writes, profile.steps
+
+    def check_error(self, vm):
+        # the instruction that raised is counted as executed, not as a step
+        self.assertEqual(vm.profile.pcs[:2], [1, 1])
+        self.assertEqual(vm.profile.steps, 1)
+
+    def test_counts(self):
+        vm = self.make(VM)
+        self.assertEqual(vm.run(), (18, VM.STOP_HALT))
+        profile = vm.profile
+        self.assertEqual(profile.steps, 18)
+        self.assertEqual(profile.pcs[:13], [1, 0, 0, 1, 0, 3, 3, 3, 3, 3, 0, 0, 1])
+        self.assertEqual(profile.opcodes[0x7e], 3)
+        self.assertEqual(profile.opcodes[0x76], 1)
+        self.assertEqual(sum(profile.opcodes), 18)
+        self.assertEqual(profile.top_addresses(2), [(3, 5), (3, 6)])
+        self.assertEqual(profile.top_opcodes(1), [(3, 0x05)])
+        self.assertEqual(vm.mem[0x100], 3)
+
+    def test_memory(self):
+        vm = self.make(FastVM)
+        vm.run()
+        # operand bytes of the instructions themselves are not counted
+        self.assertEqual(sum(vm.profile.reads), 3)
+        self.assertEqual(vm.profile.reads[0x100], 3)
+        self.assertEqual(sum(vm.profile.writes), 3)
+        self.assertEqual(vm.profile.writes[0x100], 3)
+        self.assertIsInstance(vm.mem, Memory)
+        # LXI SP, 0200; PUSH B; POP D; HLT, a word is counted as its two
+        # bytes and nothing around them
+        vm = self.make(FastVM, b'\x31\x00\x02\xc5\xd1\x76')
+        vm.run()
+        self.assertEqual(vm.profile.writes[0x1fd:0x201], [0, 1, 1, 0])
+        self.assertEqual(vm.profile.reads[0x1fd:0x201], [0, 1, 1, 0])
+
+    def test_top_of_memory(self):
+        for cls in (VM, FastVM):
+            # LXI SP, 0001; PUSH B; POP D; LXI SP, 0000; POP H; HLT at 1000,
+            # the words are at ffff-0000 and 0000-0001
+            vm = self.make(cls, bytes(0x1000) + b'\x31\x01\x00\xc5\xd1\x31\x00\x00\xe1\x76')
+            vm.regs.PC = 0x1000
+            self.assertEqual(vm.run(), (6, VM.STOP_HALT))
+            profile = vm.profile
+            self.assertEqual((profile.writes[0xffff], profile.writes[0]), (1, 1), cls.__name__)
+            self.assertEqual((profile.reads[0xffff], profile.reads[0], profile.reads[1]), (1, 2, 1))
+            # RET with SP at ffff
+            vm = self.make(cls, b'\x76' + bytes(0xfff) + b'\x31\xff\xff\xc9')
+            vm.regs.PC = 0x1000
+            vm.run(max_steps=2)
+            self.assertEqual((vm.regs.PC, vm.profile.reads[0xffff], vm.profile.reads[0]), (0x7600, 1, 1))
+        # operands wrapping around ffff are not counted as reads
+        vm = FastVM()
+        vm.mem[0xffff] = 0x3e # MVI A, 76
+        vm.mem[0] = 0x76
+        vm.regs.PC = 0xffff
+        vm.profile = Profile()
+        vm.run(max_steps=1)
+        self.assertEqual((vm.regs.A, sum(vm.profile.reads)), (0x76, 0))
+
+    def test_blocks(self):
+        vm = self.make(FastVM)
+        vm.run()
+        # (instructions executed, start, end, times run)
+        self.assertEqual(vm.profile.top_blocks(vm.mem), [(15, 5, 12, 3), (2, 0, 5, 1), (1, 12, 13, 1)])
+        report = vm.profile.report(vm.mem, 3).splitlines()
+        self.assertEqual(report[0], '18 instructions')
+        self.assertIn('0005', report[2])
+        self.assertTrue(report[2].endswith('MOV A, M'))
+        self.assertIn('hottest blocks', report)
+        self.assertIn('0005-000B', '\n'.join(report))
+
+    def test_traced(self):
+        vm = self.make(VM)
+        vm.trace = Trace()
+        with self.assertRaises(VMError):
+            vm.run()
+
+    def test_clear(self):
+        vm = self.make(FastVM)
+        vm.run(max_steps=5)
+        self.assertEqual(vm.profile.steps, 5)
+        vm.run()
+        self.assertEqual(vm.profile.steps, 18)
+        vm.profile.clear()
+        self.assertEqual(vm.profile.steps, 0)
+        self.assertEqual(vm.profile.top_addresses(), [])
+        self.assertIsNone(VM().profile)
+
+class ClockTest(RunModeTest, unittest.TestCase):
+    ATTR = 'clock'
+    # LXI 10, MVI 7, 3 x (MOV 7, INR 4, MOV 7, DCR 4), JNZ 10 10 7, HLT 5
+    CYCLES = 10 + 7 + 3 * 22 + 27 + 5
+    # MVI B, 00; loop: DCR B; JNZ loop; HLT, 7 + 256 x 14 - 3 + 5 T-states
+    DELAY = b'\x06\x00\x05\xc2\x02\x00\x76'
+
+    def mode(self):
+        return Clock()
+
+    def result(self, vm):
+        return vm.cycles
+
+    def check_error(self, vm):
+        # INR A, the instruction that raised is not counted
+        self.assertEqual(vm.cycles, 4)
+
+    def test_tstates(self):
+        self.assertEqual(TSTATES[0x78], (4, 4)) # MOV A, B
+        self.assertEqual(TSTATES[0x7e], (7, 7)) # MOV A, M
+        self.assertEqual(TSTATES[0x70], (7, 7)) # MOV M, B
+        self.assertEqual(TSTATES[0x06], (7, 7)) # MVI B
+        self.assertEqual(TSTATES[0x36], (10, 10)) # MVI M
+        self.assertEqual(TSTATES[0x80], (4, 4)) # ADD B
+        self.assertEqual(TSTATES[0x86], (7, 7)) # ADD M
+        self.assertEqual(TSTATES[0x34], (10, 10)) # INR M
+        self.assertEqual(TSTATES[0xcd], (18, 18)) # CALL
+        self.assertEqual(TSTATES[0xc2], (7, 10)) # JNZ
+        self.assertEqual(TSTATES[0xdc], (9, 18)) # CC
+        self.assertEqual(TSTATES[0xf8], (6, 12)) # RM
+        self.assertEqual(TSTATES[0x76], (5, 5)) # HLT
+        # taken depends on the PSW
+        self.assertEqual(CYCLES[0xc2], 10)
+        self.assertEqual(CYCLES[Z_BIT << 8 | 0xc2], 7)
+        self.assertEqual(CYCLES[CY_BIT << 8 | 0xdc], 18)
+
+    def test_cycles(self):
+        vm = self.make(VM)
+        vm.run()
+        self.assertEqual(vm.cycles, self.CYCLES)
+        vm = self.make(FastVM)
+        vm.run(max_steps=3)
+        self.assertEqual(vm.cycles, 10 + 7 + 7)
+        # unclocked runs do not count
+        vm = VM()
+        vm.mem.load(self.PROGRAM)
+        vm.run()
+        self.assertEqual(vm.cycles, 0)
+
+    def test_snapshot(self):
+        vm = self.make(FastVM)
+        vm.run(max_steps=3)
+        snap = vm.snapshot()
+        fork = vm.fork()
+        self.assertEqual(fork.cycles, 10 + 7 + 7)
+        vm.run()
+        vm.restore(snap)
+        self.assertEqual(vm.cycles, 10 + 7 + 7)
+        # the fork is not clocked but continues from the same count
+        fork.clock = Clock()
+        fork.run()
+        self.assertEqual(fork.cycles, self.CYCLES)
+
+    def test_exclusive(self):
+        with self.assertRaises(VMError):
+            Clock(0)
+        vm = self.make(FastVM)
+        vm.profile = Profile()
+        with self.assertRaises(VMError):
+            vm.run()
+
+    def test_throttle(self):
+        vm = self.make(FastVM, self.DELAY, Clock(200000, quantum=0.001))
+        start = time.perf_counter()
+        vm.run()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(vm.cycles, 3593)
+        # the last partial quantum is slept off before run() returns
+        self.assertGreaterEqual(elapsed, 3593 / 200000)
+
+    def test_throttle_slices(self):
+        clock = Clock(200000, quantum=0.001)
+        vm = self.make(FastVM, self.DELAY, clock)
+        start = time.perf_counter()
+        while vm.run(max_steps=10)[1] != VM.STOP_HALT:
+            pass
+        elapsed = time.perf_counter() - start
+        # paced as one run, not from the start of every slice
+        self.assertEqual(vm.cycles, 3593)
+        self.assertGreaterEqual(elapsed, 3593 / 200000)
+        self.assertEqual(clock.base_cycles, 0)
+        # reset(), or cycles moved back by a restore, start a new base
+        vm.halted = False
+        vm.regs.pc = 0
+        clock.reset()
+        vm.run(max_steps=1)
+        self.assertEqual(clock.base_cycles, 3593)
+        vm.cycles = 0
+        vm.run(max_steps=1)
+        self.assertEqual(clock.base_cycles, 0)
 
 class ErrorTest(unittest.TestCase):
     def test_halt(self):
@@ -486,13 +1585,35 @@ class ErrorTest(unittest.TestCase):
         with self.assertRaises(VMError):
             vm.execute_next()
     
-    def test_bad_address(self):
+    def test_wrapped_address(self):
         vm = VM()
-        # LDA, 0xffff
-        vm.mem[0] = 0x3a
+        # LHLD FFFF, the high byte wraps around to 0000
+        vm.mem[0] = 0x2a
         vm.mem[1] = 0xff
         vm.mem[2] = 0xff
-        with self.assertRaises(VMError):
-            vm.execute_next()
+        vm.mem[0xffff] = 0x11
+        vm.execute_next()
+        self.assertEqual(vm.regs.HL, 0x2a11)
+
+    def test_steps(self):
+        # INR A; INR A; STA 3000; HLT with ROM at 3000
+        program = b'\x3c\x3c\x32\x00\x30\x76'
+        for cls in (VM, FastVM, CachedVM, TranslatingVM):
+            for setup in (None, Trace, Profile, Clock):
+                vm = cls()
+                vm.hot_threshold = 0
+                vm.mem.load(program)
+                vm.mem.map_view(bytes(0x100), 0x3000)
+                if setup is Trace:
+                    vm.trace = Trace()
+                elif setup is Profile:
+                    vm.profile = Profile()
+                elif setup is Clock:
+                    vm.clock = Clock()
+                with self.assertRaises(VMError) as raised:
+                    vm.run()
+                # the instructions completed before the store
+                self.assertEqual(raised.exception.steps, 2, (cls.__name__, setup))
+                self.assertEqual(vm.regs.pc, 2)
 
 unittest.main()
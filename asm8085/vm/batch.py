@@ -0,0 +1,511 @@
+import numpy as np
+from .util import *
+from .vm import VM
+
+# Lockstep execution of many machines running the same program. Registers,
+# pc/sp, PSW and memory of every instance are NumPy arrays and each step
+# executes one instruction on every running instance: instances are grouped
+# by the opcode at their PC and each group runs through one vectorized
+# handler. While the instances agree on PC this is a single group; when they
+# diverge on data dependent branches the groups split and merge again as they
+# reach the same code. Handlers mirror the FastVM ones. An instance that
+# would raise VMError in VM stops instead, with the message in errors and its
+# state left as it was before the faulting instruction.
+
+ZSP = np.frombuffer(ZSP_TABLE, dtype=np.uint8).astype(np.int32)
+COND = np.array([np.frombuffer(table, dtype=np.uint8) for table in CONDITION_TABLES], dtype=bool)
+
+class BatchVM:
+    def __init__(self, count):
+        self.count = count
+        self.size = VM.RAM_SIZE
+        self.mem = np.zeros((count, self.size), dtype=np.uint8)
+        # one row per register encoding, row 6 stays 0
+        self.r = np.zeros((8, count), dtype=np.int32)
+        self.pc = np.zeros(count, dtype=np.int32)
+        self.sp = np.zeros(count, dtype=np.int32)
+        self.psw = np.zeros(count, dtype=np.int32)
+        self.halted = np.zeros(count, dtype=bool)
+        self.faulted = np.zeros(count, dtype=bool)
+        self.errors = [None] * count
+        # instructions executed by each instance
+        self.steps = np.zeros(count, dtype=np.int64)
+        self.groups = 0
+
+    # loads data into every instance, or only instance index
+    def load(self, data, addr=0, index=None):
+        end = addr + len(data)
+        if addr < 0 or end > self.size:
+            raise VMError(f'Invalid address range {addr:04x}-{end:04x}')
+        buf = np.frombuffer(data, dtype=np.uint8)
+        if index is None:
+            self.mem[:, addr:end] = buf
+        else:
+            self.mem[index, addr:end] = buf
+        return end
+
+    def set_state(self, index, vm):
+        self.r[:, index] = vm.regs.r
+        self.pc[index] = vm.regs.pc
+        self.sp[index] = vm.regs.sp
+        self.psw[index] = vm.flags.psw
+        self.halted[index] = vm.halted
+        self.mem[index] = np.frombuffer(vm.mem.dump(), dtype=np.uint8)
+
+    # a VM holding a copy of the state of instance index
+    def instance(self, index):
+        vm = VM()
+        vm.regs.r[:] = self.r[:, index].tolist()
+        vm.regs.pc = int(self.pc[index])
+        vm.regs.sp = int(self.sp[index])
+        vm.flags.psw = int(self.psw[index])
+        vm.halted = bool(self.halted[index])
+        vm.mem.load(self.mem[index].tobytes())
+        return vm
+
+    def running(self):
+        return np.flatnonzero(~(self.halted | self.faulted))
+
+    def fault(self, idx, message):
+        self.faulted[idx] = True
+        for index in idx.tolist():
+            self.errors[index] = message
+
+    # drops instances whose access at addr..addr+last falls outside memory,
+    # addresses wrap around the top of memory
+    def checked(self, idx, addr, last=0):
+        bad = (addr >= self.size) | (((addr + last) & 0xffff) >= self.size)
+        if bad.any():
+            self.fault(idx[bad], 'Invalid address')
+            ok = ~bad
+            return idx[ok], addr[ok]
+        return idx, addr
+
+    def read(self, idx, addr):
+        return self.mem[idx, addr].astype(np.int32)
+
+    def read_word(self, idx, addr):
+        mem = self.mem
+        return mem[idx, addr].astype(np.int32) | (mem[idx, (addr + 1) & 0xffff].astype(np.int32) << 8)
+
+    def write_word(self, idx, addr, val):
+        mem = self.mem
+        mem[idx, addr] = val & 0xff
+        mem[idx, (addr + 1) & 0xffff] = val >> 8
+
+    # executes one instruction on every running instance and returns how
+    # many were stepped
+    def step(self):
+        act = self.running()
+        if not len(act):
+            return 0
+        act, pc = self.checked(act, self.pc[act])
+        ops = self.mem[act, pc]
+        if len(ops) and (ops == ops[0]).all():
+            groups = ((int(ops[0]), act, pc),)
+        else:
+            groups = []
+            for opcode in np.unique(ops).tolist():
+                sel = ops == opcode
+                groups.append((opcode, act[sel], pc[sel]))
+        for opcode, idx, pc in groups:
+            operands = OPERAND_BYTES[opcode]
+            if operands:
+                idx, _ = self.checked(idx, pc, operands)
+            BATCH_DISPATCH[opcode](self, idx)
+        self.groups += len(groups)
+        self.steps[act[~self.faulted[act]]] += 1
+        return len(act)
+
+    # steps until every instance halted or faulted, or for at most max_steps
+    # rounds, returns the number of rounds
+    def run(self, max_steps=None):
+        limit = -1 if max_steps is None else max_steps
+        rounds = 0
+        while rounds != limit and self.step():
+            rounds += 1
+        return rounds
+
+# handlers take the batch and the indices of the instances to step
+
+def hl_addr(b, idx):
+    r = b.r
+    return (r[4, idx] << 8) | r[5, idx]
+
+def pair_value(b, rp, idx):
+    if rp == 0b1011:
+        return b.sp[idx]
+    hi = (rp & 0b11) << 1
+    return (b.r[hi, idx] << 8) | b.r[hi + 1, idx]
+
+def set_pair(b, rp, idx, val):
+    if rp == 0b1011:
+        b.sp[idx] = val
+    else:
+        hi = (rp & 0b11) << 1
+        b.r[hi, idx] = val >> 8
+        b.r[hi + 1, idx] = val & 0xff
+
+def advance(b, idx, length):
+    b.pc[idx] = (b.pc[idx] + length) & 0xffff
+
+def imm_word(b, idx):
+    return b.read_word(idx, (b.pc[idx] + 1) & 0xffff)
+
+def batch_alu_add(a, val, psw):
+    res = a + val
+    return res & 0xff, ZSP[res & 0xff] | (res >> 8)
+
+def batch_alu_adc(a, val, psw):
+    res = a + val + (psw & CY_BIT)
+    return res & 0xff, ZSP[res & 0xff] | (res >> 8)
+
+def batch_alu_sub(a, val, psw):
+    res = a - val
+    return res & 0xff, ZSP[res & 0xff] | ((res >> 8) & CY_BIT)
+
+def batch_alu_sbb(a, val, psw):
+    res = a - val - (psw & CY_BIT)
+    return res & 0xff, ZSP[res & 0xff] | ((res >> 8) & CY_BIT)
+
+def batch_alu_and(a, val, psw):
+    res = a & val
+    return res, ZSP[res]
+
+def batch_alu_xor(a, val, psw):
+    res = a ^ val
+    return res, ZSP[res]
+
+def batch_alu_or(a, val, psw):
+    res = a | val
+    return res, ZSP[res]
+
+def batch_alu_cmp(a, val, psw):
+    res = a - val
+    return a, ZSP[res & 0xff] | ((res >> 8) & CY_BIT)
+
+BATCH_ALU_OPS = (
+    batch_alu_add, batch_alu_adc, batch_alu_sub, batch_alu_sbb,
+    batch_alu_and, batch_alu_xor, batch_alu_or, batch_alu_cmp,
+)
+
+def batch_nop(b, idx):
+    advance(b, idx, 1)
+
+def batch_hlt(b, idx):
+    b.halted[idx] = True
+    advance(b, idx, 1)
+
+def batch_unknown(opcode):
+    def unknown(b, idx):
+        b.fault(idx, f'Unknown instruction {opcode:02x}')
+    return unknown
+
+def batch_mov(src, dest):
+    if src == 0b110:
+        def mov(b, idx):
+            idx, addr = b.checked(idx, hl_addr(b, idx))
+            b.r[dest, idx] = b.mem[idx, addr]
+            advance(b, idx, 1)
+    elif dest == 0b110:
+        def mov(b, idx):
+            idx, addr = b.checked(idx, hl_addr(b, idx))
+            b.mem[idx, addr] = b.r[src, idx]
+            advance(b, idx, 1)
+    else:
+        def mov(b, idx):
+            b.r[dest, idx] = b.r[src, idx]
+            advance(b, idx, 1)
+    return mov
+
+def batch_mvi(dest):
+    if dest == 0b110:
+        def mvi(b, idx):
+            idx, addr = b.checked(idx, hl_addr(b, idx))
+            b.mem[idx, addr] = b.mem[idx, (b.pc[idx] + 1) & 0xffff]
+            advance(b, idx, 2)
+    else:
+        def mvi(b, idx):
+            b.r[dest, idx] = b.mem[idx, (b.pc[idx] + 1) & 0xffff]
+            advance(b, idx, 2)
+    return mvi
+
+def batch_lda(b, idx):
+    idx, addr = b.checked(idx, imm_word(b, idx))
+    b.r[7, idx] = b.mem[idx, addr]
+    advance(b, idx, 3)
+
+def batch_sta(b, idx):
+    idx, addr = b.checked(idx, imm_word(b, idx))
+    b.mem[idx, addr] = b.r[7, idx]
+    advance(b, idx, 3)
+
+def batch_lhld(b, idx):
+    idx, addr = b.checked(idx, imm_word(b, idx), 1)
+    b.r[5, idx] = b.mem[idx, addr]
+    b.r[4, idx] = b.mem[idx, (addr + 1) & 0xffff]
+    advance(b, idx, 3)
+
+def batch_shld(b, idx):
+    idx, addr = b.checked(idx, imm_word(b, idx), 1)
+    b.mem[idx, addr] = b.r[5, idx]
+    b.mem[idx, (addr + 1) & 0xffff] = b.r[4, idx]
+    advance(b, idx, 3)
+
+def batch_lxi(rp):
+    def lxi(b, idx):
+        set_pair(b, rp, idx, imm_word(b, idx))
+        advance(b, idx, 3)
+    return lxi
+
+def batch_ldax(rp):
+    def ldax(b, idx):
+        idx, addr = b.checked(idx, pair_value(b, rp, idx))
+        b.r[7, idx] = b.mem[idx, addr]
+        advance(b, idx, 1)
+    return ldax
+
+def batch_stax(rp):
+    def stax(b, idx):
+        idx, addr = b.checked(idx, pair_value(b, rp, idx))
+        b.mem[idx, addr] = b.r[7, idx]
+        advance(b, idx, 1)
+    return stax
+
+def batch_xchg(b, idx):
+    r = b.r
+    r[[2, 3, 4, 5], idx[:, None]] = r[[4, 5, 2, 3], idx[:, None]]
+    advance(b, idx, 1)
+
+def batch_xthl(b, idx):
+    idx, addr = b.checked(idx, b.sp[idx], 1)
+    val = b.read_word(idx, addr)
+    b.write_word(idx, addr, hl_addr(b, idx))
+    set_pair(b, 0b1010, idx, val)
+    advance(b, idx, 1)
+
+def batch_alu(op, src):
+    if src == 0b110:
+        def alu(b, idx):
+            idx, addr = b.checked(idx, hl_addr(b, idx))
+            b.r[7, idx], b.psw[idx] = op(b.r[7, idx], b.read(idx, addr), b.psw[idx])
+            advance(b, idx, 1)
+    else:
+        def alu(b, idx):
+            b.r[7, idx], b.psw[idx] = op(b.r[7, idx], b.r[src, idx], b.psw[idx])
+            advance(b, idx, 1)
+    return alu
+
+def batch_alu_imm(op):
+    def alu_imm(b, idx):
+        val = b.read(idx, (b.pc[idx] + 1) & 0xffff)
+        b.r[7, idx], b.psw[idx] = op(b.r[7, idx], val, b.psw[idx])
+        advance(b, idx, 2)
+    return alu_imm
+
+def batch_inc_dec(dest, delta):
+    if dest == 0b110:
+        def inc_dec(b, idx):
+            idx, addr = b.checked(idx, hl_addr(b, idx))
+            val = (b.read(idx, addr) + delta) & 0xff
+            b.mem[idx, addr] = val
+            b.psw[idx] = (b.psw[idx] & CY_BIT) | ZSP[val]
+            advance(b, idx, 1)
+    else:
+        def inc_dec(b, idx):
+            val = (b.r[dest, idx] + delta) & 0xff
+            b.r[dest, idx] = val
+            b.psw[idx] = (b.psw[idx] & CY_BIT) | ZSP[val]
+            advance(b, idx, 1)
+    return inc_dec
+
+def batch_inx_dcx(rp, delta):
+    def inx_dcx(b, idx):
+        set_pair(b, rp, idx, (pair_value(b, rp, idx) + delta) & 0xffff)
+        advance(b, idx, 1)
+    return inx_dcx
+
+def batch_dad(rp):
+    def dad(b, idx):
+        res = hl_addr(b, idx) + pair_value(b, rp, idx)
+        b.psw[idx] = (b.psw[idx] & ~CY_BIT) | (res >> 16)
+        set_pair(b, 0b1010, idx, res & 0xffff)
+        advance(b, idx, 1)
+    return dad
+
+def batch_rlc(b, idx):
+    a = b.r[7, idx]
+    b.psw[idx] = (b.psw[idx] & ~CY_BIT) | (a >> 7)
+    b.r[7, idx] = ((a << 1) & 0xff) | (a >> 7)
+    advance(b, idx, 1)
+
+def batch_rrc(b, idx):
+    a = b.r[7, idx]
+    b.psw[idx] = (b.psw[idx] & ~CY_BIT) | (a & 1)
+    b.r[7, idx] = ((a & 1) << 7) | (a >> 1)
+    advance(b, idx, 1)
+
+def batch_ral(b, idx):
+    a = b.r[7, idx]
+    psw = b.psw[idx]
+    b.r[7, idx] = ((a << 1) & 0xff) | (psw & CY_BIT)
+    b.psw[idx] = (psw & ~CY_BIT) | (a >> 7)
+    advance(b, idx, 1)
+
+def batch_rar(b, idx):
+    a = b.r[7, idx]
+    psw = b.psw[idx]
+    b.r[7, idx] = ((psw & CY_BIT) << 7) | (a >> 1)
+    b.psw[idx] = (psw & ~CY_BIT) | (a & 1)
+    advance(b, idx, 1)
+
+def batch_cma(b, idx):
+    b.r[7, idx] ^= 0xff
+    advance(b, idx, 1)
+
+def batch_cmc(b, idx):
+    b.psw[idx] ^= CY_BIT
+    advance(b, idx, 1)
+
+def batch_stc(b, idx):
+    b.psw[idx] |= CY_BIT
+    advance(b, idx, 1)
+
+def batch_jmp(b, idx):
+    b.pc[idx] = imm_word(b, idx)
+
+# conditional instructions only read their operands when taken, split idx
+# into (taken, not taken)
+def split(b, cond, idx):
+    taken = cond[b.psw[idx]]
+    return idx[taken], idx[~taken]
+
+def batch_jcc(cond):
+    def jcc(b, idx):
+        taken, skipped = split(b, cond, idx)
+        taken, _ = b.checked(taken, b.pc[taken], 2)
+        batch_jmp(b, taken)
+        advance(b, skipped, 3)
+    return jcc
+
+def batch_call(b, idx):
+    idx, sp = b.checked(idx, (b.sp[idx] - 2) & 0xffff, 1)
+    addr = imm_word(b, idx)
+    b.write_word(idx, sp, (b.pc[idx] + 3) & 0xffff)
+    b.sp[idx] = sp
+    b.pc[idx] = addr
+
+def batch_ccc(cond):
+    def ccc(b, idx):
+        taken, skipped = split(b, cond, idx)
+        taken, _ = b.checked(taken, b.pc[taken], 2)
+        batch_call(b, taken)
+        advance(b, skipped, 3)
+    return ccc
+
+def batch_ret(b, idx):
+    idx, sp = b.checked(idx, b.sp[idx], 1)
+    b.pc[idx] = b.read_word(idx, sp)
+    b.sp[idx] = (sp + 2) & 0xffff
+
+def batch_rcc(cond):
+    def rcc(b, idx):
+        taken, skipped = split(b, cond, idx)
+        batch_ret(b, taken)
+        advance(b, skipped, 1)
+    return rcc
+
+def batch_pchl(b, idx):
+    b.pc[idx] = hl_addr(b, idx)
+
+def batch_sphl(b, idx):
+    b.sp[idx] = hl_addr(b, idx)
+    advance(b, idx, 1)
+
+# rp 0b1011 is PSW rather than SP for PUSH and POP
+def batch_push(rp):
+    def push(b, idx):
+        idx, sp = b.checked(idx, (b.sp[idx] - 2) & 0xffff, 1)
+        if rp == 0b1011:
+            val = (b.r[7, idx] << 8) | b.psw[idx]
+        else:
+            val = pair_value(b, rp, idx)
+        b.write_word(idx, sp, val)
+        b.sp[idx] = sp
+        advance(b, idx, 1)
+    return push
+
+def batch_pop(rp):
+    def pop(b, idx):
+        idx, sp = b.checked(idx, b.sp[idx], 1)
+        val = b.read_word(idx, sp)
+        if rp == 0b1011:
+            b.r[7, idx] = val >> 8
+            b.psw[idx] = val & PSW_MASK
+        else:
+            set_pair(b, rp, idx, val)
+        b.sp[idx] = (sp + 2) & 0xffff
+        advance(b, idx, 1)
+    return pop
+
+def build_batch_dispatch():
+    table = [batch_unknown(opcode) for opcode in range(256)]
+    # operand bytes read unconditionally, checked before the handler runs
+    operands = bytearray(256)
+    table[0x00] = batch_nop
+    for opcode in range(0x40, 0x80):
+        table[opcode] = batch_mov(get_src(opcode), get_dest(opcode))
+    table[0x76] = batch_hlt
+    for opcode in range(0x00, 0x40, 0x08):
+        dest = get_dest(opcode)
+        table[opcode | 0x04] = batch_inc_dec(dest, 0x01)
+        table[opcode | 0x05] = batch_inc_dec(dest, 0xff)
+        table[opcode | 0x06] = batch_mvi(dest)
+        operands[opcode | 0x06] = 1
+    for opcode in range(0x00, 0x40, 0x10):
+        rp = get_rp(opcode)
+        table[opcode | 0x01] = batch_lxi(rp)
+        operands[opcode | 0x01] = 2
+        table[opcode | 0x03] = batch_inx_dcx(rp, 0x0001)
+        table[opcode | 0x09] = batch_dad(rp)
+        table[opcode | 0x0b] = batch_inx_dcx(rp, 0xffff)
+    for opcode in (0x3a, 0x32, 0x2a, 0x22, 0xc3, 0xcd):
+        operands[opcode] = 2
+    table[0x3a] = batch_lda
+    table[0x32] = batch_sta
+    table[0x2a] = batch_lhld
+    table[0x22] = batch_shld
+    table[0x0a] = batch_ldax(0b1000)
+    table[0x1a] = batch_ldax(0b1001)
+    table[0x02] = batch_stax(0b1000)
+    table[0x12] = batch_stax(0b1001)
+    table[0xeb] = batch_xchg
+    table[0xe3] = batch_xthl
+    for opcode in range(0x80, 0xc0):
+        table[opcode] = batch_alu(BATCH_ALU_OPS[(opcode >> 3) & 0x07], get_src(opcode))
+    for opcode in range(0xc6, 0x100, 0x08):
+        table[opcode] = batch_alu_imm(BATCH_ALU_OPS[(opcode >> 3) & 0x07])
+        operands[opcode] = 1
+    table[0x07] = batch_rlc
+    table[0x0f] = batch_rrc
+    table[0x17] = batch_ral
+    table[0x1f] = batch_rar
+    table[0x2f] = batch_cma
+    table[0x3f] = batch_cmc
+    table[0x37] = batch_stc
+    table[0xc3] = batch_jmp
+    table[0xcd] = batch_call
+    table[0xc9] = batch_ret
+    for opcode in range(0xc0, 0x100, 0x08):
+        cond = COND[get_dest(opcode)]
+        table[opcode] = batch_rcc(cond)
+        table[opcode | 0x02] = batch_jcc(cond)
+        table[opcode | 0x04] = batch_ccc(cond)
+    for opcode in range(0xc0, 0x100, 0x10):
+        table[opcode | 0x01] = batch_pop(get_rp(opcode))
+        table[opcode | 0x05] = batch_push(get_rp(opcode))
+    table[0xe9] = batch_pchl
+    table[0xf9] = batch_sphl
+    return table, bytes(operands)
+
+BATCH_DISPATCH, OPERAND_BYTES = build_batch_dispatch()
@@ -0,0 +1,502 @@
+import copy
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+from .vm import VM, DISPATCH
+from .registers import Registers
+from .fast import FastVM
+from .predecode import CachedVM
+from .translate import TranslatingVM
+from .trace import Trace
+from .profile import Profile
+from .clock import Clock
+
+# opcodes in the order the old if/elif chain in execute_next tested them
+CHAIN_ORDER = (
+    ('NOP', 0x00), ('HLT', 0x76), ('MOV', 0x4c), ('MVI', 0x16), ('LDA', 0x3a),
+    ('STA', 0x32), ('LHLD', 0x2a), ('SHLD', 0x22), ('LXI', 0x01), ('LDAX', 0x1a),
+    ('STAX', 0x02), ('XCHG', 0xeb), ('XTHL', 0xe3), ('ADD', 0x82), ('ADI', 0xc6),
+    ('ADC', 0x89), ('ACI', 0xce), ('SUB', 0x90), ('SUI', 0xd6), ('SBB', 0x98),
+    ('SBI', 0xde), ('INR', 0x0c), ('DCR', 0x25), ('INX', 0x13), ('DCX', 0x2b),
+    ('DAD', 0x39), ('ANA', 0xa1), ('ANI', 0xe6), ('ORA', 0xb2), ('ORI', 0xf6),
+    ('XRA', 0xa8), ('XRI', 0xee), ('CMP', 0xbb), ('CPI', 0xfe), ('RLC', 0x07),
+    ('RRC', 0x0f), ('RAL', 0x17), ('RAR', 0x1f), ('CMA', 0x2f), ('CMC', 0x3f),
+    ('STC', 0x37),
+)
+
+def make_vm(opcode):
+    vm = VM()
+    vm.mem[0] = opcode
+    vm.mem[1] = 0x10
+    vm.mem[2] = 0x10
+    vm.regs.HL = 0x1000
+    vm.regs.SP = 0x2000
+    return vm
+
+def bench_opcode(opcode, number):
+    vm = make_vm(opcode)
+    regs = vm.regs
+
+    def step():
+        regs.PC = 0
+        vm.halted = False
+        vm.execute_next()
+
+    def reset():
+        regs.PC = 0
+        vm.halted = False
+
+    total = min(timeit.repeat(step, number=number, repeat=3))
+    overhead = min(timeit.repeat(reset, number=number, repeat=3))
+    return (total - overhead) / number * 1e9
+
+def bench_dispatch(number=50000):
+    print(f'{"pos":>4} {"op":<5} {"ns/op":>8}')
+    costs = []
+    for pos, (name, opcode) in enumerate(CHAIN_ORDER):
+        assert DISPATCH[opcode].__name__ != 'unknown'
+        cost = bench_opcode(opcode, number)
+        costs.append(cost)
+        print(f'{pos:>4} {name:<5} {cost:>8.1f}')
+    head = sum(costs[:10]) / 10
+    tail = sum(costs[-10:]) / 10
+    print(f'first 10 avg {head:.1f} ns, last 10 avg {tail:.1f} ns, ratio {tail / head:.2f}')
+
+# straight-line INR/DCR/MVI/MOV/ADI/ADD/INX program, 7 instructions per 9 bytes
+def make_program_vm(steps, cls=VM):
+    vm = cls()
+    body = bytes((0x3c, 0x05, 0x3e, 0x12, 0x48, 0xc6, 0x01, 0x81, 0x13))
+    vm.mem.load(body * (steps // 7 + 1))
+    return vm
+
+def bench_run(steps=35000):
+    vm = make_program_vm(steps)
+    fast = make_program_vm(steps, FastVM)
+    cached = make_program_vm(steps, CachedVM)
+    translated = make_program_vm(steps, TranslatingVM)
+    # every block is run once per repeat, compile them on first sight
+    translated.hot_threshold = 0
+
+    def loop():
+        vm.regs.PC = 0
+        for _ in range(steps):
+            vm.execute_next()
+
+    def run():
+        vm.regs.PC = 0
+        vm.run(max_steps=steps)
+
+    def run_fast():
+        fast.regs.PC = 0
+        fast.run(max_steps=steps)
+
+    # early repeats fill the caches, the best repeat is reported
+    def run_cached():
+        cached.regs.PC = 0
+        cached.run(max_steps=steps)
+
+    def run_translated():
+        translated.regs.PC = 0
+        translated.run(max_steps=steps)
+
+    cases = (
+        ('execute_next loop', loop), ('run', run), ('FastVM.run', run_fast),
+        ('CachedVM.run', run_cached), ('TranslatingVM.run', run_translated),
+    )
+    for name, fn in cases:
+        cost = min(timeit.repeat(fn, number=1, repeat=5)) / steps * 1e9
+        print(f'{name:<18} {cost:>8.1f} ns/instruction')
+
+# nested DCR/JNZ loops calling a subroutine that adds M into A and counts
+# carries in D, mostly branches, calls and returns
+LOOP_PROGRAM = bytes((
+    0x31, 0x00, 0x20, # LXI SP, 2000
+    0x21, 0x00, 0x10, # LXI H, 1000
+    0x06, 0x00,       # MVI B, outer count
+    0x0e, 0x00,       # outer: MVI C, 00
+    0xcd, 0x16, 0x00, # inner: CALL sub
+    0x0d,             # DCR C
+    0xc2, 0x0a, 0x00, # JNZ inner
+    0x05,             # DCR B
+    0xc2, 0x08, 0x00, # JNZ outer
+    0x76,             # HLT
+    0x86,             # sub: ADD M
+    0xd0,             # RNC
+    0x14,             # INR D
+    0xc9,             # RET
+))
+
+def make_loop_vm(outer, cls=VM):
+    vm = cls()
+    vm.mem.load(LOOP_PROGRAM)
+    vm.mem[7] = outer
+    vm.mem[0x1000] = 0x5b
+    return vm
+
+# runs a loop VM again from the start
+def rerun(vm):
+    vm.regs.PC = 0
+    vm.halted = False
+    return vm.run()
+
+# ns per instruction of the best of 5 reruns, the first run fills the caches
+# and counts the instructions
+def time_rerun(vm):
+    steps, _ = rerun(vm)
+    return min(timeit.repeat(lambda: rerun(vm), number=1, repeat=5)) / steps * 1e9
+
+def bench_loop(outer=10):
+    print(f'loop program, {outer} x 256 calls')
+    for cls in (VM, FastVM, CachedVM, TranslatingVM):
+        cost = time_rerun(make_loop_vm(outer, cls))
+        print(f'{cls.__name__ + ".run":<18} {cost:>8.1f} ns/instruction')
+
+# the loop program with attr of the VM set to None (the plain bench_loop path)
+# and to make()
+def bench_mode(outer, attr, make, label):
+    for cls in (VM, FastVM):
+        for mode in (None, make()):
+            vm = make_loop_vm(outer, cls)
+            setattr(vm, attr, mode)
+            name = f'{cls.__name__}.run' + (f' {label}' if mode else '')
+            print(f'{name:<18} {time_rerun(vm):>8.1f} ns/instruction')
+
+def bench_trace(outer=10, size=1024):
+    print(f'loop program, {outer} x 256 calls, trace of {size} records')
+    bench_mode(outer, 'trace', lambda: Trace(size), 'traced')
+
+def bench_profile(outer=10):
+    print(f'loop program, {outer} x 256 calls, profiled')
+    bench_mode(outer, 'profile', Profile, 'profiled')
+
+# clocked runs counting cycles, and paced to 3.072 MHz, timed over one rerun
+# since a paced run takes as long every time
+def bench_clock(outer=10, hz=3072000):
+    print(f'loop program, {outer} x 256 calls, clocked')
+    for clock in (None, Clock(), Clock(hz)):
+        vm = make_loop_vm(outer, FastVM)
+        vm.clock = clock
+        steps, _ = rerun(vm)
+        start = time.perf_counter()
+        cycles = vm.cycles
+        rerun(vm)
+        elapsed = time.perf_counter() - start
+        name = 'FastVM.run' + (' counted' if clock and not clock.hz else ' paced' if clock else '')
+        line = f'{name:<18} {elapsed / steps * 1e9:>8.1f} ns/instruction'
+        if clock:
+            line += f', {(vm.cycles - cycles) / elapsed / 1e6:.3f} MHz emulated'
+        print(line)
+
+# the loop program on count instances with different data, BatchVM against
+# running FastVM once per instance
+def bench_batch(count=1000, outer=1):
+    try:
+        from .batch import BatchVM
+    except ImportError:
+        print('numpy is not installed, skipping BatchVM')
+        return
+    rng = random.Random(0)
+    data = [bytes([rng.randrange(256)]) for _ in range(count)]
+
+    def run_fast():
+        total = 0
+        for value in data:
+            vm = make_loop_vm(outer, FastVM)
+            vm.mem[0x1000] = value[0]
+            total += vm.run()[0]
+        return total
+
+    def run_batch():
+        batch = BatchVM(count)
+        batch.load(make_loop_vm(outer).mem.dump())
+        for index, value in enumerate(data):
+            batch.load(value, 0x1000, index)
+        batch.run()
+        return int(batch.steps.sum())
+
+    print(f'loop program, {count} instances')
+    for name, fn in (('FastVM.run', run_fast), ('BatchVM.run', run_batch)):
+        start = time.perf_counter()
+        steps = fn()
+        cost = (time.perf_counter() - start) / steps * 1e9
+        print(f'{name:<18} {cost:>8.1f} ns/instruction')
+
+# cost of branching a VM with a full memory image: fork() against a deep
+# copy, and fork() followed by running code that dirties pages
+def bench_fork(number=200):
+    vm = VM()
+    vm.mem.load(random.Random(0).randbytes(VM.RAM_SIZE))
+    vm.mem.load(bytes((0x32, 0x00, 0x10, 0x32, 0x00, 0x20, 0x76)), 0x100) # STA 1000; STA 2000; HLT
+    vm.regs.PC = 0x100
+    vm.snapshot()
+
+    def fork_run():
+        vm.fork().run()
+
+    cases = (
+        ('copy.deepcopy', lambda: copy.deepcopy(vm)), ('fork', vm.fork),
+        ('fork, 2 pages', fork_run), ('snapshot', vm.snapshot),
+    )
+    for name, fn in cases:
+        cost = min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+        print(f'{name:<18} {cost:>8.1f} us')
+
+# startup cost of a full memory image: byte-by-byte stores, load() and
+# mapping the file
+def bench_map(number=20):
+    data = random.Random(0).randbytes(VM.RAM_SIZE)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(data)
+    try:
+        def stores():
+            vm = VM()
+            for addr, val in enumerate(data):
+                vm.mem[addr] = val
+
+        def load():
+            with open(f.name, 'rb') as image:
+                VM().mem.load(image.read())
+
+        def map_file():
+            VM().mem.map_file(f.name)
+
+        cases = (('mem[i] = ...', stores), ('load', load), ('map_file', map_file))
+        for name, fn in cases:
+            cost = min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+            print(f'{name:<18} {cost:>8.1f} us')
+    finally:
+        os.unlink(f.name)
+
+# finding what a run changed in a full memory image: diff() against the
+# mark, against scanning every byte of a dump
+def bench_diff(number=200):
+    vm = VM()
+    image = random.Random(0).randbytes(VM.RAM_SIZE)
+    vm.mem.load(image)
+    vm.mem.load(bytes((0x32, 0x00, 0x10, 0x32, 0x00, 0x20, 0x76)), 0x100) # STA 1000; STA 2000; HLT
+    vm.regs.PC = 0x100
+    baseline = vm.mem.dump()
+    vm.mem.mark()
+    vm.run()
+
+    def scan():
+        return [addr for addr, (new, old) in enumerate(zip(vm.mem.dump(), baseline)) if new != old]
+
+    cases = (('byte scan', scan), ('dump ==', lambda: vm.mem.dump() == baseline), ('diff', vm.mem.diff))
+    for name, fn in cases:
+        cost = min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+        print(f'{name:<18} {cost:>8.1f} us')
+
+# the property/if-chain register file Registers replaced, kept for comparison
+class LegacyRegisters:
+    def __init__(self):
+        self._A = 0
+        self._B = 0
+        self._C = 0
+        self._D = 0
+        self._E = 0
+        self._H = 0
+        self._L = 0
+        self._PC = 0
+        self._SP = 0
+    
+    @property
+    def A(self):
+        return self._A
+    
+    @A.setter
+    def A(self, value):
+        assert 0 <= value <= 0xff
+        self._A = value
+    
+    @property
+    def B(self):
+        return self._B
+    
+    @B.setter
+    def B(self, value):
+        assert 0 <= value <= 0xff
+        self._B = value
+
+    @property
+    def C(self):
+        return self._C
+    
+    @C.setter
+    def C(self, value):
+        assert 0 <= value <= 0xff
+        self._C = value
+
+    @property
+    def D(self):
+        return self._D
+    
+    @D.setter
+    def D(self, value):
+        assert 0 <= value <= 0xff
+        self._D = value
+
+    @property
+    def E(self):
+        return self._E
+    
+    @E.setter
+    def E(self, value):
+        assert 0 <= value <= 0xff
+        self._E = value
+
+    @property
+    def H(self):
+        return self._H
+    
+    @H.setter
+    def H(self, value):
+        assert 0 <= value <= 0xff
+        self._H = value
+
+    @property
+    def L(self):
+        return self._L
+    
+    @L.setter
+    def L(self, value):
+        assert 0 <= value <= 0xff
+        self._L = value
+
+    @property
+    def BC(self):
+        return (self.B << 8) | self.C
+    
+    @BC.setter
+    def BC(self, value):
+        assert 0 <= value <= 0xffff
+        self.B = value >> 8
+        self.C = value & 0xff
+    
+    @property
+    def DE(self):
+        return (self.D << 8) | self.E
+    
+    @DE.setter
+    def DE(self, value):
+        assert 0 <= value <= 0xffff
+        self.D = value >> 8
+        self.E = value & 0xff
+    
+    @property
+    def HL(self):
+        return (self.H << 8) | self.L
+    
+    @HL.setter
+    def HL(self, value):
+        assert 0 <= value <= 0xffff
+        self.H = value >> 8
+        self.L = value & 0xff
+
+    @property
+    def PC(self):
+        return self._PC
+    
+    @PC.setter
+    def PC(self, value):
+        assert 0 <= value <= 0xffff
+        self._PC = value
+
+    @property
+    def SP(self):
+        return self._SP
+    
+    @SP.setter
+    def SP(self, value):
+        assert 0 <= value <= 0xffff
+        self._SP = value
+    
+    def __getitem__(self, enc):
+        if enc == 0b0000:
+            return self.B
+        elif enc == 0b0001:
+            return self.C
+        elif enc == 0b0010:
+            return self.D
+        elif enc == 0b0011:
+            return self.E
+        elif enc == 0b0100:
+            return self.H
+        elif enc == 0b0101:
+            return self.L
+        elif enc == 0b0111:
+            return self.A
+        elif enc == 0b1000:
+            return self.BC
+        elif enc == 0b1001:
+            return self.DE
+        elif enc == 0b1010:
+            return self.HL
+        elif enc == 0b1011:
+            return self.SP
+        else:
+            raise IndexError(f'Unknown register encoding {enc:04b}')
+
+    def __setitem__(self, enc, val):
+        assert 0 <= val <= (0xff if enc & 0b1000 == 0 else 0xffff)
+        if enc == 0b0000:
+            self.B = val
+        elif enc == 0b0001:
+            self.C = val
+        elif enc == 0b0010:
+            self.D = val
+        elif enc == 0b0011:
+            self.E = val
+        elif enc == 0b0100:
+            self.H = val
+        elif enc == 0b0101:
+            self.L = val
+        elif enc == 0b0111:
+            self.A = val
+        elif enc == 0b1000:
+            self.BC = val
+        elif enc == 0b1001:
+            self.DE = val
+        elif enc == 0b1010:
+            self.HL = val
+        elif enc == 0b1011:
+            self.SP = val
+        else:
+            raise IndexError(f'Unknown register encoding {enc:04b}')
+
+def bench_registers(number=200000):
+    cases = (
+        ('regs.A', 'regs.A'),
+        ('regs.A = 1', 'regs.A = 1'),
+        ('regs.HL', 'regs.HL'),
+        ('regs.HL = 0x1234', 'regs.HL = 0x1234'),
+        ('regs[0b0111]', 'regs[0b0111]'),
+        ('regs[0b0111] = 1', 'regs[0b0111] = 1'),
+        ('regs[0b1010]', 'regs[0b1010]'),
+        ('regs[0b1011] = 1', 'regs[0b1011] = 1'),
+    )
+    print(f'{"":<18} {"legacy":>8} {"list":>8}')
+    for name, stmt in cases:
+        costs = []
+        for cls in (LegacyRegisters, Registers):
+            regs = cls()
+            t = min(timeit.repeat(stmt, globals={'regs': regs}, number=number, repeat=3))
+            costs.append(t / number * 1e9)
+        print(f'{name:<18} {costs[0]:>8.1f} {costs[1]:>8.1f}')
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    bench_dispatch(number)
+    bench_run()
+    bench_loop()
+    bench_trace()
+    bench_profile()
+    bench_clock()
+    bench_batch()
+    bench_fork()
+    bench_map()
+    bench_diff()
+    bench_registers()
@@ -0,0 +1,136 @@
+import time
+from .util import VMError, CONDITION_TABLES
+from .vm import run_loop
+from ..disassembler.disassembler import TABLE
+
+# T-state accounting and real-time pacing. Setting vm.clock to a Clock makes
+# run() add the T-states of every instruction executed to vm.cycles from a
+# run_loop hook. With hz set the hook also paces execution to that clock
+# rate, it checks the time once every quantum seconds of emulated time and
+# sleeps off whatever it is ahead, so there is no sleep per instruction. Unclocked runs do not count cycles and are not touched.
+
+ALU = ('ADD', 'ADC', 'SUB', 'SBB', 'ANA', 'XRA', 'ORA', 'CMP')
+ALU_IMMEDIATE = ('ADI', 'ACI', 'SUI', 'SBI', 'ANI', 'XRI', 'ORI', 'CPI')
+CONDITIONS = ('NZ', 'Z', 'NC', 'C', 'PO', 'PE', 'P', 'M')
+
+# 8085 T-states per mnemonic, (register operand, M operand) where they differ
+TIMES = {
+    'MOV': (4, 7), 'MVI': (7, 10), 'LXI': 10, 'LDA': 13, 'STA': 13, 'LHLD': 16, 'SHLD': 16,
+    'LDAX': 7, 'STAX': 7, 'XCHG': 4, 'XTHL': 16, 'SPHL': 6, 'PCHL': 6,
+    'INR': (4, 10), 'DCR': (4, 10), 'INX': 6, 'DCX': 6, 'DAD': 10, 'DAA': 4,
+    'RLC': 4, 'RRC': 4, 'RAL': 4, 'RAR': 4, 'CMA': 4, 'CMC': 4, 'STC': 4,
+    'JMP': 10, 'CALL': 18, 'RET': 10, 'RST': 12, 'PUSH': 12, 'POP': 10,
+    'IN': 10, 'OUT': 10, 'EI': 4, 'DI': 4, 'HLT': 5, 'NOP': 4, 'RIM': 4, 'SIM': 4,
+    # undefined opcodes raise before they are counted
+    'DB': 0,
+}
+TIMES.update({op: (4, 7) for op in ALU})
+TIMES.update({op: 7 for op in ALU_IMMEDIATE})
+# conditional branches, (not taken, taken)
+BRANCHES = {'J': (7, 10), 'C': (9, 18), 'R': (6, 12)}
+TIMES.update({op + cc: taken for op, taken in BRANCHES.items() for cc in CONDITIONS})
+
+# (T-states not taken, T-states taken) for every opcode, equal for everything
+# but conditional branches
+def build_tstates():
+    tstates = []
+    for text, _ in TABLE:
+        op, _, operands = text.partition(' ')
+        times = TIMES[op]
+        if op in ('MOV', 'MVI', 'INR', 'DCR') + ALU:
+            times = times[1] if 'M' in operands.split(', ') else times[0]
+        if isinstance(times, int):
+            times = (times, times)
+        tstates.append(times)
+    return tuple(tstates)
+
+TSTATES = build_tstates()
+
+# T-states indexed by psw << 8 | opcode, conditional branches are taken when
+# the PSW before the instruction satisfies their condition
+def build_cycles():
+    cycles = bytearray(0x10000)
+    for opcode, (not_taken, taken) in enumerate(TSTATES):
+        cond = CONDITION_TABLES[(opcode >> 3) & 7]
+        for psw in range(256):
+            cycles[psw << 8 | opcode] = taken if cond[psw] else not_taken
+    return bytes(cycles)
+
+CYCLES = build_cycles()
+
+class Clock:
+    # hz is the clock rate to pace execution to, None runs at full speed and
+    # only counts cycles
+    # quantum is the emulated time in seconds run between checks of the time,
+    # max_lag how far behind real time a run may fall before it stops trying
+    # to catch up
+    def __init__(self, hz=None, quantum=0.01, max_lag=0.1):
+        if hz is not None and hz <= 0:
+            raise VMError('Clock rate must be positive')
+        self.hz = hz
+        self.quantum = quantum
+        self.max_lag = max_lag
+        # real time and vm.cycles pacing is measured from, kept across runs
+        # so a VM run in slices is paced as one run
+        self.base_time = None
+        self.base_cycles = 0
+
+    # measures pacing from the start of the next run, e.g. after a pause the
+    # VM should not catch up on
+    def reset(self):
+        self.base_time = None
+
+    # sleeps off how far cycles are ahead of real time, or moves the base up
+    # to now when they are too far behind to catch up
+    def pace(self, cycles):
+        ahead = (cycles - self.base_cycles) / self.hz - (time.perf_counter() - self.base_time)
+        if ahead > 0:
+            time.sleep(ahead)
+        elif ahead < -self.max_lag:
+            # too slow to keep up, carry on from here rather than running
+            # flat out to make up the time
+            self.base_time = time.perf_counter()
+            self.base_cycles = cycles
+
+    # VM.run adding the T-states of every instruction to vm.cycles, table is
+    # the dispatch table of the VM's core
+    def run(self, vm, table, max_steps=None, until_pc=None):
+        if vm.trace is not None or vm.profile is not None:
+            raise VMError('Cannot clock a traced or profiled run')
+        flags = vm.flags
+        fetch = vm.mem.__getitem__
+        cycles_table = CYCLES
+        hz = self.hz
+        # T-states of the instruction about to run, taken back if it raises
+        t = 0
+        if hz is None:
+            def tick(pc):
+                nonlocal t
+                t = cycles_table[flags.psw << 8 | fetch(pc)]
+                vm.cycles += t
+        else:
+            # cycles moved back, e.g. by restoring a snapshot, start a new base
+            if self.base_time is None or vm.cycles < self.base_cycles:
+                self.base_time = time.perf_counter()
+                self.base_cycles = vm.cycles
+            period = max(1, int(hz * self.quantum))
+            check = vm.cycles + period
+            pace = self.pace
+
+            def tick(pc):
+                nonlocal t, check
+                t = cycles_table[flags.psw << 8 | fetch(pc)]
+                cycles = vm.cycles = vm.cycles + t
+                if cycles >= check:
+                    pace(cycles)
+                    check = cycles + period
+        try:
+            res = run_loop(vm, table, max_steps, until_pc, tick)
+        except VMError:
+            # the instruction that raised is not counted
+            vm.cycles -= t
+            raise
+        if hz is not None:
+            # the last partial quantum is slept off too
+            self.pace(vm.cycles)
+        return res
@@ -0,0 +1,483 @@
+from .util import *
+from .vm import VM, make_unknown
+
+# Unchecked execution core. Handlers work on the raw register list, pc/sp
+# and PSW byte and keep every value in range by masking, so none of the
+# asserts in Registers, Flags or the VM.apply_* helpers are evaluated.
+# Memory bounds are still enforced by Memory.
+
+# ALU results as (new A, new psw) given A, operand and the current psw,
+# ADC/SBB with operand 0xff and CY set fall out of the general formula
+def alu_add(a, val, psw):
+    res = a + val
+    return res & 0xff, ZSP_TABLE[res & 0xff] | (res >> 8)
+
+def alu_adc(a, val, psw):
+    res = a + val + (psw & CY_BIT)
+    return res & 0xff, ZSP_TABLE[res & 0xff] | (res >> 8)
+
+def alu_sub(a, val, psw):
+    res = a - val
+    return res & 0xff, ZSP_TABLE[res & 0xff] | ((res >> 8) & CY_BIT)
+
+def alu_sbb(a, val, psw):
+    res = a - val - (psw & CY_BIT)
+    return res & 0xff, ZSP_TABLE[res & 0xff] | ((res >> 8) & CY_BIT)
+
+def alu_and(a, val, psw):
+    res = a & val
+    return res, ZSP_TABLE[res]
+
+def alu_xor(a, val, psw):
+    res = a ^ val
+    return res, ZSP_TABLE[res]
+
+def alu_or(a, val, psw):
+    res = a | val
+    return res, ZSP_TABLE[res]
+
+def alu_cmp(a, val, psw):
+    res = a - val
+    return a, ZSP_TABLE[res & 0xff] | ((res >> 8) & CY_BIT)
+
+FAST_ALU_OPS = (alu_add, alu_adc, alu_sub, alu_sbb, alu_and, alu_xor, alu_or, alu_cmp)
+
+def fast_nop(vm):
+    regs = vm.regs
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_hlt(vm):
+    vm.halted = True
+    regs = vm.regs
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_mov(src, dest):
+    if src == 0b110:
+        def mov(vm):
+            regs = vm.regs
+            r = regs.r
+            r[dest] = vm.mem[(r[4] << 8) | r[5]]
+            regs.pc = (regs.pc + 1) & 0xffff
+    elif dest == 0b110:
+        def mov(vm):
+            regs = vm.regs
+            r = regs.r
+            vm.mem[(r[4] << 8) | r[5]] = r[src]
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        def mov(vm):
+            regs = vm.regs
+            r = regs.r
+            r[dest] = r[src]
+            regs.pc = (regs.pc + 1) & 0xffff
+    return mov
+
+def fast_mvi(dest):
+    if dest == 0b110:
+        def mvi(vm):
+            regs = vm.regs
+            r = regs.r
+            mem = vm.mem
+            pc = regs.pc
+            mem[(r[4] << 8) | r[5]] = mem[(pc + 1) & 0xffff]
+            regs.pc = (pc + 2) & 0xffff
+    else:
+        def mvi(vm):
+            regs = vm.regs
+            pc = regs.pc
+            regs.r[dest] = vm.mem[(pc + 1) & 0xffff]
+            regs.pc = (pc + 2) & 0xffff
+    return mvi
+
+def fast_lda(vm):
+    regs = vm.regs
+    mem = vm.mem
+    pc = regs.pc
+    regs.r[7] = mem[mem[(pc + 1) & 0xffff] | (mem[(pc + 2) & 0xffff] << 8)]
+    regs.pc = (pc + 3) & 0xffff
+
+def fast_sta(vm):
+    regs = vm.regs
+    mem = vm.mem
+    pc = regs.pc
+    mem[mem[(pc + 1) & 0xffff] | (mem[(pc + 2) & 0xffff] << 8)] = regs.r[7]
+    regs.pc = (pc + 3) & 0xffff
+
+def fast_lhld(vm):
+    regs = vm.regs
+    r = regs.r
+    mem = vm.mem
+    pc = regs.pc
+    addr = mem[(pc + 1) & 0xffff] | (mem[(pc + 2) & 0xffff] << 8)
+    r[5] = mem[addr]
+    r[4] = mem[(addr + 1) & 0xffff]
+    regs.pc = (pc + 3) & 0xffff
+
+def fast_shld(vm):
+    regs = vm.regs
+    r = regs.r
+    mem = vm.mem
+    pc = regs.pc
+    addr = mem[(pc + 1) & 0xffff] | (mem[(pc + 2) & 0xffff] << 8)
+    mem[addr] = r[5]
+    mem[(addr + 1) & 0xffff] = r[4]
+    regs.pc = (pc + 3) & 0xffff
+
+def fast_lxi(rp):
+    if rp == 0b1011:
+        def lxi(vm):
+            regs = vm.regs
+            mem = vm.mem
+            pc = regs.pc
+            regs.sp = mem[(pc + 1) & 0xffff] | (mem[(pc + 2) & 0xffff] << 8)
+            regs.pc = (pc + 3) & 0xffff
+    else:
+        hi = (rp & 0b11) << 1
+        def lxi(vm):
+            regs = vm.regs
+            r = regs.r
+            mem = vm.mem
+            pc = regs.pc
+            # both bytes are read before either register changes
+            lo = mem[(pc + 1) & 0xffff]
+            r[hi] = mem[(pc + 2) & 0xffff]
+            r[hi + 1] = lo
+            regs.pc = (pc + 3) & 0xffff
+    return lxi
+
+def fast_ldax(rp):
+    hi = (rp & 0b11) << 1
+    def ldax(vm):
+        regs = vm.regs
+        r = regs.r
+        r[7] = vm.mem[(r[hi] << 8) | r[hi + 1]]
+        regs.pc = (regs.pc + 1) & 0xffff
+    return ldax
+
+def fast_stax(rp):
+    hi = (rp & 0b11) << 1
+    def stax(vm):
+        regs = vm.regs
+        r = regs.r
+        vm.mem[(r[hi] << 8) | r[hi + 1]] = r[7]
+        regs.pc = (regs.pc + 1) & 0xffff
+    return stax
+
+def fast_xchg(vm):
+    regs = vm.regs
+    r = regs.r
+    r[2], r[3], r[4], r[5] = r[4], r[5], r[2], r[3]
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_xthl(vm):
+    regs = vm.regs
+    r = regs.r
+    mem = vm.mem
+    sp = regs.sp
+    mem[sp], r[5] = r[5], mem[sp]
+    hi = (sp + 1) & 0xffff
+    mem[hi], r[4] = r[4], mem[hi]
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_alu(op, src):
+    if src == 0b110:
+        def alu(vm):
+            regs = vm.regs
+            r = regs.r
+            flags = vm.flags
+            r[7], flags.psw = op(r[7], vm.mem[(r[4] << 8) | r[5]], flags.psw)
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        def alu(vm):
+            regs = vm.regs
+            r = regs.r
+            flags = vm.flags
+            r[7], flags.psw = op(r[7], r[src], flags.psw)
+            regs.pc = (regs.pc + 1) & 0xffff
+    return alu
+
+def fast_alu_imm(op):
+    def alu_imm(vm):
+        regs = vm.regs
+        r = regs.r
+        flags = vm.flags
+        pc = regs.pc
+        r[7], flags.psw = op(r[7], vm.mem[(pc + 1) & 0xffff], flags.psw)
+        regs.pc = (pc + 2) & 0xffff
+    return alu_imm
+
+# INR/DCR leave CY alone
+def fast_inc_dec(dest, delta):
+    if dest == 0b110:
+        def inc_dec(vm):
+            regs = vm.regs
+            r = regs.r
+            mem = vm.mem
+            flags = vm.flags
+            addr = (r[4] << 8) | r[5]
+            res = (mem[addr] + delta) & 0xff
+            flags.psw = (flags.psw & CY_BIT) | ZSP_TABLE[res]
+            mem[addr] = res
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        def inc_dec(vm):
+            regs = vm.regs
+            r = regs.r
+            flags = vm.flags
+            res = (r[dest] + delta) & 0xff
+            flags.psw = (flags.psw & CY_BIT) | ZSP_TABLE[res]
+            r[dest] = res
+            regs.pc = (regs.pc + 1) & 0xffff
+    return inc_dec
+
+def fast_inx_dcx(rp, delta):
+    if rp == 0b1011:
+        def inx_dcx(vm):
+            regs = vm.regs
+            regs.sp = (regs.sp + delta) & 0xffff
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        hi = (rp & 0b11) << 1
+        def inx_dcx(vm):
+            regs = vm.regs
+            r = regs.r
+            res = (((r[hi] << 8) | r[hi + 1]) + delta) & 0xffff
+            r[hi] = res >> 8
+            r[hi + 1] = res & 0xff
+            regs.pc = (regs.pc + 1) & 0xffff
+    return inx_dcx
+
+def fast_dad(rp):
+    if rp == 0b1011:
+        def dad(vm):
+            regs = vm.regs
+            r = regs.r
+            flags = vm.flags
+            res = ((r[4] << 8) | r[5]) + regs.sp
+            flags.psw = (flags.psw & ~CY_BIT) | (res >> 16)
+            r[4] = (res >> 8) & 0xff
+            r[5] = res & 0xff
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        hi = (rp & 0b11) << 1
+        def dad(vm):
+            regs = vm.regs
+            r = regs.r
+            flags = vm.flags
+            res = ((r[4] << 8) | r[5]) + ((r[hi] << 8) | r[hi + 1])
+            flags.psw = (flags.psw & ~CY_BIT) | (res >> 16)
+            r[4] = (res >> 8) & 0xff
+            r[5] = res & 0xff
+            regs.pc = (regs.pc + 1) & 0xffff
+    return dad
+
+def fast_rlc(vm):
+    regs = vm.regs
+    r = regs.r
+    flags = vm.flags
+    a = r[7]
+    flags.psw = (flags.psw & ~CY_BIT) | (a >> 7)
+    r[7] = ((a << 1) & 0xff) | (a >> 7)
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_rrc(vm):
+    regs = vm.regs
+    r = regs.r
+    flags = vm.flags
+    a = r[7]
+    flags.psw = (flags.psw & ~CY_BIT) | (a & 1)
+    r[7] = ((a & 1) << 7) | (a >> 1)
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_ral(vm):
+    regs = vm.regs
+    r = regs.r
+    flags = vm.flags
+    a = r[7]
+    psw = flags.psw
+    r[7] = ((a << 1) & 0xff) | (psw & CY_BIT)
+    flags.psw = (psw & ~CY_BIT) | (a >> 7)
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_rar(vm):
+    regs = vm.regs
+    r = regs.r
+    flags = vm.flags
+    a = r[7]
+    psw = flags.psw
+    r[7] = ((psw & CY_BIT) << 7) | (a >> 1)
+    flags.psw = (psw & ~CY_BIT) | (a & 1)
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_cma(vm):
+    regs = vm.regs
+    regs.r[7] ^= 0xff
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_cmc(vm):
+    vm.flags.psw ^= CY_BIT
+    regs = vm.regs
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_stc(vm):
+    vm.flags.psw |= CY_BIT
+    regs = vm.regs
+    regs.pc = (regs.pc + 1) & 0xffff
+
+def fast_jmp(vm):
+    regs = vm.regs
+    regs.pc = vm.mem.read_word((regs.pc + 1) & 0xffff)
+
+def fast_jcc(cond):
+    def jcc(vm):
+        regs = vm.regs
+        if cond[vm.flags.psw]:
+            regs.pc = vm.mem.read_word((regs.pc + 1) & 0xffff)
+        else:
+            regs.pc = (regs.pc + 3) & 0xffff
+    return jcc
+
+def fast_call(vm):
+    regs = vm.regs
+    mem = vm.mem
+    pc = regs.pc
+    addr = mem.read_word((pc + 1) & 0xffff)
+    sp = (regs.sp - 2) & 0xffff
+    mem.write_word(sp, (pc + 3) & 0xffff)
+    regs.sp = sp
+    regs.pc = addr
+
+def fast_ccc(cond):
+    def ccc(vm):
+        if cond[vm.flags.psw]:
+            fast_call(vm)
+        else:
+            regs = vm.regs
+            regs.pc = (regs.pc + 3) & 0xffff
+    return ccc
+
+def fast_ret(vm):
+    regs = vm.regs
+    sp = regs.sp
+    regs.pc = vm.mem.read_word(sp)
+    regs.sp = (sp + 2) & 0xffff
+
+def fast_rcc(cond):
+    def rcc(vm):
+        if cond[vm.flags.psw]:
+            fast_ret(vm)
+        else:
+            regs = vm.regs
+            regs.pc = (regs.pc + 1) & 0xffff
+    return rcc
+
+def fast_pchl(vm):
+    regs = vm.regs
+    r = regs.r
+    regs.pc = (r[4] << 8) | r[5]
+
+def fast_sphl(vm):
+    regs = vm.regs
+    r = regs.r
+    regs.sp = (r[4] << 8) | r[5]
+    regs.pc = (regs.pc + 1) & 0xffff
+
+# rp 0b1011 is PSW rather than SP for PUSH and POP
+def fast_push(rp):
+    if rp == 0b1011:
+        def push(vm):
+            regs = vm.regs
+            sp = (regs.sp - 2) & 0xffff
+            vm.mem.write_word(sp, (regs.r[7] << 8) | vm.flags.psw)
+            regs.sp = sp
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        hi = (rp & 0b11) << 1
+        def push(vm):
+            regs = vm.regs
+            r = regs.r
+            sp = (regs.sp - 2) & 0xffff
+            vm.mem.write_word(sp, (r[hi] << 8) | r[hi + 1])
+            regs.sp = sp
+            regs.pc = (regs.pc + 1) & 0xffff
+    return push
+
+def fast_pop(rp):
+    if rp == 0b1011:
+        def pop(vm):
+            regs = vm.regs
+            sp = regs.sp
+            val = vm.mem.read_word(sp)
+            regs.r[7] = val >> 8
+            vm.flags.psw = val & PSW_MASK
+            regs.sp = (sp + 2) & 0xffff
+            regs.pc = (regs.pc + 1) & 0xffff
+    else:
+        hi = (rp & 0b11) << 1
+        def pop(vm):
+            regs = vm.regs
+            r = regs.r
+            sp = regs.sp
+            val = vm.mem.read_word(sp)
+            r[hi] = val >> 8
+            r[hi + 1] = val & 0xff
+            regs.sp = (sp + 2) & 0xffff
+            regs.pc = (regs.pc + 1) & 0xffff
+    return pop
+
+def build_fast_dispatch():
+    table = [make_unknown(opcode) for opcode in range(256)]
+    table[0x00] = fast_nop
+    for opcode in range(0x40, 0x80):
+        table[opcode] = fast_mov(get_src(opcode), get_dest(opcode))
+    table[0x76] = fast_hlt
+    for opcode in range(0x80, 0xc0):
+        table[opcode] = fast_alu(FAST_ALU_OPS[(opcode >> 3) & 0x07], get_src(opcode))
+    for opcode in range(0xc6, 0x100, 0x08):
+        table[opcode] = fast_alu_imm(FAST_ALU_OPS[(opcode >> 3) & 0x07])
+    for opcode in range(0x00, 0x40, 0x08):
+        table[opcode | 0x04] = fast_inc_dec(get_dest(opcode), 0x01)
+        table[opcode | 0x05] = fast_inc_dec(get_dest(opcode), 0xff)
+        table[opcode | 0x06] = fast_mvi(get_dest(opcode))
+    for opcode in range(0x00, 0x40, 0x10):
+        rp = get_rp(opcode)
+        table[opcode | 0x01] = fast_lxi(rp)
+        table[opcode | 0x03] = fast_inx_dcx(rp, 0x0001)
+        table[opcode | 0x09] = fast_dad(rp)
+        table[opcode | 0x0b] = fast_inx_dcx(rp, 0xffff)
+    for opcode in (0x02, 0x12):
+        table[opcode] = fast_stax(get_rp(opcode))
+        table[opcode | 0x08] = fast_ldax(get_rp(opcode))
+    table[0x3a] = fast_lda
+    table[0x32] = fast_sta
+    table[0x2a] = fast_lhld
+    table[0x22] = fast_shld
+    table[0xeb] = fast_xchg
+    table[0xe3] = fast_xthl
+    table[0x07] = fast_rlc
+    table[0x0f] = fast_rrc
+    table[0x17] = fast_ral
+    table[0x1f] = fast_rar
+    table[0x2f] = fast_cma
+    table[0x3f] = fast_cmc
+    table[0x37] = fast_stc
+    table[0xc3] = fast_jmp
+    table[0xcd] = fast_call
+    table[0xc9] = fast_ret
+    for opcode in range(0xc0, 0x100, 0x08):
+        cond = CONDITION_TABLES[get_dest(opcode)]
+        table[opcode] = fast_rcc(cond)
+        table[opcode | 0x02] = fast_jcc(cond)
+        table[opcode | 0x04] = fast_ccc(cond)
+    for opcode in range(0xc0, 0x100, 0x10):
+        table[opcode | 0x01] = fast_pop(get_rp(opcode))
+        table[opcode | 0x05] = fast_push(get_rp(opcode))
+    table[0xe9] = fast_pchl
+    table[0xf9] = fast_sphl
+    return table
+
+FAST_DISPATCH = build_fast_dispatch()
+
+# VM running FAST_DISPATCH
+class FastVM(VM):
+    DISPATCH = FAST_DISPATCH
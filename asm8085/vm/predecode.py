@@ -0,0 +1,237 @@
+from .util import *
+from .vm import VM
+from .fast import FastVM, FAST_DISPATCH, FAST_ALU_OPS
+
+# Predecoded execution on top of the fast core. The first time an address is
+# executed its instruction is decoded into a handler with the operand bytes
+# and the next PC baked in; later executions call the cached handler without
+# touching memory for the opcode or operands. Cached bytes are watched in
+# Memory so any write to them drops the affected entries.
+
+# decoders take (next pc, operand) and return a handler
+def decode_mvi(dest):
+    if dest == 0b110:
+        def decoder(next_pc, arg):
+            def mvi(vm):
+                r = vm.regs.r
+                vm.mem[(r[4] << 8) | r[5]] = arg
+                vm.regs.pc = next_pc
+            return mvi
+    else:
+        def decoder(next_pc, arg):
+            def mvi(vm):
+                vm.regs.r[dest] = arg
+                vm.regs.pc = next_pc
+            return mvi
+    return decoder
+
+def decode_alu_imm(op):
+    def decoder(next_pc, arg):
+        def alu_imm(vm):
+            r = vm.regs.r
+            flags = vm.flags
+            r[7], flags.psw = op(r[7], arg, flags.psw)
+            vm.regs.pc = next_pc
+        return alu_imm
+    return decoder
+
+def decode_lxi(rp):
+    if rp == 0b1011:
+        def decoder(next_pc, arg):
+            def lxi(vm):
+                regs = vm.regs
+                regs.sp = arg
+                regs.pc = next_pc
+            return lxi
+    else:
+        hi = (rp & 0b11) << 1
+        def decoder(next_pc, arg):
+            arg_hi = arg >> 8
+            arg_lo = arg & 0xff
+            def lxi(vm):
+                regs = vm.regs
+                r = regs.r
+                r[hi] = arg_hi
+                r[hi + 1] = arg_lo
+                regs.pc = next_pc
+            return lxi
+    return decoder
+
+def decode_lda(next_pc, addr):
+    def lda(vm):
+        regs = vm.regs
+        regs.r[7] = vm.mem[addr]
+        regs.pc = next_pc
+    return lda
+
+def decode_sta(next_pc, addr):
+    def sta(vm):
+        regs = vm.regs
+        vm.mem[addr] = regs.r[7]
+        regs.pc = next_pc
+    return sta
+
+def decode_lhld(next_pc, addr):
+    def lhld(vm):
+        regs = vm.regs
+        r = regs.r
+        mem = vm.mem
+        r[5] = mem[addr]
+        r[4] = mem[(addr + 1) & 0xffff]
+        regs.pc = next_pc
+    return lhld
+
+def decode_shld(next_pc, addr):
+    def shld(vm):
+        regs = vm.regs
+        r = regs.r
+        mem = vm.mem
+        mem[addr] = r[5]
+        mem[(addr + 1) & 0xffff] = r[4]
+        regs.pc = next_pc
+    return shld
+
+def decode_jmp(next_pc, addr):
+    def jmp(vm):
+        vm.regs.pc = addr
+    return jmp
+
+def decode_jcc(cond):
+    def decoder(next_pc, addr):
+        def jcc(vm):
+            vm.regs.pc = addr if cond[vm.flags.psw] else next_pc
+        return jcc
+    return decoder
+
+def decode_call(next_pc, addr):
+    def call(vm):
+        regs = vm.regs
+        sp = (regs.sp - 2) & 0xffff
+        vm.mem.write_word(sp, next_pc)
+        regs.sp = sp
+        regs.pc = addr
+    return call
+
+def decode_ccc(cond):
+    def decoder(next_pc, addr):
+        call = decode_call(next_pc, addr)
+        def ccc(vm):
+            if cond[vm.flags.psw]:
+                call(vm)
+            else:
+                vm.regs.pc = next_pc
+        return ccc
+    return decoder
+
+def build_decoders():
+    # (decoder, instruction length), None keeps the fast handler as is
+    table = [None] * 256
+    for opcode in range(0x00, 0x40, 0x08):
+        table[opcode | 0x06] = (decode_mvi(get_dest(opcode)), 2)
+    for opcode in range(0xc6, 0x100, 0x08):
+        table[opcode] = (decode_alu_imm(FAST_ALU_OPS[(opcode >> 3) & 0x07]), 2)
+    for opcode in range(0x00, 0x40, 0x10):
+        table[opcode | 0x01] = (decode_lxi(get_rp(opcode)), 3)
+    table[0x3a] = (decode_lda, 3)
+    table[0x32] = (decode_sta, 3)
+    table[0x2a] = (decode_lhld, 3)
+    table[0x22] = (decode_shld, 3)
+    table[0xc3] = (decode_jmp, 3)
+    table[0xcd] = (decode_call, 3)
+    for opcode in range(0xc0, 0x100, 0x08):
+        cond = CONDITION_TABLES[get_dest(opcode)]
+        table[opcode | 0x02] = (decode_jcc(cond), 3)
+        table[opcode | 0x04] = (decode_ccc(cond), 3)
+    return table
+
+DECODERS = build_decoders()
+
+class CachedVM(FastVM):
+    def __init__(self):
+        super().__init__()
+        # indexed by any 16-bit PC, decoding past the end of memory raises VMError
+        self.cache = [None] * 0x10000
+        # length of the cached instruction starting at each address, 0 if none
+        self.cached_len = bytearray(0x10000)
+        self.decoded = 0
+        self.invalidated = 0
+        self.mem.watchers.append(self.invalidate)
+
+    def decode(self, pc):
+        mem = self.mem
+        opcode = mem[pc]
+        entry = DECODERS[opcode]
+        if entry is None:
+            handler = FAST_DISPATCH[opcode]
+            length = 1
+        else:
+            decoder, length = entry
+            if pc + length > 0x10000:
+                # operands wrapping to 0000 are not watched, run it uncached
+                return FAST_DISPATCH[opcode]
+            arg = mem[pc + 1]
+            if length == 3:
+                arg |= mem[pc + 2] << 8
+            handler = decoder((pc + length) & 0xffff, arg)
+        self.cache[pc] = handler
+        self.cached_len[pc] = length
+        mem.watch(pc, pc + length)
+        self.decoded += 1
+        return handler
+
+    # drops every cached instruction overlapping [start, end)
+    def invalidate(self, start, end):
+        cache = self.cache
+        cached_len = self.cached_len
+        for addr in range(max(start - 2, 0), end):
+            length = cached_len[addr]
+            if length and addr + length > start:
+                cache[addr] = None
+                cached_len[addr] = 0
+                self.mem.unwatch(addr, addr + length)
+                self.invalidated += 1
+
+    def flush(self):
+        self.invalidate(0, len(self.mem))
+
+    def execute_next(self):
+        if self.trace is not None or self.profile is not None or self.clock is not None:
+            VM.run(self, 1)
+            return
+        if self.halted:
+            raise VMError('Cannot run a halted program')
+        pc = self.regs.pc
+        handler = self.cache[pc]
+        if handler is None:
+            handler = self.decode(pc)
+        handler(self)
+
+    def run(self, max_steps=None, until_pc=None):
+        # traced, profiled and clocked runs step through FAST_DISPATCH instead
+        # of the cache
+        if self.trace is not None or self.profile is not None or self.clock is not None:
+            return VM.run(self, max_steps, until_pc)
+        if self.halted:
+            raise VMError('Cannot run a halted program')
+        regs = self.regs
+        cache = self.cache
+        decode = self.decode
+        limit = -1 if max_steps is None else max_steps
+        steps = 0
+        try:
+            while steps != limit:
+                pc = regs.pc
+                if pc == until_pc:
+                    return steps, VM.STOP_PC
+                handler = cache[pc]
+                if handler is None:
+                    handler = decode(pc)
+                handler(self)
+                steps += 1
+                if self.halted:
+                    return steps, VM.STOP_HALT
+            return steps, VM.STOP_STEPS
+        except VMError as e:
+            # see run_loop
+            e.steps = steps
+            raise
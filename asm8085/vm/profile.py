@@ -0,0 +1,166 @@
+from .util import VMError
+from .vm import run_loop
+from ..disassembler.disassembler import TABLE, HEX, instruction_at
+
+# Execution profiler: setting vm.profile to a Profile makes run() count each
+# instruction from a run_loop hook. Executions are counted per PC and per
+# opcode, and bytes read and written by instructions per address, all in
+# preallocated lists. Memory is counted through CountingMemory, installed as
+# vm.mem for the length of the run. An instruction reading its own operand
+# bytes is not counted as a read, opcode fetches are in the per-PC counts.
+
+LENGTHS = bytes(length for _, length in TABLE)
+CONDITIONS = ('NZ', 'Z', 'NC', 'C', 'PO', 'PE', 'P', 'M')
+BRANCHES = {'JMP', 'CALL', 'RET', 'RST', 'PCHL', 'HLT'} | {op + cc for op in 'JCR' for cc in CONDITIONS}
+# opcodes that end a basic block
+TERMINATORS = bytes(text.split()[0] in BRANCHES for text, _ in TABLE)
+
+class CountingMemory:
+    def __init__(self, mem, reads, writes):
+        self.mem = mem
+        self.reads = reads
+        self.writes = writes
+        # bytes of the current instruction, start <= addr < end, with
+        # addr + 10000 for operands wrapped around ffff
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return len(self.mem)
+
+    # everything else goes to the real memory
+    def __getattr__(self, name):
+        return getattr(self.mem, name)
+
+    def operand(self, addr):
+        return self.start <= addr < self.end or self.start <= addr + 0x10000 < self.end
+
+    def __getitem__(self, idx):
+        val = self.mem[idx]
+        if not self.operand(idx):
+            self.reads[idx] += 1
+        return val
+
+    def __setitem__(self, idx, val):
+        self.mem[idx] = val
+        self.writes[idx] += 1
+
+    def read_word(self, addr):
+        val = self.mem.read_word(addr)
+        if not self.operand(addr):
+            self.reads[addr] += 1
+            self.reads[(addr + 1) & 0xffff] += 1
+        return val
+
+    # the high byte of a word at ffff is at 0000, like in Memory
+    def write_word(self, addr, val):
+        self.mem.write_word(addr, val)
+        self.writes[addr] += 1
+        self.writes[(addr + 1) & 0xffff] += 1
+
+class Profile:
+    def __init__(self):
+        self.pcs = [0] * 0x10000
+        self.opcodes = [0] * 256
+        self.reads = [0] * 0x10000
+        self.writes = [0] * 0x10000
+        self.steps = 0
+
+    def clear(self):
+        for counts in (self.pcs, self.opcodes, self.reads, self.writes):
+            counts[:] = [0] * len(counts)
+        self.steps = 0
+
+    # VM.run counting every instruction, table is the dispatch table of the
+    # VM's core
+    def run(self, vm, table, max_steps=None, until_pc=None):
+        if vm.trace is not None:
+            raise VMError('Cannot trace and profile at the same time')
+        mem = vm.mem
+        fetch = mem.__getitem__
+        counting = CountingMemory(mem, self.reads, self.writes)
+        pcs = self.pcs
+        opcodes = self.opcodes
+        lengths = LENGTHS
+
+        # the opcode is fetched from mem here, run_loop fetches it again
+        # through counting but it is inside [start, end)
+        def count(pc):
+            opcode = fetch(pc)
+            pcs[pc] += 1
+            opcodes[opcode] += 1
+            counting.start = pc
+            counting.end = pc + lengths[opcode]
+
+        vm.mem = counting
+        steps = 0
+        try:
+            res = run_loop(vm, table, max_steps, until_pc, count)
+            steps = res[0]
+            return res
+        except VMError as e:
+            steps = getattr(e, 'steps', 0)
+            raise
+        finally:
+            vm.mem = mem
+            self.steps += steps
+
+    # (count, address) of the n most executed addresses
+    def top_addresses(self, n=10):
+        return top(self.pcs, n)
+
+    # (count, opcode) of the n most executed opcodes
+    def top_opcodes(self, n=10):
+        return top(self.opcodes, n)
+
+    # (instructions executed, start, end, times run) of the n hottest basic
+    # blocks, found as runs of instructions executed equally often and ending
+    # at a branch, in the code currently in mem
+    def top_blocks(self, mem, n=10):
+        pcs = self.pcs
+        blocks = []
+        start = None
+        pc = 0
+        while pc < len(pcs):
+            executed = pcs[pc]
+            if start is not None and (pc != end or executed != count):
+                blocks.append((count * size, start, end, count))
+                start = None
+            if not executed:
+                pc += 1
+                continue
+            opcode = mem[pc]
+            if start is None:
+                start, size, count = pc, 0, executed
+            size += 1
+            end = pc = pc + LENGTHS[opcode]
+            if TERMINATORS[opcode]:
+                blocks.append((count * size, start, end, count))
+                start = None
+        if start is not None:
+            blocks.append((count * size, start, end, count))
+        blocks.sort(key=lambda block: (-block[0], block[1]))
+        return blocks[:n]
+
+    # hot spot report over the code in mem
+    def report(self, mem, n=10):
+        steps = self.steps or 1
+        lines = [f'{self.steps} instructions']
+        lines.append('top addresses')
+        for count, pc in self.top_addresses(n):
+            lines.append(f'  {pc:04X}  {count:10d} {count / steps:6.1%}  {instruction_at(mem, pc)[1]}')
+        lines.append('top opcodes')
+        for count, opcode in self.top_opcodes(n):
+            lines.append(f'  {HEX[opcode]}    {count:10d} {count / steps:6.1%}  {TABLE[opcode][0].rstrip(", ")}')
+        lines.append('hottest blocks')
+        for executed, start, end, count in self.top_blocks(mem, n):
+            lines.append(f'  {start:04X}-{end - 1:04X} {executed:10d} {executed / steps:6.1%}  x{count}')
+        for name, counts in (('reads', self.reads), ('writes', self.writes)):
+            lines.append(f'top {name}')
+            for count, addr in top(counts, n):
+                lines.append(f'  {addr:04X}  {count:10d}')
+        return '\n'.join(lines) + '\n'
+
+# (count, index) of the n largest non-zero counts, largest first
+def top(counts, n):
+    return sorted(((count, i) for i, count in enumerate(counts) if count), key=lambda item: (-item[0], item[1]))[:n]
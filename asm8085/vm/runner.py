@@ -0,0 +1,184 @@
+import contextlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ..assembler import Assembler, AssemblyCache
+from .util import VMError, file_view
+from .vm import VM
+from .fast import FastVM
+from .trace import Trace
+from .clock import Clock
+
+# Parallel batch runner: assembles and runs many .asm programs over a process
+# pool and writes one JSON line per program as soon as it finishes. Images
+# shared by every program (input data, tables) are handed to each worker once
+# through the pool initializer, tasks only carry the program path, so the
+# images are not pickled per task (and not at all under fork). ROM files are
+# mapped read-only once per worker and their pages used by every program, so
+# all workers share the same physical pages.
+
+# set in each worker by init_worker
+images = ()
+roms = ()
+
+def init_worker(shared, rom_paths):
+    global images, roms
+    images = shared
+    roms = tuple((addr, file_view(path)) for addr, path in rom_paths)
+
+# returns the address the code starts at, load_addr unless the program
+# moves it with ORG, and the code
+# cache is the directory of an AssemblyCache or None
+def assemble(path, load_addr=0, cache=None):
+    if cache is not None:
+        with open(path) as f:
+            origin, code, _ = AssemblyCache(cache).assemble(f.read(), load_addr)
+        return origin, code
+    with open(path) as f:
+        assembler = Assembler(f, load_addr)
+        code = assembler.assemble()
+    return assembler.origin, code
+
+def regs_dict(vm):
+    regs = vm.regs
+    return {
+        'A': regs.A, 'B': regs.B, 'C': regs.C, 'D': regs.D,
+        'E': regs.E, 'H': regs.H, 'L': regs.L, 'PC': regs.pc, 'SP': regs.sp,
+    }
+
+def flags_dict(vm):
+    flags = vm.flags
+    return {'S': flags.S, 'Z': flags.Z, 'P': flags.P, 'CY': flags.CY}
+
+# assembles and runs one program, never raises, returns the result record
+# trace is the number of instructions to keep a trace of, the trace ends with
+# the instruction that raised for programs stopped by an error
+# clock counts the T-states executed, paced to clock Hz unless it is 0
+def run_program(path, load_addr=0, max_steps=100000, dumps=(), core=FastVM, diff=False, cache=None,
+                trace=0, clock=None):
+    result = {'program': path}
+    try:
+        load_addr, code = assemble(path, load_addr, cache)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['stage'] = 'assemble'
+        return result
+    vm = core()
+    if trace:
+        vm.trace = Trace(trace)
+    if clock is not None:
+        vm.clock = Clock(clock or None)
+    steps = 0
+    try:
+        for addr, data in images:
+            vm.mem.load(data, addr)
+        for addr, view in roms:
+            vm.mem.map_view(view, addr)
+        vm.mem.load(code, load_addr)
+        vm.regs.pc = load_addr
+        vm.mem.mark()
+        steps, reason = vm.run(max_steps=max_steps)
+        result['stop'] = reason
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['stage'] = 'run'
+        # the instructions run before the fault, None for errors from outside
+        # the VM
+        steps = getattr(e, 'steps', None)
+    result['steps'] = steps
+    result['registers'] = regs_dict(vm)
+    result['flags'] = flags_dict(vm)
+    result['memory'] = {f'{start:04x}-{end:04x}': vm.mem.dump(start, end).hex() for start, end in dumps}
+    if diff:
+        # bytes changed by the program since it was loaded
+        result['diff'] = {f'{addr:04x}': data.hex() for addr, data in vm.mem.diff()}
+    if trace:
+        result['trace'] = vm.trace.decode()
+    if clock is not None:
+        result['cycles'] = vm.cycles
+    return result
+
+def find_programs(paths):
+    programs = []
+    for path in paths:
+        if os.path.isdir(path):
+            programs += sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith('.asm'))
+        else:
+            programs.append(path)
+    return programs
+
+# runs every program in paths (files or directories of .asm files) and writes
+# one JSON line per program to out in completion order
+# images are (address, bytes) pairs loaded before each program, roms are
+# (address, path) pairs of files mapped read-only, dumps are (start, end)
+# memory ranges included in the results, diff adds the bytes each program
+# changed, cache is a directory shared by the workers to cache assembled
+# programs in, trace adds the last trace instructions of each program, clock
+# adds the T-states each program ran for
+# returns the number of programs that stopped with an error
+def run_all(paths, out, images=(), load_addr=0, max_steps=100000, dumps=(), core=FastVM,
+            workers=None, roms=(), diff=False, cache=None, trace=0, clock=None):
+    for start, end in dumps:
+        if not 0 <= start <= end <= VM.RAM_SIZE:
+            raise VMError(f'Invalid address range {start:04x}-{end:04x}')
+    shared = tuple((addr, bytes(data)) for addr, data in images)
+    failed = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(shared, tuple(roms))) as pool:
+        futures = [
+            pool.submit(run_program, path, load_addr, max_steps, tuple(dumps), core, diff, cache, trace, clock)
+            for path in find_programs(paths)
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            if 'error' in result:
+                failed += 1
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+    return failed
+
+def parse_range(text):
+    start, end = text.split('-')
+    return int(start, 16), int(end, 16)
+
+def parse_image(text):
+    addr, path = text.split(':', 1)
+    with open(path, 'rb') as f:
+        return int(addr, 16), f.read()
+
+def parse_rom(text):
+    addr, path = text.split(':', 1)
+    return int(addr, 16), path
+
+# python -m asm8085.vm.runner [--steps N] [--dump 1000-1010] [--image 8000:data.bin]
+#                             [--rom 8000:rom.bin] [--diff] [--out results.jsonl]
+#                             [--workers N] [--cache dir] [--trace N] [--clock HZ]
+#                             program.asm|dir ...
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {'--steps': [], '--dump': [], '--image': [], '--out': [], '--workers': [], '--rom': [],
+               '--cache': [], '--trace': [], '--clock': []}
+    paths = []
+    diff = False
+    while args:
+        arg = args.pop(0)
+        if arg == '--diff':
+            diff = True
+        elif arg in options:
+            options[arg].append(args.pop(0))
+        else:
+            paths.append(arg)
+    max_steps = int(options['--steps'][-1]) if options['--steps'] else 100000
+    workers = int(options['--workers'][-1]) if options['--workers'] else None
+    dumps = [parse_range(text) for text in options['--dump']]
+    shared = [parse_image(text) for text in options['--image']]
+    rom_paths = [parse_rom(text) for text in options['--rom']]
+    cache = options['--cache'][-1] if options['--cache'] else None
+    trace = int(options['--trace'][-1]) if options['--trace'] else 0
+    # --clock 0 counts cycles without pacing
+    clock = float(options['--clock'][-1]) if options['--clock'] else None
+    with open(options['--out'][-1], 'w') if options['--out'] else contextlib.nullcontext(sys.stdout) as out:
+        failed = run_all(paths, out, shared, max_steps=max_steps, dumps=dumps, workers=workers,
+                         roms=rom_paths, diff=diff, cache=cache, trace=trace, clock=clock)
+    sys.exit(1 if failed else 0)
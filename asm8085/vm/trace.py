@@ -0,0 +1,86 @@
+import struct
+from .vm import run_loop
+from ..disassembler.disassembler import TABLE, HEX
+
+# Instruction trace kept in a preallocated ring buffer of fixed-size records,
+# the state before each instruction: PC, opcode, operand bytes (0 past the
+# instruction's length), B C D E H L A, SP and flags. Setting vm.trace to a
+# Trace makes run() record each instruction from a run_loop hook. Records are
+# written with pack_into, nothing is allocated per step.
+
+RECORD = struct.Struct('<HBBBBBBBBBBHBx')
+LENGTHS = bytes(length for _, length in TABLE)
+
+class Trace:
+    def __init__(self, size=1024):
+        self.size = size
+        self.buffer = bytearray(size * RECORD.size)
+        # records written since the trace was created or cleared
+        self.count = 0
+
+    def clear(self):
+        self.count = 0
+
+    # VM.run with every instruction recorded before it executes, table is the
+    # dispatch table of the VM's core
+    def run(self, vm, table, max_steps=None, until_pc=None):
+        regs = vm.regs
+        r = regs.r
+        flags = vm.flags
+        fetch = vm.mem.__getitem__
+        buffer = self.buffer
+        pack = RECORD.pack_into
+        record_size = RECORD.size
+        end = len(buffer)
+        lengths = LENGTHS
+        offset = self.count % self.size * record_size
+        written = 0
+
+        def record(pc):
+            nonlocal offset, written
+            opcode = fetch(pc)
+            length = lengths[opcode]
+            pack(buffer, offset, pc, opcode,
+                 fetch((pc + 1) & 0xffff) if length > 1 else 0,
+                 fetch((pc + 2) & 0xffff) if length > 2 else 0,
+                 r[0], r[1], r[2], r[3], r[4], r[5], r[7], regs.sp, flags.psw)
+            written += 1
+            offset += record_size
+            if offset == end:
+                offset = 0
+
+        try:
+            return run_loop(vm, table, max_steps, until_pc, record)
+        finally:
+            # a record is kept for an instruction that raised
+            self.count += written
+
+    # the raw records, oldest first
+    def dump(self):
+        if self.count <= self.size:
+            return bytes(self.buffer[:self.count * RECORD.size])
+        split = self.count % self.size * RECORD.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def records(self):
+        return records(self.dump())
+
+    # one line per record, oldest first
+    def decode(self):
+        return [format_record(record) for record in self.records()]
+
+# (pc, opcode, operand 1, operand 2, b, c, d, e, h, l, a, sp, psw) tuples from
+# raw records
+def records(data):
+    return RECORD.iter_unpack(data)
+
+def format_record(record):
+    pc, opcode, arg1, arg2, b, c, d, e, h, l, a, sp, psw = record
+    text, length = TABLE[opcode]
+    if length == 2:
+        text += HEX[arg1]
+    elif length == 3:
+        text += HEX[arg2] + HEX[arg1]
+    flags = ''.join(name if psw & bit else '-' for name, bit in (('S', 0x80), ('Z', 0x40), ('P', 0x04), ('C', 0x01)))
+    return (f'{pc:04X}  {text:14s} A={a:02X} B={b:02X} C={c:02X} D={d:02X} E={e:02X} '
+            f'H={h:02X} L={l:02X} SP={sp:04X} {flags}')
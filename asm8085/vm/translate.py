@@ -0,0 +1,363 @@
+from .util import *
+from .vm import VM
+from .fast import FastVM, FAST_DISPATCH
+
+# Basic-block translation on top of the fast core. A straight-line run of
+# instructions starting at PC is turned into the source of one Python
+# function that keeps the registers, SP and PSW in locals and writes them
+# back when the block exits. Compiled blocks are cached by start address and
+# their bytes are watched in Memory, so a write into a block drops it, and a
+# block that overwrites itself exits right after the store. Jumps, calls and
+# returns end a block and leave the address to continue at in npc.
+# Blocks are not chained: each one returns to run(), and unpacks and writes
+# back the registers on every call. Long straight-line blocks run several
+# times faster than FastVM, but code that branches every few instructions
+# (most loops) gains little and can be slower than CachedVM.
+
+MAX_BLOCK = 32 # instructions
+MAX_BLOCK_BYTES = MAX_BLOCK * 3
+# executions of an address before a block is compiled for it, compiling
+# costs about as much as interpreting a thousand instructions, which a long
+# block earns back in a few dozen runs
+HOT_THRESHOLD = 50
+# an address whose block is invalidated (self-modifying code) runs
+# 2 ** n * (HOT_THRESHOLD + 1) more times interpreted before it is compiled
+# again, n counting its invalidations up to MAX_BACKOFF, so code that keeps
+# rewriting itself settles on the interpreter instead of recompiling every
+# pass
+MAX_BACKOFF = 12
+
+REG = ('b', 'c', 'd', 'e', 'h', 'l', None, 'a')
+HL = '(h << 8 | l)'
+
+def pair_expr(rp):
+    if rp == 0b1011:
+        return 'sp'
+    hi = (rp & 0b11) << 1
+    return f'({REG[hi]} << 8 | {REG[hi + 1]})'
+
+def pair_set(rp, expr):
+    if rp == 0b1011:
+        return [f'sp = {expr}']
+    hi = (rp & 0b11) << 1
+    return [f'res = {expr}', f'{REG[hi]} = res >> 8', f'{REG[hi + 1]} = res & 0xff']
+
+# source for A <- A op val and the PSW update, val is a local or constant
+def alu_lines(group, val):
+    if group == 0: # ADD
+        return [f'res = a + {val}', 'a = res & 0xff', 'psw = ZSP[a] | (res >> 8)']
+    if group == 1: # ADC
+        return [f'res = a + {val} + (psw & 1)', 'a = res & 0xff', 'psw = ZSP[a] | (res >> 8)']
+    if group == 2: # SUB
+        return [f'res = a - {val}', 'a = res & 0xff', 'psw = ZSP[a] | ((res >> 8) & 1)']
+    if group == 3: # SBB
+        return [f'res = a - {val} - (psw & 1)', 'a = res & 0xff', 'psw = ZSP[a] | ((res >> 8) & 1)']
+    if group == 4: # ANA
+        return [f'a &= {val}', 'psw = ZSP[a]']
+    if group == 5: # XRA
+        return [f'a ^= {val}', 'psw = ZSP[a]']
+    if group == 6: # ORA
+        return [f'a |= {val}', 'psw = ZSP[a]']
+    return [f'res = a - {val}', 'psw = ZSP[res & 0xff] | ((res >> 8) & 1)'] # CMP
+
+def call_lines(target, ret):
+    return [
+        'addr = (sp - 2) & 0xffff', f'store_word(addr, {ret})',
+        'sp = addr', f'npc = {target}',
+    ]
+
+def ret_lines():
+    return ['npc = fetch_word(sp)', 'sp = (sp + 2) & 0xffff']
+
+# source for a conditional branch, taken lines run when condition cc holds
+def cond_lines(cc, taken, next_pc):
+    return [f'if COND[{cc}][psw]:'] + [f'    {line}' for line in taken] + ['else:', f'    npc = {next_pc}']
+
+# returns (source lines, length, touches memory, stores to memory, ends block)
+# for the instruction at pc, or None if it cannot be translated, instructions
+# ending a block set npc
+def translate_one(pc, opcode, arg1, arg2):
+    imm = arg1
+    addr = arg1 | (arg2 << 8)
+    if opcode == 0x00: # NOP
+        return [], 1, False, False, False
+    if opcode == 0x76: # HLT
+        return ['vm.halted = True', f'npc = {(pc + 1) & 0xffff}'], 1, False, False, True
+    if opcode == 0xc3: # JMP
+        return [f'npc = {addr}'], 3, False, False, True
+    if opcode & 0xc7 == 0xc2: # Jcc
+        return cond_lines(get_dest(opcode), [f'npc = {addr}'], (pc + 3) & 0xffff), 3, False, False, True
+    if opcode == 0xcd: # CALL
+        return call_lines(addr, (pc + 3) & 0xffff), 3, True, True, True
+    if opcode & 0xc7 == 0xc4: # Ccc
+        next_pc = (pc + 3) & 0xffff
+        return cond_lines(get_dest(opcode), call_lines(addr, next_pc), next_pc), 3, True, True, True
+    if opcode == 0xc9: # RET
+        return ret_lines(), 1, True, False, True
+    if opcode & 0xc7 == 0xc0: # Rcc
+        return cond_lines(get_dest(opcode), ret_lines(), (pc + 1) & 0xffff), 1, True, False, True
+    if opcode == 0xe9: # PCHL
+        return [f'npc = {HL}'], 1, False, False, True
+    if opcode == 0xf9: # SPHL
+        return [f'sp = {HL}'], 1, False, False, False
+    if opcode & 0xcf == 0xc5: # PUSH
+        rp = get_rp(opcode)
+        val = '(a << 8 | psw)' if rp == 0b1011 else pair_expr(rp)
+        return ['addr = (sp - 2) & 0xffff', f'store_word(addr, {val})', 'sp = addr'], 1, True, True, False
+    if opcode & 0xcf == 0xc1: # POP
+        rp = get_rp(opcode)
+        if rp == 0b1011:
+            lines = ['a = res >> 8', f'psw = res & {PSW_MASK}']
+        else:
+            hi = (rp & 0b11) << 1
+            lines = [f'{REG[hi]} = res >> 8', f'{REG[hi + 1]} = res & 0xff']
+        return ['res = fetch_word(sp)'] + lines + ['sp = (sp + 2) & 0xffff'], 1, True, False, False
+    if opcode & 0xc0 == 0x40: # MOV
+        src = get_src(opcode)
+        dest = get_dest(opcode)
+        if src == 0b110:
+            return [f'{REG[dest]} = fetch{HL}'], 1, True, False, False
+        if dest == 0b110:
+            return [f'store({HL}, {REG[src]})'], 1, True, True, False
+        return [f'{REG[dest]} = {REG[src]}'], 1, False, False, False
+    if opcode & 0xc7 == 0x06: # MVI
+        dest = get_dest(opcode)
+        if dest == 0b110:
+            return [f'store({HL}, {imm})'], 2, True, True, False
+        return [f'{REG[dest]} = {imm}'], 2, False, False, False
+    if opcode == 0x3a: # LDA
+        return [f'a = fetch({addr})'], 3, True, False, False
+    if opcode == 0x32: # STA
+        return [f'store({addr}, a)'], 3, True, True, False
+    if opcode == 0x2a: # LHLD
+        return [f'l = fetch({addr})', f'h = fetch({(addr + 1) & 0xffff})'], 3, True, False, False
+    if opcode == 0x22: # SHLD
+        return [f'store({addr}, l)', f'store({(addr + 1) & 0xffff}, h)'], 3, True, True, False
+    if opcode & 0xcf == 0x01: # LXI
+        rp = get_rp(opcode)
+        if rp == 0b1011:
+            return [f'sp = {addr}'], 3, False, False, False
+        hi = (rp & 0b11) << 1
+        return [f'{REG[hi]} = {arg2}', f'{REG[hi + 1]} = {arg1}'], 3, False, False, False
+    if opcode in (0x0a, 0x1a): # LDAX
+        return [f'a = fetch{pair_expr(get_rp(opcode))}'], 1, True, False, False
+    if opcode in (0x02, 0x12): # STAX
+        return [f'store({pair_expr(get_rp(opcode))}, a)'], 1, True, True, False
+    if opcode == 0xeb: # XCHG
+        return ['d, e, h, l = h, l, d, e'], 1, False, False, False
+    if opcode == 0xe3: # XTHL
+        return [
+            'res = fetch(sp)', 'store(sp, l)', 'l = res',
+            'addr = (sp + 1) & 0xffff', 'res = fetch(addr)', 'store(addr, h)', 'h = res',
+        ], 1, True, True, False
+    if opcode & 0xc0 == 0x80: # ADD ADC SUB SBB ANA XRA ORA CMP
+        group = (opcode >> 3) & 0x07
+        src = get_src(opcode)
+        if src == 0b110:
+            return [f'val = fetch{HL}'] + alu_lines(group, 'val'), 1, True, False, False
+        return alu_lines(group, REG[src]), 1, False, False, False
+    if opcode & 0xc7 == 0xc6: # ADI ACI SUI SBI ANI XRI ORI CPI
+        return alu_lines((opcode >> 3) & 0x07, imm), 2, False, False, False
+    if opcode & 0xc6 == 0x04: # INR DCR
+        dest = get_dest(opcode)
+        delta = 0x01 if opcode & 0x01 == 0 else 0xff
+        if dest == 0b110:
+            return [
+                f'addr = {HL}', f'res = (fetch(addr) + {delta}) & 0xff',
+                'psw = (psw & 1) | ZSP[res]', 'store(addr, res)',
+            ], 1, True, True, False
+        reg = REG[dest]
+        return [f'{reg} = ({reg} + {delta}) & 0xff', f'psw = (psw & 1) | ZSP[{reg}]'], 1, False, False, False
+    if opcode & 0xc7 == 0x03: # INX DCX
+        rp = get_rp(opcode)
+        delta = 0x0001 if opcode & 0x08 == 0 else 0xffff
+        return pair_set(rp, f'({pair_expr(rp)} + {delta}) & 0xffff'), 1, False, False, False
+    if opcode & 0xcf == 0x09: # DAD
+        return [
+            f'res = {HL} + {pair_expr(get_rp(opcode))}', 'psw = (psw & ~1) | (res >> 16)',
+            'h = (res >> 8) & 0xff', 'l = res & 0xff',
+        ], 1, False, False, False
+    if opcode == 0x07: # RLC
+        return ['psw = (psw & ~1) | (a >> 7)', 'a = ((a << 1) & 0xff) | (a >> 7)'], 1, False, False, False
+    if opcode == 0x0f: # RRC
+        return ['psw = (psw & ~1) | (a & 1)', 'a = ((a & 1) << 7) | (a >> 1)'], 1, False, False, False
+    if opcode == 0x17: # RAL
+        return ['res = a >> 7', 'a = ((a << 1) & 0xff) | (psw & 1)', 'psw = (psw & ~1) | res'], 1, False, False, False
+    if opcode == 0x1f: # RAR
+        return ['res = a & 1', 'a = ((psw & 1) << 7) | (a >> 1)', 'psw = (psw & ~1) | res'], 1, False, False, False
+    if opcode == 0x2f: # CMA
+        return ['a ^= 0xff'], 1, False, False, False
+    if opcode == 0x3f: # CMC
+        return ['psw ^= 1'], 1, False, False, False
+    if opcode == 0x37: # STC
+        return ['psw |= 1'], 1, False, False, False
+    return None
+
+WRITE_BACK = 'r[:] = (b, c, d, e, h, l, 0, a); regs.sp = sp; flags.psw = psw'
+
+# returns (source, end address, instruction count) or None if the first
+# instruction at start cannot be translated
+def block_source(mem, start):
+    body = []
+    pcs = []
+    pc = start
+    exit_pc = None
+    size = len(mem)
+    while len(pcs) < MAX_BLOCK and pc < size:
+        opcode = mem[pc]
+        arg1 = mem[pc + 1] if pc + 1 < size else 0
+        arg2 = mem[pc + 2] if pc + 2 < size else 0
+        res = translate_one(pc, opcode, arg1, arg2)
+        if res is None:
+            break
+        lines, length, faults, stores, ends = res
+        if pc + length > size:
+            break
+        index = len(pcs)
+        pcs.append(pc)
+        next_pc = (pc + length) & 0xffff
+        if faults:
+            body.append(f'k = {index}')
+        body += lines
+        if stores and not ends:
+            # leave right after an instruction whose store landed in this block
+            body.append(f'if blocks[{start}] is None:')
+            body.append(f'    {WRITE_BACK}; regs.pc = {next_pc}; return {index + 1}')
+        pc += length
+        if ends:
+            exit_pc = 'npc'
+            break
+    if not pcs:
+        return None
+    count = len(pcs)
+    if exit_pc is None:
+        exit_pc = pc & 0xffff
+    src = [
+        'def factory(fetch, store, fetch_word, store_word, blocks, ZSP, COND, VMError):',
+        f'    PCS = {tuple(pcs)!r}',
+        '    def block(vm):',
+        '        regs = vm.regs',
+        '        r = regs.r',
+        '        flags = vm.flags',
+        '        b, c, d, e, h, l, _, a = r',
+        '        sp = regs.sp',
+        '        psw = flags.psw',
+        '        k = 0',
+        '        try:',
+    ]
+    src += [f'            {line}' for line in body or ['pass']]
+    src += [
+        '        except VMError as err:',
+        f'            {WRITE_BACK}; regs.pc = PCS[k]',
+        # instructions of the block completed before the one that raised
+        '            err.block_steps = k',
+        '            raise',
+        f'        {WRITE_BACK}; regs.pc = {exit_pc}',
+        f'        return {count}',
+        '    return block',
+    ]
+    return '\n'.join(src), pc, count
+
+class TranslatingVM(FastVM):
+    def __init__(self):
+        super().__init__()
+        # compiled blocks by start address, with the end address and
+        # instruction count of each
+        self.blocks = [None] * 0x10000
+        self.block_end = [0] * 0x10000
+        self.block_len = bytearray(0x10000)
+        self.heat = [0] * 0x10000
+        self.hot_threshold = HOT_THRESHOLD
+        # invalidations of the block at each address, see MAX_BACKOFF
+        self.backoff = bytearray(0x10000)
+        self.blocks_compiled = 0
+        self.block_hits = 0
+        self.block_invalidations = 0
+        self.mem.watchers.append(self.invalidate)
+
+    def stats(self):
+        return {
+            'blocks_compiled': self.blocks_compiled,
+            'block_hits': self.block_hits,
+            'block_invalidations': self.block_invalidations,
+        }
+
+    def translate(self, start):
+        res = block_source(self.mem, start)
+        if res is None:
+            return None
+        src, end, count = res
+        namespace = {}
+        exec(compile(src, f'<block {start:04x}>', 'exec'), namespace)
+        mem = self.mem
+        block = namespace['factory'](
+            mem.__getitem__, mem.__setitem__, mem.read_word, mem.write_word,
+            self.blocks, ZSP_TABLE, CONDITION_TABLES, VMError)
+        self.blocks[start] = block
+        self.block_end[start] = end
+        self.block_len[start] = count
+        mem.watch(start, end)
+        self.blocks_compiled += 1
+        return block
+
+    # drops every block overlapping [start, end)
+    def invalidate(self, start, end):
+        blocks = self.blocks
+        block_end = self.block_end
+        backoff = self.backoff
+        for addr in range(max(start - MAX_BLOCK_BYTES + 1, 0), end):
+            if blocks[addr] is not None and block_end[addr] > start:
+                blocks[addr] = None
+                self.mem.unwatch(addr, block_end[addr])
+                self.block_invalidations += 1
+                n = backoff[addr] = min(backoff[addr] + 1, MAX_BACKOFF)
+                self.heat[addr] = self.hot_threshold - ((self.hot_threshold + 1) << n)
+
+    def flush(self):
+        self.invalidate(0, len(self.mem))
+
+    def run(self, max_steps=None, until_pc=None):
+        # blocks do not record single instructions, traced, profiled and
+        # clocked runs step through FAST_DISPATCH
+        if self.trace is not None or self.profile is not None or self.clock is not None:
+            return VM.run(self, max_steps, until_pc)
+        if self.halted:
+            raise VMError('Cannot run a halted program')
+        regs = self.regs
+        fetch = self.mem.__getitem__
+        blocks = self.blocks
+        block_end = self.block_end
+        block_len = self.block_len
+        heat = self.heat
+        hot = self.hot_threshold
+        table = FAST_DISPATCH
+        limit = -1 if max_steps is None else max_steps
+        steps = 0
+        try:
+            while steps != limit:
+                pc = regs.pc
+                if pc == until_pc:
+                    return steps, VM.STOP_PC
+                block = blocks[pc]
+                if block is None:
+                    if heat[pc] < hot:
+                        heat[pc] += 1
+                    else:
+                        block = self.translate(pc)
+                else:
+                    self.block_hits += 1
+                # single-step when there is no block or running the whole block
+                # would overshoot the step budget or skip over until_pc
+                if (block is None or (limit >= 0 and steps + block_len[pc] > limit)
+                        or (until_pc is not None and pc < until_pc < block_end[pc])):
+                    table[fetch(pc)](self)
+                    steps += 1
+                else:
+                    steps += block(self)
+                if self.halted:
+                    return steps, VM.STOP_HALT
+            return steps, VM.STOP_STEPS
+        except VMError as e:
+            # see run_loop, the instructions of a block that raised count too
+            e.steps = steps + getattr(e, 'block_steps', 0)
+            raise
@@ -1,79 +1,515 @@
+import itertools
+import mmap
+import os
+
+# raised out of run() with steps set to the instructions completed before the
+# one that raised
 class VMError(Exception):
     pass
 
-# AC not supported
+# PSW bit masks, AC not supported
+S_BIT = 0x80
+Z_BIT = 0x40
+P_BIT = 0x04
+CY_BIT = 0x01
+
+def zsp_bits(val):
+    bits = S_BIT if val & 0x80 else 0
+    if val == 0:
+        bits |= Z_BIT
+    if bin(val).count('1') % 2 == 0:
+        bits |= P_BIT
+    return bits
+
+# Z, S and P bits of the PSW for every byte value
+ZSP_TABLE = bytes(zsp_bits(val) for val in range(256))
+
+# flag bits that survive POP PSW
+PSW_MASK = S_BIT | Z_BIT | P_BIT | CY_BIT
+
+# (flag, required value) for the condition field of Jcc/Ccc/Rcc:
+# NZ Z NC C PO PE P M
+CONDITIONS = (
+    (Z_BIT, 0), (Z_BIT, Z_BIT), (CY_BIT, 0), (CY_BIT, CY_BIT),
+    (P_BIT, 0), (P_BIT, P_BIT), (S_BIT, 0), (S_BIT, S_BIT),
+)
+
+# per condition, 1 for every PSW value that satisfies it
+CONDITION_TABLES = tuple(
+    bytes(1 if psw & flag == value else 0 for psw in range(256))
+    for flag, value in CONDITIONS
+)
+
 class Flags:
     def __init__(self):
-        self._Z = 0
-        self._S = 0
-        self._P = 0
-        self._CY = 0
+        self.psw = 0
     
     @property
     def Z(self):
-        return self._Z
+        return (self.psw >> 6) & 1
     
     @Z.setter
     def Z(self, value):
         assert value == 0 or value == 1
-        self._Z = value
+        self.psw = (self.psw & ~Z_BIT) | (value << 6)
     
     @property
     def S(self):
-        return self._S
+        return self.psw >> 7
     
     @S.setter
     def S(self, value):
         assert value == 0 or value == 1
-        self._S = value
+        self.psw = (self.psw & ~S_BIT) | (value << 7)
     
     @property
     def P(self):
-        return self._P
+        return (self.psw >> 2) & 1
     
     @P.setter
     def P(self, value):
         assert value == 0 or value == 1
-        self._P = value
+        self.psw = (self.psw & ~P_BIT) | (value << 2)
     
     @property
     def CY(self):
-        return self._CY
+        return self.psw & CY_BIT
     
     @CY.setter
     def CY(self, value):
         assert value == 0 or value == 1
-        self._CY = value
+        self.psw = (self.psw & ~CY_BIT) | value
 
     def update_zsp(self, val):
+        # a negative index would silently wrap in the table
         assert 0 <= val <= 0xff
-        self.Z = 1 if val & 0xff == 0 else 0
-        self.S = 1 if val & 0x80 != 0 else 0
-        self.P = 1 if bin(val & 0xff).count('1') % 2 == 0 else 0
+        self.psw = (self.psw & CY_BIT) | ZSP_TABLE[val]
 
     def as_byte(self):
-        return (self.S << 7) | (self.Z << 6) | (self.P << 2) | self.CY
+        return self.psw
+
+# Memory is a table of 256-byte pages. A page is a bytearray while the Memory
+# owns it and an immutable bytes object while it is shared with snapshots and
+# forks. Writing to a shared page fails with TypeError on the fast path and
+# the slow path gives the Memory its own copy first, so a fork only pays for
+# the pages it writes. Pages can also be memoryviews into a mapped file or
+# another buffer, read-only views are ROM and writing to them raises VMError,
+# or DevicePages that forward accesses to callbacks. Every kind is indexed
+# the same way, so plain RAM accesses never check what kind a page is.
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+ZERO_PAGE = bytes(PAGE_SIZE)
+
+# a page of memory-mapped I/O, read(addr) returns the byte at addr and
+# write(addr, val) stores one
+class DevicePage:
+    __slots__ = ('base', 'read', 'write')
+
+    def __init__(self, base, read, write):
+        self.base = base
+        self.read = read
+        self.write = write
+
+    def __len__(self):
+        return PAGE_SIZE
+
+    # without this iteration would go through __getitem__ until it raised,
+    # reading one address past the page
+    def __iter__(self):
+        return (self.read(self.base + i) for i in range(PAGE_SIZE))
+
+    def __getitem__(self, offset):
+        if isinstance(offset, slice):
+            return bytes(self.read(self.base + i) for i in range(*offset.indices(PAGE_SIZE)))
+        return self.read(self.base + offset)
+
+    def __setitem__(self, offset, val):
+        if isinstance(offset, slice):
+            for i, byte in zip(range(*offset.indices(PAGE_SIZE)), val):
+                self.write(self.base + i, byte)
+        else:
+            self.write(self.base + offset, val)
+
+# the contents of a writable mapped page in a snapshot, restore() copies them
+# back into the mapping so the file stays attached
+class MappedPage(bytes):
+    def __new__(cls, view):
+        page = super().__new__(cls, view)
+        page.view = view
+        return page
+
+# the pages of a snapshot with mapped pages as plain copies, for a fork that
+# must not write through to the parent's mapping
+def detach(pages):
+    return tuple(bytes(page) if type(page) is MappedPage else page for page in pages)
+
+# a range of pages switched between several sets of pages, bank 0 holds what
+# was mapped in the range when the banks were created, the others start as
+# zeroed RAM
+# snapshots only hold the pages currently mapped, not the other banks or which
+# bank is selected
+class Banks:
+    def __init__(self, mem, start, end, count):
+        mem.check_pages(start, end)
+        self.mem = mem
+        self.start = start
+        self.end = end
+        first = start >> PAGE_BITS
+        last = end >> PAGE_BITS
+        self.banks = [mem.pages[first:last]] + [[ZERO_PAGE] * (last - first) for _ in range(count - 1)]
+        self.current = 0
+
+    def select(self, bank):
+        if bank == self.current:
+            return
+        if not 0 <= bank < len(self.banks):
+            raise VMError(f'Unknown bank {bank}')
+        pages = self.mem.pages
+        first = self.start >> PAGE_BITS
+        last = self.end >> PAGE_BITS
+        # pages may have been copied or replaced since the bank was selected
+        self.banks[self.current] = pages[first:last]
+        pages[first:last] = self.banks[bank]
+        self.current = bank
+        self.mem.written(self.start, self.end)
 
 class Memory:
     def __init__(self, size):
         self.len = size
-        self.content = [0] * size
+        full, rest = divmod(size, PAGE_SIZE)
+        self.pages = [ZERO_PAGE] * full + ([bytes(rest)] if rest else [])
+        # per-byte count of watches, watchers are called as watcher(start, end)
+        # after a write to any watched byte
+        self.watched = bytearray(size)
+        self.watchers = []
+        # pages at the last mark()
+        self.marked = tuple(self.pages)
     
     def __len__(self):
         return self.len
+
+    # kept from when memory was one bytearray behind a memoryview: indexing
+    # and slicing Memory reads and writes through the same way, iterating,
+    # bytes() and tobytes() give the whole image. Slices and the image are
+    # copies since the pages are not one buffer, so memoryview() does not
+    # take a Memory.
+    @property
+    def view(self):
+        return self
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.pages)
+
+    def tobytes(self):
+        return self.dump()
+
+    __bytes__ = tobytes
     
+    # negative addresses would index pages from the end, they go to the slow
+    # path with slices (which raise TypeError on the comparison)
     def __getitem__(self, idx):
-        assert idx >= 0
-        if idx >= self.len:
-            raise VMError('Invalid address')
-        return self.content[idx]
+        try:
+            if idx >= 0:
+                return self.pages[idx >> PAGE_BITS][idx & PAGE_MASK]
+        except (IndexError, TypeError):
+            pass
+        return self.read_slow(idx)
     
     def __setitem__(self, idx, val):
-        assert idx >= 0
-        assert 0 <= val <= 0xff
-        if idx >= self.len:
+        try:
+            if idx < 0:
+                raise IndexError
+            self.pages[idx >> PAGE_BITS][idx & PAGE_MASK] = val
+        except (IndexError, TypeError):
+            self.write_slow(idx, val)
+        # a slice yields a non-empty bytearray here, notify_write narrows it down
+        if self.watched[idx]:
+            self.notify_write(idx)
+
+    # slices and addresses outside memory
+    def read_slow(self, idx):
+        if isinstance(idx, slice):
+            start, end, step = idx.indices(self.len)
+            if step == 1:
+                return self.dump(start, max(start, end))
+            return bytes(self[addr] for addr in range(start, end, step))
+        raise VMError('Invalid address')
+
+    # slices, addresses outside memory and shared pages
+    def write_slow(self, idx, val):
+        if isinstance(idx, slice):
+            addrs = range(*idx.indices(self.len))
+            data = bytes(val)
+            if len(data) != len(addrs):
+                raise ValueError('Memory slice assignment cannot change its size')
+            if addrs.step == 1:
+                self.store(addrs.start, data)
+            else:
+                for addr, byte in zip(addrs, data):
+                    self.own(addr >> PAGE_BITS)[addr & PAGE_MASK] = byte
+            return
+        if not 0 <= idx < self.len:
             raise VMError('Invalid address')
-        self.content[idx] = val
+        self.own(idx >> PAGE_BITS)[idx & PAGE_MASK] = val
+
+    # page n in a writable form, a shared page is copied first
+    def own(self, n):
+        page = self.pages[n]
+        if type(page) is bytes:
+            page = self.pages[n] = bytearray(page)
+        elif type(page) is memoryview and page.readonly:
+            raise VMError(f'Write to read-only memory at {n << PAGE_BITS:04x}')
+        return page
+
+    # (page, start offset, end offset) for every page touched by [start, end)
+    def spans(self, start, end):
+        while start < end:
+            lo = start & PAGE_MASK
+            hi = min(PAGE_SIZE, lo + end - start)
+            yield start >> PAGE_BITS, lo, hi
+            start += hi - lo
+
+    # writes data at addr without bounds checks or notifying watchers
+    def store(self, addr, data):
+        pos = 0
+        for n, lo, hi in self.spans(addr, addr + len(data)):
+            self.own(n)[lo:hi] = data[pos:pos + hi - lo]
+            pos += hi - lo
+
+    # little-endian 16-bit access, e.g. for the stack, the high byte of a word
+    # at ffff wraps around to 0000
+    def read_word(self, addr):
+        if addr < 0:
+            raise VMError('Invalid address')
+        lo = addr & PAGE_MASK
+        try:
+            page = self.pages[addr >> PAGE_BITS]
+            if lo != PAGE_MASK:
+                return page[lo] | (page[lo + 1] << 8)
+            return page[lo] | (self.pages[((addr + 1) & 0xffff) >> PAGE_BITS][0] << 8)
+        except IndexError:
+            raise VMError('Invalid address') from None
+
+    def write_word(self, addr, val):
+        hi = (addr + 1) & 0xffff
+        if addr < 0 or addr >= self.len or hi >= self.len:
+            raise VMError('Invalid address')
+        lo = addr & PAGE_MASK
+        try:
+            if lo == PAGE_MASK:
+                raise TypeError
+            page = self.pages[addr >> PAGE_BITS]
+            page[lo] = val & 0xff
+            page[lo + 1] = val >> 8
+        except TypeError:
+            self.write_slow(addr, val & 0xff)
+            self.write_slow(hi, val >> 8)
+        watched = self.watched
+        if watched[addr] or watched[hi]:
+            if hi:
+                self.written(addr, addr + 2)
+            else:
+                self.written(addr, addr + 1)
+                self.written(0, 1)
+
+    # the current contents as a tuple of shared pages, pages owned by this
+    # Memory are frozen so both sides copy them on their next write, writable
+    # mapped pages are copied into the snapshot as MappedPages and stay
+    # mapped here
+    def snapshot(self):
+        pages = self.pages
+        snapshot = list(pages)
+        for n, page in enumerate(pages):
+            if type(page) is bytearray:
+                pages[n] = snapshot[n] = bytes(page)
+            elif type(page) is memoryview and not page.readonly:
+                snapshot[n] = MappedPage(page)
+        return tuple(snapshot)
+
+    # mapped pages in the snapshot are mapped again and get their saved
+    # contents written back, so the file sees the restore
+    def restore(self, pages):
+        if len(pages) != len(self.pages):
+            raise VMError('Snapshot does not match the memory size')
+        current = self.pages
+        changed = [n for n, page in enumerate(pages) if current[n] is not page]
+        current[:] = pages
+        for n in changed:
+            page = pages[n]
+            if type(page) is MappedPage:
+                page.view[:] = page
+                current[n] = page.view
+        # one scan of watched instead of one per page when nothing is watched
+        if self.watchers and self.watched.count(0) != self.len:
+            for n in changed:
+                start = n << PAGE_BITS
+                self.written(start, min(start + PAGE_SIZE, self.len))
+
+    # a new Memory with the same contents, sharing every page until written,
+    # writable mapped pages are copied into plain RAM
+    def fork(self):
+        mem = Memory(self.len)
+        mem.marked = detach(self.snapshot())
+        mem.pages = list(mem.marked)
+        return mem
+
+    # Dirty tracking falls out of copy-on-write: mark() freezes every page
+    # like snapshot() does, so a page written since then is a new object and
+    # finding them is an identity check per page, writes pay nothing for it.
+    # Writable mapped pages are always reported and compared by contents.
+    def mark(self):
+        self.marked = self.snapshot()
+        return self.marked
+
+    # numbers of the pages written since the last mark(), or since baseline
+    # (a snapshot) when given
+    def dirty_pages(self, baseline=None):
+        if baseline is None:
+            baseline = self.marked
+        return [n for n, page in enumerate(self.pages) if page is not baseline[n]]
+
+    # the bytes that differ from the last mark(), or from baseline, as a list
+    # of (address, bytes) runs, device pages are not compared
+    def diff(self, baseline=None):
+        if baseline is None:
+            baseline = self.marked
+        runs = []
+        start = None
+        end = None
+        for n in self.dirty_pages(baseline):
+            page = self.pages[n]
+            base = baseline[n]
+            # reading a device page could have side effects, they are skipped
+            if type(page) is DevicePage or type(base) is DevicePage or page == base:
+                continue
+            addr = n << PAGE_BITS
+            for offset, (new, old) in enumerate(zip(page, base)):
+                if new == old:
+                    continue
+                if addr + offset != end:
+                    if start is not None:
+                        runs.append((start, self.dump(start, end)))
+                    start = addr + offset
+                end = addr + offset + 1
+        if start is not None:
+            runs.append((start, self.dump(start, end)))
+        return runs
+
+    # uses the bytes of a buffer as the pages from addr on without copying,
+    # a read-only buffer becomes ROM, a writable one RAM that writes through
+    # to it. addr must be page aligned. A partial last page is copied: for a
+    # read-only buffer the whole page becomes ROM, for a writable one the
+    # copy is plain RAM that does not write through.
+    def map_view(self, view, addr=0):
+        view = memoryview(view).cast('B')
+        end = addr + len(view)
+        self.check_range(addr, end)
+        if addr & PAGE_MASK:
+            raise VMError(f'Mapping at {addr:04x} is not page aligned')
+        pages = self.pages
+        n = addr >> PAGE_BITS
+        pos = 0
+        while pos < len(view) and len(view) - pos >= len(pages[n]):
+            size = len(pages[n])
+            pages[n] = view[pos:pos + size]
+            n += 1
+            pos += size
+        if pos < len(view):
+            tail = bytes(view[pos:])
+            if view.readonly:
+                rest = bytes(pages[n][len(tail):])
+                pages[n] = memoryview(tail + rest)
+            else:
+                self.store(addr + pos, tail)
+        self.written(addr, end)
+        return end
+
+    # maps a file into memory at addr, see map_view
+    def map_file(self, path, addr=0, writable=False):
+        return self.map_view(file_view(path, writable), addr)
+
+    def check_pages(self, start, end):
+        self.check_range(start, end)
+        if (start | end) & PAGE_MASK:
+            raise VMError(f'Range {start:04x}-{end:04x} is not page aligned')
+
+    # routes every access to [start, end) to read(addr) and write(addr, val)
+    def map_device(self, start, end, read, write):
+        self.check_pages(start, end)
+        for base in range(start, end, PAGE_SIZE):
+            self.pages[base >> PAGE_BITS] = DevicePage(base, read, write)
+        self.written(start, end)
+
+    # turns [start, end) back into zeroed RAM
+    def unmap(self, start, end):
+        self.check_pages(start, end)
+        self.pages[start >> PAGE_BITS:end >> PAGE_BITS] = [ZERO_PAGE] * ((end - start) >> PAGE_BITS)
+        self.written(start, end)
+
+    # switchable banks over [start, end), see Banks
+    def banks(self, start, end, count):
+        return Banks(self, start, end, count)
+
+    def check_range(self, start, end):
+        if start < 0 or end > self.len or start > end:
+            raise VMError(f'Invalid address range {start:04x}-{end:04x}')
+
+    def watch(self, start, end):
+        for addr in range(start, end):
+            self.watched[addr] += 1
+
+    def unwatch(self, start, end):
+        for addr in range(start, end):
+            self.watched[addr] -= 1
+
+    def notify_write(self, idx):
+        if isinstance(idx, slice):
+            start, end, _ = idx.indices(self.len)
+        else:
+            start, end = idx, idx + 1
+        self.written(start, end)
+
+    def written(self, start, end):
+        if self.watched.count(0, start, end) != end - start:
+            for watcher in self.watchers:
+                watcher(start, end)
+
+    def load(self, data, addr=0):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
+        end = addr + len(data)
+        self.check_range(addr, end)
+        self.store(addr, data)
+        self.written(addr, end)
+        return end
+
+    def dump(self, start=0, end=None):
+        if end is None:
+            end = self.len
+        self.check_range(start, end)
+        pages = self.pages
+        return b''.join([pages[n][lo:hi] for n, lo, hi in self.spans(start, end)])
+
+    def fill(self, start, end, val=0):
+        self.check_range(start, end)
+        self.store(start, bytes((val,)) * (end - start))
+        self.written(start, end)
+
+    def copy(self, src, dest, size):
+        self.check_range(src, src + size)
+        self.check_range(dest, dest + size)
+        self.store(dest, self.dump(src, src + size))
+        self.written(dest, dest + size)
+
+# a memoryview of a whole file mapped into this process, read-only unless
+# writable, processes mapping the same file share its pages
+def file_view(path, writable=False):
+    with open(path, 'r+b' if writable else 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        return memoryview(mmap.mmap(f.fileno(), 0, access=access))
 
 def get_src(opcode):
     assert 0 <= opcode <= 0xff
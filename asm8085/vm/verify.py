@@ -0,0 +1,140 @@
+import random
+import sys
+from .util import VMError
+from .vm import VM, DISPATCH
+from .fast import FastVM
+from .predecode import CachedVM
+from .translate import TranslatingVM
+
+# Differential check of an unchecked core (FastVM by default) against the
+# checked VM: both run the same random instruction stream and must agree on
+# registers, flags, memory and errors after every step. PC wraps back to the
+# start of the code once it runs off the end, so code is executed repeatedly
+# and may be overwritten by the data it stores.
+
+IMPLEMENTED = [opcode for opcode in range(256) if DISPATCH[opcode].__name__ != 'unknown']
+
+class Mismatch(Exception):
+    pass
+
+def random_image(rng, code_size, data_size):
+    code = bytes(rng.choice(IMPLEMENTED) for _ in range(code_size))
+    data = rng.randbytes(data_size)
+    return code + data
+
+def random_state(rng, data_end):
+    r = [rng.randrange(256) for _ in range(8)]
+    r[6] = 0
+    # keep most M operands and stack accesses inside the loaded image
+    r[4] = rng.randrange(data_end >> 8)
+    sp = rng.randrange(data_end)
+    psw = rng.randrange(256) & 0xc5
+    return r, sp, psw
+
+def state(vm):
+    return tuple(vm.regs.r), vm.regs.pc, vm.regs.sp, vm.flags.psw, vm.halted
+
+# executes one instruction, or up to chunk instructions through run()
+# stopping at the end of the code
+def step(vm, chunk, code_size):
+    try:
+        if chunk is None:
+            vm.execute_next()
+        else:
+            vm.run(max_steps=chunk, until_pc=code_size)
+    except VMError as e:
+        return str(e)
+    return None
+
+def check_program(rng, steps, core=FastVM, max_chunk=None, code_size=256, data_size=0x1000):
+    image = random_image(rng, code_size, data_size)
+    r, sp, psw = random_state(rng, len(image))
+    checked = VM()
+    fast = core()
+    if isinstance(fast, TranslatingVM):
+        # translate from the first run so the blocks are what gets checked
+        fast.hot_threshold = 0
+    for vm in (checked, fast):
+        vm.mem.load(image)
+        vm.regs.r[:] = r
+        vm.regs.sp = sp
+        vm.flags.psw = psw
+    for n in range(steps):
+        pc = checked.regs.pc
+        opcode = checked.mem[pc]
+        chunk = None if max_chunk is None else rng.randrange(1, max_chunk + 1)
+        err = step(checked, chunk, code_size)
+        fast_err = step(fast, chunk, code_size)
+        if err != fast_err:
+            raise Mismatch(f'step {n} at {pc:04x} ({opcode:02x}): error {err!r} != {fast_err!r}')
+        if state(checked) != state(fast):
+            raise Mismatch(f'step {n} at {pc:04x} ({opcode:02x}): {state(checked)} != {state(fast)}')
+        if checked.mem.pages != fast.mem.pages:
+            raise Mismatch(f'step {n} at {pc:04x} ({opcode:02x}): memory differs')
+        if err is not None or checked.halted:
+            return n + 1
+        if checked.regs.pc >= code_size:
+            checked.regs.pc = fast.regs.pc = 0
+    return steps
+
+# returns the number of comparisons made, raises Mismatch on divergence
+# compares after every instruction, or after every run() of a random
+# 1..max_chunk instructions when max_chunk is given
+def verify(seed=0, programs=100, steps=500, core=FastVM, max_chunk=None):
+    rng = random.Random(seed)
+    return sum(check_program(rng, steps, core, max_chunk) for _ in range(programs))
+
+def batch_state(batch, index):
+    return (tuple(batch.r[:, index].tolist()), int(batch.pc[index]), int(batch.sp[index]),
+            int(batch.psw[index]), bool(batch.halted[index]))
+
+# Lockstep check of BatchVM: every instance runs the same random code on its
+# own random data and registers, after every round each instance must match a
+# VM stepped on its own. A faulted instance only has to agree on the error
+# and PC, VM may have done part of the instruction before raising.
+# Returns the number of instance steps compared.
+def verify_batch(seed=0, instances=64, steps=200, code_size=256, data_size=0x1000):
+    from .batch import BatchVM
+    rng = random.Random(seed)
+    code = random_image(rng, code_size, 0)
+    batch = BatchVM(instances)
+    vms = []
+    for index in range(instances):
+        vm = VM()
+        vm.mem.load(code + rng.randbytes(data_size))
+        vm.regs.r[:], vm.regs.sp, vm.flags.psw = random_state(rng, code_size + data_size)
+        batch.set_state(index, vm)
+        vms.append(vm)
+    errors = [None] * instances
+    compared = 0
+    for n in range(steps):
+        batch.step()
+        for index, vm in enumerate(vms):
+            if errors[index] is not None or vm.halted:
+                continue
+            pc = vm.regs.pc
+            errors[index] = step(vm, None, code_size)
+            compared += 1
+            if errors[index] != batch.errors[index]:
+                raise Mismatch(f'instance {index} step {n} at {pc:04x}: error {errors[index]!r} != {batch.errors[index]!r}')
+            if errors[index] is not None:
+                if vm.regs.pc != batch.pc[index]:
+                    raise Mismatch(f'instance {index} step {n}: faulted at {vm.regs.pc:04x} != {batch.pc[index]:04x}')
+                continue
+            if state(vm) != batch_state(batch, index):
+                raise Mismatch(f'instance {index} step {n} at {pc:04x}: {state(vm)} != {batch_state(batch, index)}')
+            if vm.regs.pc >= code_size:
+                vm.regs.pc = batch.pc[index] = 0
+    for index, vm in enumerate(vms):
+        if errors[index] is None and vm.mem.dump() != batch.mem[index].tobytes():
+            raise Mismatch(f'instance {index}: memory differs')
+    return compared
+
+if __name__ == '__main__':
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    programs = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for core in (FastVM, CachedVM):
+        print(f'{core.__name__}: {verify(seed, programs, core=core)} steps match')
+    for core in (FastVM, CachedVM, TranslatingVM):
+        print(f'{core.__name__}.run: {verify(seed, programs, core=core, max_chunk=64)} runs match')
+    print(f'BatchVM: {verify_batch(seed)} instance steps match')
@@ -1,21 +1,34 @@
-from util import *
-from registers import Registers
+from .util import *
+from .registers import Registers
 
 class VM:
-    RAM_SIZE = 64000 # bytes
+    RAM_SIZE = 0x10000 # bytes
+
+    # reasons returned by run()
+    STOP_HALT = 'halt'
+    STOP_STEPS = 'max_steps'
+    STOP_PC = 'until_pc'
 
     def __init__(self):
         self.regs = Registers()
         self.flags = Flags()
         self.mem = Memory(VM.RAM_SIZE)
         self.halted = False
+        # a Trace recording every instruction executed, see trace.py
+        self.trace = None
+        # a Profile counting executions and memory accesses, see profile.py
+        self.profile = None
+        # a Clock counting T-states into cycles, see clock.py
+        self.clock = None
+        self.cycles = 0
     
+    # operands wrap around the top of memory like PC does
     def get_single_arg(self):
-        return self.mem[self.regs.PC + 1]
+        return self.mem[(self.regs.PC + 1) & 0xffff]
     
     def get_double_arg(self):
-        arg1 = self.mem[self.regs.PC + 1]
-        arg2 = self.mem[self.regs.PC + 2]
+        arg1 = self.mem[(self.regs.PC + 1) & 0xffff]
+        arg2 = self.mem[(self.regs.PC + 2) & 0xffff]
         return (arg2 << 8) | arg1
 
     def extract_enc(self, enc):
@@ -40,9 +53,8 @@ class VM:
     def apply_add(self, val):
         assert 0 <= val <= 0xff
         res = self.regs.A + val
-        self.flags.CY = 1 if res > 255 else 0
-        self.regs.A = res % 256
-        self.flags.update_zsp(self.regs.A)
+        self.regs.A = res & 0xff
+        self.flags.psw = ZSP_TABLE[res & 0xff] | (res >> 8)
     
     def apply_add_carry(self, val):
         assert 0 <= val <= 0xff
@@ -54,9 +66,8 @@ class VM:
     def apply_sub(self, val):
         assert 0 <= val <= 0xff
         res = self.regs.A - val
-        self.flags.CY = 1 if res < 0 else 0
-        self.regs.A = res % 256
-        self.flags.update_zsp(self.regs.A)
+        self.regs.A = res & 0xff
+        self.flags.psw = ZSP_TABLE[res & 0xff] | ((res >> 8) & CY_BIT)
     
     def apply_sub_borrow(self, val):
         assert 0 <= val <= 0xff
@@ -65,215 +76,442 @@ class VM:
         else:
             self.apply_sub(val + self.flags.CY)
         
+    # logical operations clear CY
     def apply_and(self, val):
         assert 0 <= val <= 0xff
         self.regs.A &= val
-        self.flags.CY = 0
-        self.flags.update_zsp(self.regs.A)
+        self.flags.psw = ZSP_TABLE[self.regs.A]
     
     def apply_or(self, val):
         assert 0 <= val <= 0xff
         self.regs.A |= val
-        self.flags.CY = 0
-        self.flags.update_zsp(self.regs.A)
+        self.flags.psw = ZSP_TABLE[self.regs.A]
 
     def apply_xor(self, val):
         assert 0 <= val <= 0xff
         self.regs.A ^= val
-        self.flags.CY = 0
-        self.flags.update_zsp(self.regs.A)
+        self.flags.psw = ZSP_TABLE[self.regs.A]
 
     def apply_cmp(self, val):
         assert 0 <= val <= 0xff
         res = self.regs.A - val
-        self.flags.CY = 1 if res < 0 else 0
-        self.flags.update_zsp(res % 256)
+        self.flags.psw = ZSP_TABLE[res & 0xff] | ((res >> 8) & CY_BIT)
+
+    def push(self, val):
+        sp = (self.regs.SP - 2) & 0xffff
+        self.mem.write_word(sp, val)
+        self.regs.SP = sp
+
+    def pop(self):
+        val = self.mem.read_word(self.regs.SP)
+        self.regs.SP = (self.regs.SP + 2) & 0xffff
+        return val
+
+    # the whole machine state as a tuple, memory pages are shared with the
+    # VM copy-on-write so taking a snapshot only copies pages written since
+    # the previous one
+    def snapshot(self):
+        regs = self.regs
+        return (tuple(regs.r), regs.pc, regs.sp, self.flags.psw, self.halted, self.cycles,
+                self.mem.snapshot())
 
+    def restore(self, snapshot):
+        r, pc, sp, psw, halted, cycles, pages = snapshot
+        regs = self.regs
+        regs.r[:] = r
+        regs.pc = pc
+        regs.sp = sp
+        self.flags.psw = psw
+        self.halted = halted
+        self.cycles = cycles
+        self.mem.restore(pages)
+
+    # a new VM of the same class continuing from the current state, like
+    # Memory.fork it does not write through to mapped files
+    def fork(self):
+        vm = type(self)()
+        *state, pages = self.snapshot()
+        vm.restore((*state, detach(pages)))
+        return vm
+
+    # one instruction through DISPATCH, TranslatingVM steps without its blocks
     def execute_next(self):
-        if self.halted:
-            raise VMError('Cannot run a halted program')
-        opcode = self.mem[self.regs.PC]
-        if opcode == 0x00: # NOP
-            self.regs.PC += 1
-        elif opcode == 0x76: # HLT
-            self.halted = True
-            self.regs.PC += 1
-        elif opcode != 0x76 and opcode & 0xc0 == 0x40: # MOV
-            val = self.extract_src(opcode)
-            dest = get_dest(opcode)
-            self.apply_mov(val, dest)
-            self.regs.PC += 1
-        elif opcode & 0xc7 == 0x06: # MVI
-            dest = get_dest(opcode)
-            arg = self.get_single_arg()
-            self.apply_mov(arg, dest)
-            self.regs.PC += 2
-        elif opcode == 0x3a: # LDA
-            addr = self.get_double_arg()
-            self.regs.A = self.mem[addr]
-            self.regs.PC += 3
-        elif opcode == 0x32: # STA
-            addr = self.get_double_arg()
-            self.mem[addr] = self.regs.A
-            self.regs.PC += 3
-        elif opcode == 0x2a: # LHLD
-            addr = self.get_double_arg()
-            self.regs.L = self.mem[addr]
-            self.regs.H = self.mem[addr + 1]
-            self.regs.PC += 3
-        elif opcode == 0x22: # SHLD
-            addr = self.get_double_arg()
-            self.mem[addr] = self.regs.L
-            self.mem[addr + 1] = self.regs.H
-            self.regs.PC += 3
-        elif opcode & 0xcf == 0x01: # LXI
-            rp = get_rp(opcode)
-            arg = self.get_double_arg()
-            self.regs[rp] = arg
-            self.regs.PC += 3
-        elif opcode & 0xef == 0x0a: # LDAX
-            addr = self.extract_rp(opcode)
-            self.regs.A = self.mem[addr]
-            self.regs.PC += 1
-        elif opcode & 0xef == 0x02: # STAX
-            addr = self.extract_rp(opcode)
-            self.mem[addr] = self.regs.A
-            self.regs.PC += 1
-        elif opcode == 0xeb: # XCHG
-            self.regs.HL, self.regs.DE = self.regs.DE, self.regs.HL
-            self.regs.PC += 1
-        elif opcode == 0xe3: # XTHL
-            idx1 = self.regs.SP
-            idx2 = self.regs.SP + 1
-            self.mem[idx1], self.regs.L = self.regs.L, self.mem[idx1]
-            self.mem[idx2], self.regs.H = self.regs.H, self.mem[idx2]
-            self.regs.PC += 1
-        elif opcode & 0xf8 == 0x80: # ADD
-            val = self.extract_src(opcode)
-            self.apply_add(val)
-            self.regs.PC += 1
-        elif opcode == 0xc6: # ADI
-            arg = self.get_single_arg()
-            self.apply_add(arg)
-            self.regs.PC += 2
-        elif opcode & 0xf8 == 0x88: # ADC
-            val = self.extract_src(opcode)
-            self.apply_add_carry(val)
-            self.regs.PC += 1
-        elif opcode == 0xce: # ACI
-            arg = self.get_single_arg()
-            self.apply_add_carry(arg)
-            self.regs.PC += 2
-        elif opcode & 0xf8 == 0x90: # SUB
-            val = self.extract_src(opcode)
-            self.apply_sub(val)
-            self.regs.PC += 1
-        elif opcode == 0xd6: # SUI
-            arg = self.get_single_arg()
-            self.apply_sub(arg)
-            self.regs.PC += 2
-        elif opcode & 0xf8 == 0x98: # SBB
-            val = self.extract_src(opcode)
-            self.apply_sub_borrow(val)
-            self.regs.PC += 1
-        elif opcode == 0xde: # SBI
-            arg = self.get_single_arg()
-            self.apply_sub_borrow(arg)
-            self.regs.PC += 2
-        elif opcode & 0xc7 == 0x04: # INR
-            dest = get_dest(opcode)
-            val = self.extract_dest(opcode)
-            res = (val + 0x01) & 0xff
-            self.flags.update_zsp(res)
-            if dest == 0b110:
-                self.mem[self.regs.HL] = res
-            else:
-                self.regs[dest] = res
-            self.regs.PC += 1
-        elif opcode & 0xc7 == 0x05: # DCR
-            dest = get_dest(opcode)
-            val = self.extract_dest(opcode)
-            res = (val + 0xff) & 0xff
-            self.flags.update_zsp(res)
-            if dest == 0b110:
-                self.mem[self.regs.HL] = res
-            else:
-                self.regs[dest] = res
-            self.regs.PC += 1
-        elif opcode & 0xcf == 0x03: # INX
-            rp = get_rp(opcode)
-            res = (self.regs[rp] + 0x0001) & 0xffff
-            self.regs[rp] = res
-            self.regs.PC += 1
-        elif opcode & 0xcf == 0x0b: # DCX
-            rp = get_rp(opcode)
-            res = (self.regs[rp] + 0xffff) & 0xffff
-            self.regs[rp] = res
-            self.regs.PC += 1
-        elif opcode & 0xcf == 0x09: # DAD
-            val = self.extract_rp(opcode)
-            res = self.regs.HL + val
-            self.flags.CY = 1 if res > 0xffff else 0
-            self.regs.HL = res & 0xffff
-            self.regs.PC += 1
-        elif opcode & 0xf8 == 0xa0: # ANA
-            val = self.extract_src(opcode)
-            self.apply_and(val)
-            self.regs.PC += 1
-        elif opcode == 0xe6: # ANI
-            arg = self.get_single_arg()
-            self.apply_and(arg)
-            self.regs.PC += 2
-        elif opcode & 0xf8 == 0xb0: # ORA
-            val = self.extract_src(opcode)
-            self.apply_or(val)
-            self.regs.PC += 1
-        elif opcode == 0xf6: # ORI
-            arg = self.get_single_arg()
-            self.apply_or(arg)
-            self.regs.PC += 2
-        elif opcode & 0xf8 == 0xa8: # XRA
-            val = self.extract_src(opcode)
-            self.apply_xor(val)
-            self.regs.PC += 1
-        elif opcode == 0xee: # XRI
-            arg = self.get_single_arg()
-            self.apply_xor(arg)
-            self.regs.PC += 2
-        elif opcode & 0xf8 == 0xb8: # CMP
-            val = self.extract_src(opcode)
-            self.apply_cmp(val)
-            self.regs.PC += 1
-        elif opcode == 0xfe: # CPI
-            arg = self.get_single_arg()
-            self.apply_cmp(arg)
-            self.regs.PC += 2
-        elif opcode == 0x07: # RLC
-            self.flags.CY = self.regs.A >> 7
-            self.regs.A = ((self.regs.A << 1) & 0xff) | (self.regs.A >> 7)
-            self.regs.PC += 1
-        elif opcode == 0x0f: # RRC
-            self.flags.CY = self.regs.A & 1
-            self.regs.A = ((self.regs.A & 1) << 7) | (self.regs.A >> 1)
-            self.regs.PC += 1
-        elif opcode == 0x17: # RAL
-            msb = self.regs.A >> 7
-            self.regs.A = ((self.regs.A << 1) & 0xff) | self.flags.CY
-            self.flags.CY = msb
-            self.regs.PC += 1
-        elif opcode == 0x1f: # RAR
-            lsb = self.regs.A & 1
-            self.regs.A = (self.flags.CY << 7) | (self.regs.A >> 1)
-            self.flags.CY = lsb
-            self.regs.PC += 1
-        elif opcode == 0x2f: # CMA
-            self.regs.A ^= 0xff
-            self.regs.PC += 1
-        elif opcode == 0x3f: # CMC
-            self.flags.CY ^= 1
-            self.regs.PC += 1
-        elif opcode == 0x37: # STC
-            self.flags.CY = 1
-            self.regs.PC += 1
+        VM.run(self, 1)
+
+    # runs until HLT, max_steps instructions or PC == until_pc
+    # returns (instructions executed, stop reason)
+    # a set clock, profile or trace (checked in that order) runs the loop
+    # with its hook, see run_loop
+    def run(self, max_steps=None, until_pc=None):
+        for mode in (self.clock, self.profile, self.trace):
+            if mode is not None:
+                return mode.run(self, self.DISPATCH, max_steps, until_pc)
+        return run_loop(self, self.DISPATCH, max_steps, until_pc)
+
+# The run loop of every core dispatching one opcode at a time through table,
+# tracing, profiling and clocking pass hook(pc), called before each
+# instruction. The loop is picked once per run so a run without a hook or
+# until_pc does no per-step work beyond fetch, dispatch and the HLT check,
+# which is why those features cost nothing while they are off. CachedVM and
+# TranslatingVM dispatch by address and by block and have loops of their own
+# that follow the same rules, including setting steps on a VMError.
+def run_loop(vm, table, max_steps=None, until_pc=None, hook=None):
+    if vm.halted:
+        raise VMError('Cannot run a halted program')
+    regs = vm.regs
+    fetch = vm.mem.__getitem__
+    limit = -1 if max_steps is None else max_steps
+    steps = 0
+    try:
+        if hook is not None:
+            while steps != limit:
+                pc = regs.pc
+                if pc == until_pc:
+                    return steps, VM.STOP_PC
+                hook(pc)
+                table[fetch(pc)](vm)
+                steps += 1
+                if vm.halted:
+                    return steps, VM.STOP_HALT
+        elif until_pc is None:
+            while steps != limit:
+                table[fetch(regs.pc)](vm)
+                steps += 1
+                if vm.halted:
+                    return steps, VM.STOP_HALT
         else:
-            raise VMError(f'Unknown instruction {opcode:02x}')
+            while steps != limit:
+                pc = regs.pc
+                if pc == until_pc:
+                    return steps, VM.STOP_PC
+                table[fetch(pc)](vm)
+                steps += 1
+                if vm.halted:
+                    return steps, VM.STOP_HALT
+        return steps, VM.STOP_STEPS
+    except VMError as e:
+        e.steps = steps
+        raise
+
+# handlers take the VM and execute one instruction with its operands baked in
+
+def op_nop(vm):
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_hlt(vm):
+    vm.halted = True
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def make_unknown(opcode):
+    def unknown(vm):
+        raise VMError(f'Unknown instruction {opcode:02x}')
+    return unknown
+
+def make_mov(src, dest):
+    if src == 0b110:
+        def mov(vm):
+            vm.regs.r[dest] = vm.mem[vm.regs.HL]
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    elif dest == 0b110:
+        def mov(vm):
+            vm.mem[vm.regs.HL] = vm.regs.r[src]
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    else:
+        def mov(vm):
+            r = vm.regs.r
+            r[dest] = r[src]
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return mov
+
+def make_mvi(dest):
+    if dest == 0b110:
+        def mvi(vm):
+            vm.mem[vm.regs.HL] = vm.mem[(vm.regs.PC + 1) & 0xffff]
+            vm.regs.PC = (vm.regs.PC + 2) & 0xffff
+    else:
+        def mvi(vm):
+            vm.regs.r[dest] = vm.mem[(vm.regs.PC + 1) & 0xffff]
+            vm.regs.PC = (vm.regs.PC + 2) & 0xffff
+    return mvi
+
+def op_lda(vm):
+    vm.regs.A = vm.mem[vm.get_double_arg()]
+    vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+
+def op_sta(vm):
+    vm.mem[vm.get_double_arg()] = vm.regs.A
+    vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+
+def op_lhld(vm):
+    addr = vm.get_double_arg()
+    vm.regs.L = vm.mem[addr]
+    vm.regs.H = vm.mem[(addr + 1) & 0xffff]
+    vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+
+def op_shld(vm):
+    addr = vm.get_double_arg()
+    vm.mem[addr] = vm.regs.L
+    vm.mem[(addr + 1) & 0xffff] = vm.regs.H
+    vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+
+def make_lxi(rp):
+    def lxi(vm):
+        vm.regs[rp] = vm.get_double_arg()
+        vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+    return lxi
+
+def make_ldax(rp):
+    def ldax(vm):
+        vm.regs.A = vm.mem[vm.regs[rp]]
+        vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return ldax
+
+def make_stax(rp):
+    def stax(vm):
+        vm.mem[vm.regs[rp]] = vm.regs.A
+        vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return stax
+
+def op_xchg(vm):
+    vm.regs.HL, vm.regs.DE = vm.regs.DE, vm.regs.HL
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_xthl(vm):
+    idx1 = vm.regs.SP
+    idx2 = (vm.regs.SP + 1) & 0xffff
+    vm.mem[idx1], vm.regs.L = vm.regs.L, vm.mem[idx1]
+    vm.mem[idx2], vm.regs.H = vm.regs.H, vm.mem[idx2]
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+# register/memory operand forms of ADD, ADC, SUB, SBB, ANA, XRA, ORA, CMP
+def make_alu(apply, src):
+    if src == 0b110:
+        def alu(vm):
+            apply(vm, vm.mem[vm.regs.HL])
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    else:
+        def alu(vm):
+            apply(vm, vm.regs.r[src])
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return alu
+
+# immediate forms ADI, ACI, SUI, SBI, ANI, XRI, ORI, CPI
+def make_alu_imm(apply):
+    def alu_imm(vm):
+        apply(vm, vm.mem[(vm.regs.PC + 1) & 0xffff])
+        vm.regs.PC = (vm.regs.PC + 2) & 0xffff
+    return alu_imm
+
+def make_inr(dest):
+    if dest == 0b110:
+        def inr(vm):
+            addr = vm.regs.HL
+            res = (vm.mem[addr] + 0x01) & 0xff
+            vm.flags.update_zsp(res)
+            vm.mem[addr] = res
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    else:
+        def inr(vm):
+            r = vm.regs.r
+            res = (r[dest] + 0x01) & 0xff
+            vm.flags.update_zsp(res)
+            r[dest] = res
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return inr
+
+def make_dcr(dest):
+    if dest == 0b110:
+        def dcr(vm):
+            addr = vm.regs.HL
+            res = (vm.mem[addr] + 0xff) & 0xff
+            vm.flags.update_zsp(res)
+            vm.mem[addr] = res
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    else:
+        def dcr(vm):
+            r = vm.regs.r
+            res = (r[dest] + 0xff) & 0xff
+            vm.flags.update_zsp(res)
+            r[dest] = res
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return dcr
+
+def make_inx(rp):
+    def inx(vm):
+        vm.regs[rp] = (vm.regs[rp] + 0x0001) & 0xffff
+        vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return inx
+
+def make_dcx(rp):
+    def dcx(vm):
+        vm.regs[rp] = (vm.regs[rp] + 0xffff) & 0xffff
+        vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return dcx
+
+def make_dad(rp):
+    def dad(vm):
+        res = vm.regs.HL + vm.regs[rp]
+        vm.flags.CY = 1 if res > 0xffff else 0
+        vm.regs.HL = res & 0xffff
+        vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return dad
+
+def op_rlc(vm):
+    vm.flags.CY = vm.regs.A >> 7
+    vm.regs.A = ((vm.regs.A << 1) & 0xff) | (vm.regs.A >> 7)
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_rrc(vm):
+    vm.flags.CY = vm.regs.A & 1
+    vm.regs.A = ((vm.regs.A & 1) << 7) | (vm.regs.A >> 1)
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_ral(vm):
+    msb = vm.regs.A >> 7
+    vm.regs.A = ((vm.regs.A << 1) & 0xff) | vm.flags.CY
+    vm.flags.CY = msb
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_rar(vm):
+    lsb = vm.regs.A & 1
+    vm.regs.A = (vm.flags.CY << 7) | (vm.regs.A >> 1)
+    vm.flags.CY = lsb
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_cma(vm):
+    vm.regs.A ^= 0xff
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_cmc(vm):
+    vm.flags.psw ^= CY_BIT
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_stc(vm):
+    vm.flags.psw |= CY_BIT
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+def op_jmp(vm):
+    vm.regs.PC = vm.get_double_arg()
+
+def make_jcc(cond):
+    def jcc(vm):
+        if cond[vm.flags.psw]:
+            vm.regs.PC = vm.get_double_arg()
+        else:
+            vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+    return jcc
+
+def op_call(vm):
+    addr = vm.get_double_arg()
+    vm.push((vm.regs.PC + 3) & 0xffff)
+    vm.regs.PC = addr
+
+def make_ccc(cond):
+    def ccc(vm):
+        if cond[vm.flags.psw]:
+            op_call(vm)
+        else:
+            vm.regs.PC = (vm.regs.PC + 3) & 0xffff
+    return ccc
+
+def op_ret(vm):
+    vm.regs.PC = vm.pop()
+
+def make_rcc(cond):
+    def rcc(vm):
+        if cond[vm.flags.psw]:
+            vm.regs.PC = vm.pop()
+        else:
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return rcc
+
+def op_pchl(vm):
+    vm.regs.PC = vm.regs.HL
+
+def op_sphl(vm):
+    vm.regs.SP = vm.regs.HL
+    vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+
+# rp 0b1011 is PSW rather than SP for PUSH and POP
+def make_push(rp):
+    if rp == 0b1011:
+        def push(vm):
+            vm.push((vm.regs.A << 8) | vm.flags.psw)
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    else:
+        def push(vm):
+            vm.push(vm.regs[rp])
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return push
+
+def make_pop(rp):
+    if rp == 0b1011:
+        def pop(vm):
+            val = vm.pop()
+            vm.regs.A = val >> 8
+            vm.flags.psw = val & PSW_MASK
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    else:
+        def pop(vm):
+            vm.regs[rp] = vm.pop()
+            vm.regs.PC = (vm.regs.PC + 1) & 0xffff
+    return pop
+
+ALU_OPS = (
+    VM.apply_add, VM.apply_add_carry, VM.apply_sub, VM.apply_sub_borrow,
+    VM.apply_and, VM.apply_xor, VM.apply_or, VM.apply_cmp,
+)
+
+def build_dispatch():
+    table = [make_unknown(opcode) for opcode in range(256)]
+    table[0x00] = op_nop
+    for opcode in range(0x40, 0x80):
+        table[opcode] = make_mov(get_src(opcode), get_dest(opcode))
+    table[0x76] = op_hlt
+    for opcode in range(0x80, 0xc0):
+        table[opcode] = make_alu(ALU_OPS[(opcode >> 3) & 0x07], get_src(opcode))
+    for opcode in range(0xc6, 0x100, 0x08):
+        table[opcode] = make_alu_imm(ALU_OPS[(opcode >> 3) & 0x07])
+    for opcode in range(0x00, 0x40, 0x08):
+        table[opcode | 0x04] = make_inr(get_dest(opcode))
+        table[opcode | 0x05] = make_dcr(get_dest(opcode))
+        table[opcode | 0x06] = make_mvi(get_dest(opcode))
+    for opcode in range(0x00, 0x40, 0x10):
+        rp = get_rp(opcode)
+        table[opcode | 0x01] = make_lxi(rp)
+        table[opcode | 0x03] = make_inx(rp)
+        table[opcode | 0x09] = make_dad(rp)
+        table[opcode | 0x0b] = make_dcx(rp)
+    for opcode in (0x02, 0x12):
+        table[opcode] = make_stax(get_rp(opcode))
+        table[opcode | 0x08] = make_ldax(get_rp(opcode))
+    table[0x3a] = op_lda
+    table[0x32] = op_sta
+    table[0x2a] = op_lhld
+    table[0x22] = op_shld
+    table[0xeb] = op_xchg
+    table[0xe3] = op_xthl
+    table[0x07] = op_rlc
+    table[0x0f] = op_rrc
+    table[0x17] = op_ral
+    table[0x1f] = op_rar
+    table[0x2f] = op_cma
+    table[0x3f] = op_cmc
+    table[0x37] = op_stc
+    table[0xc3] = op_jmp
+    table[0xcd] = op_call
+    table[0xc9] = op_ret
+    for opcode in range(0xc0, 0x100, 0x08):
+        cond = CONDITION_TABLES[get_dest(opcode)]
+        table[opcode] = make_rcc(cond)
+        table[opcode | 0x02] = make_jcc(cond)
+        table[opcode | 0x04] = make_ccc(cond)
+    for opcode in range(0xc0, 0x100, 0x10):
+        table[opcode | 0x01] = make_pop(get_rp(opcode))
+        table[opcode | 0x05] = make_push(get_rp(opcode))
+    table[0xe9] = op_pchl
+    table[0xf9] = op_sphl
+    return table
+
+DISPATCH = build_dispatch()
+VM.DISPATCH = DISPATCH